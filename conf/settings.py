@@ -18,6 +18,26 @@ env = Env()
 env.read_env()
 TG_TOKEN_API = env('TG_TOKEN_API')
 YOO_KASSA_PROVIDER_TOKEN = env('YOO_KASSA_PROVIDER_TOKEN')
+TG_API_SERVER = env('TG_API_SERVER', None)
+MENU_CACHE_SIZE = env.int('MENU_CACHE_SIZE', 10000)
+CACHE_CHECK_INTERVAL = env.float('CACHE_CHECK_INTERVAL', 1)
+FSM_STATE_TTL = env.int('FSM_STATE_TTL', 24 * 60 * 60)
+FSM_FLUSH_INTERVAL = env.float('FSM_FLUSH_INTERVAL', 0.2)
+LIKES_BUFFER = env.bool('LIKES_BUFFER', False)
+LIKES_FLUSH_INTERVAL = env.float('LIKES_FLUSH_INTERVAL', 0.1)
+LIKES_FLUSH_BATCH_SIZE = env.int('LIKES_FLUSH_BATCH_SIZE', 500)
+LIKES_CACHE_SIZE = env.int('LIKES_CACHE_SIZE', 10000)
+LEADERBOARD_SIZE = env.int('LEADERBOARD_SIZE', 10)
+LEADERBOARD_INTERVAL = env.float('LEADERBOARD_INTERVAL', 2)
+LEADERBOARD_RELOAD_INTERVAL = env.float('LEADERBOARD_RELOAD_INTERVAL', 30)
+HOT_HALF_LIFE = env.float('HOT_HALF_LIFE', 10 * 60)
+HOT_FLUSH_INTERVAL = env.float('HOT_FLUSH_INTERVAL', 5)
+QUESTION_DIGEST_INTERVAL = env.float('QUESTION_DIGEST_INTERVAL', 5)
+METRICS_DIR = env('METRICS_DIR', None)
+METRICS_FLUSH_INTERVAL = env.float('METRICS_FLUSH_INTERVAL', 5)
+METRICS_MAX_AGE = env.float('METRICS_MAX_AGE', 60)
+QUERY_BUDGET = env.int('QUERY_BUDGET', 15)
+QUERY_BUDGET_MS = env.float('QUERY_BUDGET_MS', 100)
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -85,6 +105,15 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Выполняются на каждом новом соединении, см. meetups/signals.py
+        'PRAGMAS': {
+            'busy_timeout': env.int('SQLITE_BUSY_TIMEOUT', 5000),
+            'journal_mode': env('SQLITE_JOURNAL_MODE', 'wal'),
+            'synchronous': env('SQLITE_SYNCHRONOUS', 'normal'),
+            'mmap_size': env.int('SQLITE_MMAP_SIZE', 128 * 1024 * 1024),
+            'cache_size': env.int('SQLITE_CACHE_SIZE', -32000),
+            'temp_store': env('SQLITE_TEMP_STORE', 'memory'),
+        },
     }
 }
 
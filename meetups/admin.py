@@ -1,4 +1,5 @@
 from django.contrib import admin
+from meetups.menu import menu_state_cache
 from meetups.models import (
     Client,
     Event,
@@ -8,13 +9,45 @@ from meetups.models import (
     Question,
     Donate,
     Organizer,
+    Broadcast,
+    BroadcastDelivery,
+    FSMRecord,
+    CacheVersion,
 )
 
 admin.site.register(Client)
 admin.site.register(Event)
-admin.site.register(Visitor)
-admin.site.register(Presentation)
 admin.site.register(Likes)
 admin.site.register(Question)
 admin.site.register(Donate)
 admin.site.register(Organizer)
+admin.site.register(Broadcast)
+admin.site.register(BroadcastDelivery)
+admin.site.register(FSMRecord)
+admin.site.register(CacheVersion)
+
+
+class MenuVersionAdmin(admin.ModelAdmin):
+    # Changes made by the bot reset the menu in the bot process serving the client,
+    # edits made here have to reach every bot process through the shared version
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        menu_state_cache.version.bump()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        menu_state_cache.version.bump()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        menu_state_cache.version.bump()
+
+
+@admin.register(Visitor)
+class VisitorAdmin(MenuVersionAdmin):
+    pass
+
+
+@admin.register(Presentation)
+class PresentationAdmin(MenuVersionAdmin):
+    pass
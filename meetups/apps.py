@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class MeetupsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'meetups'
+
+    def ready(self):
+        from meetups import signals  # noqa: F401
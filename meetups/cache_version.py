@@ -0,0 +1,50 @@
+import time
+
+from django.conf import settings
+from django.db.models import F
+
+from meetups.models import CacheVersion
+
+
+class SharedVersion:
+    """Version of cached data, shared by all processes through a ``CacheVersion`` row.
+
+    Writers ``bump`` the version from model signals in whatever process makes
+    the change: a bot worker, another worker or the Django admin. Caches
+    ``read`` the version when they load and ask ``changed`` before serving,
+    which reads the row again at most once per ``check_interval`` seconds.
+    So an edit made elsewhere reaches the cache within ``check_interval``.
+    """
+
+    def __init__(self, name, check_interval=None, clock=time.monotonic):
+        self.name = name
+        self.check_interval = (
+            check_interval if check_interval is not None else getattr(settings, 'CACHE_CHECK_INTERVAL', 1)
+        )
+        self.clock = clock
+        self._seen = None
+        self._checked_at = None
+
+    def bump(self):
+        if not CacheVersion.objects.filter(name=self.name).update(version=F('version') + 1):
+            CacheVersion.objects.get_or_create(name=self.name, defaults={'version': 1})
+
+    def read(self):
+        version = CacheVersion.objects.filter(name=self.name).values_list('version', flat=True).first() or 0
+        self._seen = version
+        self._checked_at = self.clock()
+        return version
+
+    @property
+    def seen(self):
+        return self._seen
+
+    def is_due(self):
+        return self._seen is not None and self.clock() - self._checked_at >= self.check_interval
+
+    def changed(self):
+        """Whether the version moved since the last ``read``, the row is read only when a check is due."""
+        if not self.is_due():
+            return False
+        seen = self._seen
+        return self.read() != seen
@@ -3,7 +3,6 @@ from datetime import datetime
 import calendar
 
 import aiogram.utils.callback_data
-from aiogram.utils.exceptions import ChatNotFound
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import StatesGroup, State
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -16,6 +15,9 @@ from aiogram.contrib.fsm_storage.memory import MemoryStorage
     Organizer
 )'''
 from asgiref.sync import sync_to_async
+from meetups import queries
+from meetups.menu import menu_state_cache
+from meetups.management.commands.keyboard_templates import keyboard_template
 from django.core.exceptions import ObjectDoesNotExist
 from meetups.management.commands.runuserbot import *
 
@@ -76,7 +78,7 @@ def get_admin_keyboard(events_details):
 @dp.message_handler(commands=['admin'])
 async def admin_command(message: types.Message) -> None:
     try:
-        organizer = await sync_to_async(Organizer.objects.get)(user_id=message.from_user.id)
+        organizer = await queries.get_organizer(message.from_user.id)
     except ObjectDoesNotExist:
         await message.answer(
             'Вы не являетесь организатором',
@@ -84,8 +86,7 @@ async def admin_command(message: types.Message) -> None:
         )
         return
     if organizer:
-        organizer_events = await sync_to_async(Event.objects.filter)(organizer=organizer)
-        events_details = await sync_to_async(get_events_details)(organizer_events)
+        events_details = get_events_details(await queries.list_organizer_events(organizer))
         await message.answer('Вы вошли в меню для организаторов. Выберите мероприятие, чтобы изменить его программу '
                              'или создайте новое.',
                              parse_mode='HTML',
@@ -95,7 +96,7 @@ async def admin_command(message: types.Message) -> None:
         await message.answer('У вас не достаточно прав.', parse_mode='HTML')
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data == 'create_event')
+@router.route(CallbackData('create_event'))
 async def create_event_handler(callback: types.CallbackQuery) -> None:
     await CreateEventFSM.name.set()
 
@@ -125,7 +126,11 @@ async def get_event_year(message: types.Message, state: FSMContext) -> None:
 
 
 def get_year_keyboard():
-    year = datetime.now().year
+    return get_years_keyboard(datetime.now().year)
+
+
+@keyboard_template(maxsize=2)
+def get_years_keyboard(year):
     inline_kb = InlineKeyboardMarkup(row_width=5)
     inline_kb.row()
     for year in range(year - 2, year + 3):
@@ -134,16 +139,15 @@ def get_year_keyboard():
     return inline_kb
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('set_year_'),
-                           state=CreateEventFSM.year)
-async def get_event_month(callback: types.CallbackQuery, state: FSMContext) -> None:
-    year = callback.data.split('_')[-1]
+@router.route(CallbackData('set_year', year=str), state=CreateEventFSM.year)
+async def get_event_month(callback: types.CallbackQuery, callback_data, state: FSMContext) -> None:
     async with state.proxy() as data:
-        data['year'] = str(year)
+        data['year'] = callback_data.year
     await CreateEventFSM.next()
     await callback.message.answer('Теперь выберите месяц:', parse_mode='HTML', reply_markup=get_month_keyboard())
 
 
+@keyboard_template()
 def get_month_keyboard():
     months = [("Jan", '01'),
               ("Feb", '02'),
@@ -174,19 +178,22 @@ def get_month_keyboard():
     return inline_kb
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('set_month_'),
-                           state=CreateEventFSM.month)
-async def get_event_day(callback: types.CallbackQuery, state: FSMContext) -> None:
-    month = callback.data.split('_')[-1]
+@router.route(CallbackData('set_month', month=str), state=CreateEventFSM.month)
+async def get_event_day(callback: types.CallbackQuery, callback_data, state: FSMContext) -> None:
+    month = callback_data.month
     async with state.proxy() as data:
-        data['month'] = str(month)
+        data['month'] = month
     await CreateEventFSM.next()
 
     await callback.message.answer(f'Выберите день:', parse_mode='HTML', reply_markup=get_days_keyboard(month))
 
 
 def get_days_keyboard(month):
-    year = datetime.now().year
+    return get_month_days_keyboard(datetime.now().year, month)
+
+
+@keyboard_template(maxsize=24, key=lambda year, month: (int(year), int(month)))
+def get_month_days_keyboard(year, month):
     inline_kb = InlineKeyboardMarkup(row_width=7)
     inline_kb.row()
     for day in ["Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"]:
@@ -204,11 +211,10 @@ def get_days_keyboard(month):
     return inline_kb
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('set_day'), state=CreateEventFSM.day)
-async def get_event_time(callback: types.CallbackQuery, state: FSMContext) -> None:
-    day = callback.data.split('_')[-1]
+@router.route(CallbackData('set_day', day=str), state=CreateEventFSM.day)
+async def get_event_time(callback: types.CallbackQuery, callback_data, state: FSMContext) -> None:
     async with state.proxy() as data:
-        data['day'] = str(day)
+        data['day'] = callback_data.day
     await CreateEventFSM.next()
 
     await callback.message.answer(
@@ -218,6 +224,7 @@ async def get_event_time(callback: types.CallbackQuery, state: FSMContext) -> No
     )
 
 
+@keyboard_template()
 def get_time_keyboard():
     inline_kb = InlineKeyboardMarkup(row_width=4)
     inline_kb.row()
@@ -242,29 +249,24 @@ def get_time_keyboard():
     return inline_kb
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('set_time'),
-                           state=CreateEventFSM.start_time)
-async def create_event(callback: types.CallbackQuery, state: FSMContext) -> None:
-    time = callback.data.split('_')[-1]
+@router.route(CallbackData('set_time', time=str), state=CreateEventFSM.start_time)
+async def create_event(callback: types.CallbackQuery, callback_data, state: FSMContext) -> None:
     async with state.proxy() as data:
-        data['start_time'] = datetime.strptime(time, '%H:%M').time()
+        data['start_time'] = callback_data.time
     event_details = await state.get_data()
 
     date = '.'.join((event_details['day'], event_details['month'], event_details['year']))
-    event, _ = await sync_to_async(Event.objects.get_or_create)(
+    organizer = await queries.get_organizer(callback.from_user.id)
+    await queries.create_organizer_event(
+        organizer,
         name=event_details['name'],
         description=event_details['description'],
         date=datetime.strptime(date, '%d.%m.%Y').date(),
-        start_time=event_details['start_time']
+        start_time=datetime.strptime(event_details['start_time'], '%H:%M').time()
     )
-    await sync_to_async(event.save)()
     await state.finish()
 
-    organizer = await sync_to_async(Organizer.objects.get)(user_id=callback.from_user.id)
-    await sync_to_async(organizer.events.add)(event)
-    await sync_to_async(organizer.save)()
-    organizer_events = await sync_to_async(Event.objects.filter)(organizer=organizer)
-    events_details = await sync_to_async(get_events_details)(organizer_events)
+    events_details = get_events_details(await queries.list_organizer_events(organizer))
 
     await callback.message.answer(
         'Новое мероприятие создано!\n'
@@ -287,18 +289,18 @@ def get_presentations_keyboard(presentations, event_id):
     return inline_kb
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('edit_program_'))
-async def edit_event(callback: types.CallbackQuery) -> None:
-    event_id = callback.data.split('_')[-1]
-    event = await sync_to_async(Event.objects.get)(id=event_id)
-    presentations = await sync_to_async(Presentation.objects.filter)(event=event)
+@router.route(CallbackData('edit_program', event_id=int))
+async def edit_event(callback: types.CallbackQuery, callback_data) -> None:
+    event_id = callback_data.event_id
+    presentations = await queries.list_event_presentations(event_id)
     await callback.message.answer(
         'Выберите доклад, чтобы изменить время его начала и завершения, либо создайте новый.',
         parse_mode='HTML',
-        reply_markup=await sync_to_async(get_presentations_keyboard)(presentations, event_id)
+        reply_markup=get_presentations_keyboard(presentations, event_id)
     )
 
 
+@keyboard_template()
 def edit_presentation_time_keyboard():
     inline_kb = InlineKeyboardMarkup(row_width=1)
     inline_kb.insert(InlineKeyboardButton('Изменить время начала', callback_data='edit_time_start'))
@@ -308,14 +310,17 @@ def edit_presentation_time_keyboard():
     return inline_kb
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('edit_presentation_'))
-async def edit_presentation(callback: types.CallbackQuery, state: FSMContext) -> None:
-    presentation_id = callback.data.split('_')[-1]
+@router.route(CallbackData('edit_presentation', presentation_id=int))
+async def edit_presentation(callback: types.CallbackQuery, callback_data, state: FSMContext) -> None:
+    presentation_id = callback_data.presentation_id
+    presentation = await queries.get_presentation(presentation_id)
+    if presentation is None:
+        await callback.answer(PRESENTATION_DELETED, show_alert=True)
+        return
     await EditPresentation.id.set()
     async with state.proxy() as data:
         data['id'] = presentation_id
     await EditPresentation.next()
-    presentation = await sync_to_async(Presentation.objects.get)(id=presentation_id)
 
     await callback.message.answer(
         f'<b>Время начала:</b>\n{presentation.start_time}\n\n<b>Время завершения:</b>\n{presentation.end_time}',
@@ -324,30 +329,15 @@ async def edit_presentation(callback: types.CallbackQuery, state: FSMContext) ->
     )
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('edit_time_'),
-                           state=EditPresentation.flag)
-async def get_presentation_time(callback: types.CallbackQuery, state: FSMContext) -> None:
-    flag = callback.data.split('_')[-1]
+@router.route(CallbackData('edit_time', flag=str), state=EditPresentation.flag)
+async def get_presentation_time(callback: types.CallbackQuery, callback_data, state: FSMContext) -> None:
     async with state.proxy() as data:
-        data['flag'] = flag
+        data['flag'] = callback_data.flag
     await EditPresentation.next()
 
     await callback.message.answer('Введите время в формате ЧЧ:ММ', parse_mode='HTML')
 
 
-def get_event(presentation):
-    return presentation.event
-
-
-def get_ids(visitors):
-    return [visitor.client.chat_id for visitor in visitors]
-
-
-async def sending_to_members(ids, message):
-    for user_id in ids:
-        await bot.send_message(user_id, message)
-
-
 @dp.message_handler(state=EditPresentation.time)
 async def edit_presentation_time(message: types.Message, state: FSMContext) -> None:
     try:
@@ -361,27 +351,23 @@ async def edit_presentation_time(message: types.Message, state: FSMContext) -> N
     data = await state.get_data()
     flag = data['flag']
     presentation_id = data['id']
-    presentation = await sync_to_async(Presentation.objects.get)(id=presentation_id)
-    event = await sync_to_async(get_event)(presentation)
+    try:
+        presentation = await queries.get_presentation_with_event(presentation_id)
+    except ObjectDoesNotExist:
+        await state.finish()
+        await message.answer(PRESENTATION_DELETED, parse_mode='HTML')
+        return
+    event = presentation.event
     if flag == 'start':
         presentation.start_time = time
         mess = f'Время начала доклада {presentation} на мероприятии {event} изменено на {time}.'
     else:
         presentation.end_time = time
         mess = f'Время завершения доклада {presentation} на мероприятии {event} изменено на {time}.'
-    await sync_to_async(presentation.save)()
+    await presentation.asave()
 
-    organizer = await sync_to_async(Organizer.objects.get)(user_id=message.from_user.id)
-    organizer_events = await sync_to_async(Event.objects.filter)(organizer=organizer)
-    events_details = await sync_to_async(get_events_details)(organizer_events)
-
-    visitors = await sync_to_async(Visitor.objects.filter)(event=event)
-    ids = await sync_to_async(get_ids)(visitors)
-    try:
-        ids.remove(str(message.from_user.id))
-    except ValueError:
-        pass
-    await sync_to_async(print)(ids)
+    organizer = await queries.get_organizer(message.from_user.id)
+    events_details = get_events_details(await queries.list_organizer_events(organizer))
 
     await message.answer(
         f'Время доклада успешно изменено.\n\n'
@@ -390,15 +376,14 @@ async def edit_presentation_time(message: types.Message, state: FSMContext) -> N
         reply_markup=get_admin_keyboard(events_details)
     )
     await state.finish()
-    await sending_to_members(ids, mess)
+    await broadcast_engine.broadcast(mess, event=event, exclude_chat_ids=[str(message.from_user.id)])
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('create_presentation_'))
-async def create_presentation_handler(callback: types.CallbackQuery, state: FSMContext) -> None:
+@router.route(CallbackData('create_presentation', event_id=int))
+async def create_presentation_handler(callback: types.CallbackQuery, callback_data, state: FSMContext) -> None:
     await CreatePresentationFSM.event_id.set()
-    event_id = callback.data.split('_')[-1]
     async with state.proxy() as data:
-        data['event_id'] = event_id
+        data['event_id'] = callback_data.event_id
     await CreatePresentationFSM.next()
 
     await callback.message.answer('Введите название для новой презентации:', parse_mode='HTML')
@@ -426,12 +411,10 @@ async def get_presentation_annotation(message: types.Message, state: FSMContext)
     )
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('set_time'),
-                           state=CreatePresentationFSM.start_time)
-async def get_presentation_start_time(callback: types.CallbackQuery, state: FSMContext) -> None:
-    time = callback.data.split('_')[-1]
+@router.route(CallbackData('set_time', time=str), state=CreatePresentationFSM.start_time)
+async def get_presentation_start_time(callback: types.CallbackQuery, callback_data, state: FSMContext) -> None:
     async with state.proxy() as data:
-        data['start_time'] = datetime.strptime(time, '%H:%M').time()
+        data['start_time'] = callback_data.time
     await CreatePresentationFSM.next()
 
     await callback.message.answer(
@@ -441,12 +424,10 @@ async def get_presentation_start_time(callback: types.CallbackQuery, state: FSMC
     )
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('set_time'),
-                           state=CreatePresentationFSM.end_time)
-async def get_presentation_end_time(callback: types.CallbackQuery, state: FSMContext) -> None:
-    time = callback.data.split('_')[-1]
+@router.route(CallbackData('set_time', time=str), state=CreatePresentationFSM.end_time)
+async def get_presentation_end_time(callback: types.CallbackQuery, callback_data, state: FSMContext) -> None:
     async with state.proxy() as data:
-        data['end_time'] = datetime.strptime(time, '%H:%M').time()
+        data['end_time'] = callback_data.time
     await CreatePresentationFSM.next()
 
     await callback.message.answer(
@@ -456,23 +437,21 @@ async def get_presentation_end_time(callback: types.CallbackQuery, state: FSMCon
 
 
 async def create_presentation(speaker, data):
-    event = await sync_to_async(Event.objects.get)(id=data['event_id'])
-    presentation, _ = await sync_to_async(Presentation.objects.get_or_create)(
+    event = await queries.get_event(data['event_id'])
+    await queries.create_presentation(
+        speaker,
+        event.pk,
         name=data['name'],
         annotation=data['annotation'],
-        event=event,
-        start_time=data['start_time'],
-        end_time=data['end_time'],
-        speaker=speaker
+        start_time=datetime.strptime(data['start_time'], '%H:%M').time(),
+        end_time=datetime.strptime(data['end_time'], '%H:%M').time(),
     )
-    await sync_to_async(presentation.save)()
-    ids = [speaker.chat_id]
-    message = f'Вы назначены спикером с докладом {data["name"]} на мероприятии {presentation.event.name}\n'\
+    # The speaker may be served by another bot process than the organizer
+    await sync_to_async(menu_state_cache.version.bump)()
+    message = f'Вы назначены спикером с докладом {data["name"]} на мероприятии {event.name}\n'\
               f'Время начала доклада {data["start_time"]}'
-    try:
-        await sending_to_members(ids, message)
-    except ChatNotFound:
-        pass
+    # Shares the flood limits with broadcasts without holding up the organizer, an unreachable speaker is skipped
+    broadcast_engine.notify(speaker.chat_id, message)
 
 
 @dp.message_handler(state=CreatePresentationFSM.speaker_id)
@@ -482,14 +461,13 @@ async def get_presentation_speaker(message: types.Message, state: FSMContext) ->
         data['speaker_id'] = speaker_id
 
     try:
-        speaker = await sync_to_async(Client.objects.get)(chat_id=speaker_id)
+        speaker = await queries.get_client(speaker_id)
         data = await state.get_data()
         await create_presentation(speaker, data)
         await state.finish()
 
-        organizer = await sync_to_async(Organizer.objects.get)(user_id=message.from_user.id)
-        organizer_events = await sync_to_async(Event.objects.filter)(organizer=organizer)
-        events_details = await sync_to_async(get_events_details)(organizer_events)
+        organizer = await queries.get_organizer(message.from_user.id)
+        events_details = get_events_details(await queries.list_organizer_events(organizer))
 
         await message.answer(
             'Новый доклад создан.\nСпикер получит соответствующее оповещение.'
@@ -516,16 +494,13 @@ async def create_new_speaker(message: types.Message, state: FSMContext) -> None:
         return
     data = await state.get_data()
     first_name, last_name = message.text.split()
-    client, _ = await sync_to_async(Client.objects.get_or_create)(chat_id=data['speaker_id'])
-    client.first_name = first_name
-    client.last_name = last_name
-    await sync_to_async(client.save)()
+    client, _ = await queries.get_or_create_client(data['speaker_id'])
+    await queries.rename_client(client, first_name, last_name)
     await create_presentation(client, data)
     await state.finish()
 
-    organizer = await sync_to_async(Organizer.objects.get)(user_id=message.from_user.id)
-    organizer_events = await sync_to_async(Event.objects.filter)(organizer=organizer)
-    events_details = await sync_to_async(get_events_details)(organizer_events)
+    organizer = await queries.get_organizer(message.from_user.id)
+    events_details = get_events_details(await queries.list_organizer_events(organizer))
 
     await message.answer(
         'Новый спикер зарегистрирован и доклад создан.\nСпикер получит соответствующее оповещение.\n'
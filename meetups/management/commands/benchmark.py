@@ -0,0 +1,830 @@
+import asyncio
+import json
+import math
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from itertools import count, cycle, product
+from datetime import datetime, timedelta
+from pathlib import Path
+from random import Random
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.utils.payload import prepare_arg
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections, transaction
+from django.test.utils import (
+    setup_databases,
+    setup_test_environment,
+    teardown_databases,
+    teardown_test_environment,
+)
+from django.utils import timezone
+
+from meetups.management.commands.callback_router import CallbackData, CallbackRouter
+from meetups.management.commands.fake_telegram import (
+    FakeTelegramServer,
+    make_callback_update,
+    make_message_update,
+)
+from meetups.management.commands.likes_buffer import LikesBuffer
+from meetups.management.commands.recount_likes import recount_likes
+from meetups.management.commands.runuserbot import bot, broadcast_engine, dp
+from meetups.management.commands.user_keyboards import (
+    fetch_questions_page,
+    get_current_presentation_question_keyboard,
+    get_donate_keyboard,
+    get_event_schedule_keyboard,
+    get_my_presentations_keyboard,
+    get_question_main_menu_keyboard,
+    get_questions_feed_keyboard,
+    get_user_main_keyboard,
+)
+from meetups.menu import menu_state_cache
+from meetups.models import Client, Event, Likes, Organizer, Presentation, Question, Visitor
+from meetups.queries import add_like
+from meetups.query_budget import QueryProfile
+from meetups.ranking import HotRanking, hot_vote, recount_hot_scores, save_hot_votes
+from meetups.schedule import schedule_resolver
+from meetups.singleflight import single_flight
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+@contextmanager
+def temporary_database():
+    """Test database in memory, so benchmarks and load tests never touch the working one."""
+    setup_test_environment()
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=0)
+        teardown_test_environment()
+
+
+def create_event_fixture(clients_count=1000, presentations_count=10):
+    """Today's event running since midnight with visitors and speakers."""
+    now = datetime.now()
+    event = Event.objects.create(name='Python Meetup', date=now.date(), start_time=datetime.min.time())
+    Event.objects.create(name='Следующий Python Meetup', date=now.date() + timedelta(days=30),
+                         start_time=datetime.min.time())
+    Client.objects.bulk_create(
+        Client(chat_id=str(100000 + number), first_name='Слушатель', last_name=str(number))
+        for number in range(clients_count)
+    )
+    clients = list(Client.objects.order_by('pk'))
+    Visitor.objects.bulk_create(Visitor(client=client, event=event) for client in clients)
+    Presentation.objects.bulk_create(
+        Presentation(
+            name=f'Доклад {number}',
+            annotation='Аннотация',
+            event=event,
+            start_time=datetime.min.time(),
+            end_time=datetime.max.time(),
+            speaker=clients[number],
+        )
+        for number in range(presentations_count)
+    )
+    return event, clients
+
+
+def create_large_event_fixture(clients_count=1000, presentations_count=50, questions_count=100):
+    """Event of ``create_event_fixture`` with questions, likes and an organizer.
+
+    Every presentation gets ``questions_count`` questions from different
+    visitors, the n-th question of a presentation has n % 10 likes. The first
+    client is the organizer of both events.
+    """
+    event, clients = create_event_fixture(clients_count, presentations_count)
+    presentations = Presentation.objects.filter(event=event).order_by('pk')
+    Question.objects.bulk_create(
+        (
+            Question(
+                question_number=number + 1,
+                text=f'Вопрос {number} к докладу {presentation.name}',
+                presentation=presentation,
+                client=clients[-1 - number % len(clients)],
+            )
+            for presentation in presentations
+            for number in range(questions_count)
+        ),
+        batch_size=1000,
+    )
+    presentations.update(questions_count=questions_count)
+    Likes.objects.bulk_create(
+        (
+            Likes(question_id=question_id, client=clients[like])
+            for question_id, number in Question.objects.filter(presentation__event=event)
+            .values_list('pk', 'question_number').iterator()
+            for like in range((number - 1) % 10)
+        ),
+        batch_size=1000,
+    )
+    recount_likes(Question.objects.filter(presentation__event=event))
+    recount_hot_scores(Question.objects.filter(presentation__event=event))
+    organizer = Organizer.objects.create(user_id=clients[0].chat_id, first_name='Организатор')
+    organizer.events.set(Event.objects.all())
+    return event, clients
+
+
+def latency_stats(latencies):
+    if len(latencies) < 2:
+        return {}
+    percentiles = statistics.quantiles(latencies, n=100)
+    return {'p50_ms': percentiles[49] * 1000, 'p99_ms': percentiles[98] * 1000}
+
+
+class QueryCounter:
+    """Execute wrapper that counts queries, unlike ``CaptureQueriesContext`` it has no 9000 queries cap."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+# Сколько первых прогонов бенчмарка выполняется под tracemalloc
+ALLOCATION_RUNS = 100
+
+
+class Measurement:
+    """Wall time, SQL queries and allocations of ``repeat`` runs of a benchmark.
+
+    ``tracemalloc`` slows the code down several times, so only the first
+    tenth of the runs (at most ``ALLOCATION_RUNS``) is traced and the time is
+    taken over the rest. An allocation is the peak of memory traced during a
+    run above the memory held before it. Queries are counted by a
+    ``QueryProfile``, so those of async code run through ``sync_to_async``
+    count too.
+    """
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.traced = min(ALLOCATION_RUNS, repeat // 10)
+        self.profile = QueryProfile()
+        self.allocated = 0
+        self.elapsed = 0
+
+    def runs(self):
+        with self.profile:
+            if self.traced:
+                tracemalloc.start()
+                try:
+                    for _ in range(self.traced):
+                        tracemalloc.reset_peak()
+                        held = tracemalloc.get_traced_memory()[0]
+                        yield
+                        self.allocated += tracemalloc.get_traced_memory()[1] - held
+                finally:
+                    tracemalloc.stop()
+            started_at = time.perf_counter()
+            for _ in range(self.repeat - self.traced):
+                yield
+            self.elapsed = time.perf_counter() - started_at
+
+    def result(self):
+        result = {'runs': self.repeat, 'queries_per_run': self.profile.count / self.repeat}
+        if self.repeat > self.traced:
+            result['ms_per_run'] = self.elapsed * 1000 / (self.repeat - self.traced)
+        if self.traced:
+            result['alloc_kb_per_run'] = self.allocated / 1024 / self.traced
+        return result
+
+
+def measure(func, repeat):
+    measurement = Measurement(repeat)
+    for _ in measurement.runs():
+        func()
+    return measurement.result()
+
+
+@asynccontextmanager
+async def fake_bot_api():
+    """Point the bot to a local ``FakeTelegramServer`` for the duration of the block."""
+    telegram = FakeTelegramServer()
+    production_server = bot.server
+    bot.server = TelegramAPIServer.from_base(await telegram.start())
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    try:
+        yield telegram
+    finally:
+        bot.server = production_server
+        await dp.storage.close()
+        await (await bot.get_session()).close()
+        await telegram.stop()
+
+
+async def send_steps(steps, chat_id, update_ids, **fields):
+    """Feed the dispatcher ``(kind, text)`` steps of one user, ``kind`` is ``message`` or ``callback``."""
+    for kind, text in steps:
+        make_update = make_message_update if kind == 'message' else make_callback_update
+        update = make_update(next(update_ids), chat_id, text.format(**fields))
+        # Like polling, every update is handled in its own task: filters cache the FSM state in the context
+        await dp.process_updates([types.Update(**update)])
+
+
+@benchmark('main_menu')
+def main_menu_benchmark(options):
+    _, clients = create_event_fixture(options['clients'])
+    render = async_to_sync(get_user_main_keyboard)
+    renders = cycle(clients)
+
+    def render_cold():
+        menu_state_cache.clear()
+        schedule_resolver.invalidate()
+        render(next(renders))
+
+    def render_warm():
+        render(next(renders))
+
+    cold = measure(render_cold, len(clients))
+    for client in clients:
+        render(client)
+    warm = measure(render_warm, len(clients))
+    return [
+        {'name': 'main_menu: без кеша', **cold},
+        {'name': 'main_menu: с кешем', **warm},
+    ]
+
+
+@benchmark('likes')
+def likes_benchmark(options):
+    event, clients = create_event_fixture(options['clients'])
+    presentation = Presentation.objects.filter(event=event).first()
+    questions = Question.objects.bulk_create(
+        Question(question_number=number + 1, text=f'Вопрос {number}', presentation=presentation, client=clients[0])
+        for number in range(10)
+    )
+    votes = cycle([(client.chat_id, question.pk) for question in questions for client in clients])
+
+    def vote():
+        add_like(*next(votes))
+
+    total = len(questions) * len(clients)
+    new_votes = measure(vote, total)
+    repeated_votes = measure(vote, total)
+
+    buffered_questions = Question.objects.bulk_create(
+        Question(question_number=number + 1, text=f'Вопрос {number}', presentation=presentation, client=clients[0])
+        for number in range(10, 20)
+    )
+    buffer = LikesBuffer()
+
+    async def vote_buffered():
+        for question in buffered_questions:
+            for client in clients:
+                await buffer.vote(client.chat_id, question.pk)
+        await buffer.close()
+
+    buffered_votes = measure(async_to_sync(vote_buffered), 1)
+    buffered_votes.update(
+        runs=total,
+        queries_per_run=buffered_votes['queries_per_run'] / total,
+        ms_per_run=buffered_votes['ms_per_run'] / total,
+    )
+    return [
+        {'name': 'likes: новый голос', **new_votes, 'votes_per_second': 1000 / new_votes['ms_per_run']},
+        {'name': 'likes: повторный голос', **repeated_votes,
+         'votes_per_second': 1000 / repeated_votes['ms_per_run']},
+        {'name': 'likes: новый голос через буфер', **buffered_votes,
+         'votes_per_second': 1000 / buffered_votes['ms_per_run']},
+    ]
+
+
+@benchmark('hot_scores')
+def hot_scores_benchmark(options):
+    """Cost of a vote for the hot ranking as the number of votes grows.
+
+    ``HotRanking`` moves the question of the vote, the comparison computes the
+    decayed scores of all questions from all votes so far, as ranking by
+    age-based gravity would, and sorts them.
+    """
+    event, _ = create_event_fixture(options['clients'], 1)
+    presentation = Presentation.objects.get(event=event)
+    speaker = presentation.speaker
+    asked_at = hot_vote(timezone.now())
+    Question.objects.bulk_create(
+        Question(question_number=number + 1, text=f'Вопрос {number}', presentation=presentation, client=speaker,
+                 hot_score=asked_at)
+        for number in range(options['questions'])
+    )
+    question_ids = list(Question.objects.filter(presentation=presentation).values_list('pk', flat=True))
+    measured = 1000
+    rows = []
+    for votes_count in (1000, 10000, 100000):
+        # Голос приходит каждые 10 мс за случайный вопрос
+        random = Random(votes_count)
+        votes = [
+            (random.choice(question_ids), asked_at + number * 0.01 / settings.HOT_HALF_LIFE)
+            for number in range(votes_count)
+        ]
+        ranking = HotRanking.load(presentation.pk)
+        history = {question_id: [asked_at] for question_id in question_ids}
+        for question_id, vote in votes[:-measured]:
+            ranking.vote(question_id, vote)
+            history[question_id].append(vote)
+
+        ranked_votes = iter(votes[-measured:])
+
+        def vote_ranked():
+            ranking.vote(*next(ranked_votes))
+
+        recounted_votes = iter(votes[-measured:])
+
+        def vote_recounted():
+            question_id, vote = next(recounted_votes)
+            history[question_id].append(vote)
+            scores = {
+                other_id: sum(2 ** (other_vote - vote) for other_vote in other_votes)
+                for other_id, other_votes in history.items()
+            }
+            sorted(scores, key=scores.get, reverse=True)
+
+        for label, func, repeat in (
+            ('рейтинг в памяти', vote_ranked, measured),
+            ('пересчет по всем голосам', vote_recounted, measured // 10),
+        ):
+            result = measure(func, repeat)
+            rows.append({
+                'name': f'hot_scores: {votes_count} голосов, {label}',
+                'runs': result['runs'],
+                'us_per_run': result['ms_per_run'] * 1000,
+                'alloc_kb_per_run': result['alloc_kb_per_run'],
+            })
+
+    pending = {question_id: ranking.score(question_id) for question_id in question_ids}
+    rows.append({
+        'name': f'hot_scores: сохранение голосов за {len(pending)} вопросов',
+        **measure(lambda: save_hot_votes(pending), 20),
+    })
+    rows.append({
+        'name': 'hot_scores: первая страница горячих вопросов',
+        **measure(lambda: fetch_questions_page(presentation.pk, 'h'), 1000),
+    })
+    return rows
+
+
+def create_routes(handlers_count):
+    """Router and an equivalent chain of aiogram-style filters with ``handlers_count`` prefixes."""
+    router = CallbackRouter()
+    filters = []
+
+    async def handler(callback):
+        pass
+
+    for number in range(handlers_count):
+        prefix = f'action{number}_item'
+        router.route(CallbackData(prefix, item_id=int), state='*')(handler)
+        filters.append(lambda data, prefix=f'{prefix}_': data.startswith(prefix))
+    return router, filters
+
+
+@benchmark('callback_router')
+def callback_router_benchmark(options):
+    rows = []
+    for handlers_count in (10, 100, 1000):
+        router, filters = create_routes(handlers_count)
+        # Худший случай для цепочки фильтров: обработчик зарегистрирован последним
+        data = f'action{handlers_count - 1}_item_42'
+
+        def resolve():
+            router.resolve(data, None)
+
+        def filter_chain():
+            next(check for check in filters if check(data))
+
+        for label, func in (('префиксное дерево', resolve), ('цепочка фильтров', filter_chain)):
+            result = measure(func, 10000)
+            rows.append({
+                'name': f'callback_router: {handlers_count}, {label}',
+                'runs': result['runs'],
+                'us_per_run': result['ms_per_run'] * 1000,
+                'alloc_kb_per_run': result['alloc_kb_per_run'],
+            })
+    return rows
+
+
+def create_benchmark_fixture(options):
+    event, clients = create_large_event_fixture(options['clients'], options['presentations'], options['questions'])
+    presentation = Presentation.objects.filter(event=event).select_related('speaker').order_by('pk').first()
+    return event, clients, presentation
+
+
+@benchmark('keyboards')
+def keyboards_benchmark(options):
+    event, clients, presentation = create_benchmark_fixture(options)
+    listener = clients[-1]
+    questions = cycle(list(
+        Question.objects.filter(presentation=presentation).select_related('client').order_by('pk')
+    ))
+    page = fetch_questions_page(presentation.pk)
+    main_menu_clients = cycle(clients)
+
+    async def build_main_menu():
+        menu_state_cache.clear()
+        schedule_resolver.invalidate()
+        await get_user_main_keyboard(next(main_menu_clients))
+
+    async def serialize(build, *args):
+        # Так aiogram готовит reply_markup к отправке, шаблон клавиатуры отдает готовый JSON
+        prepare_arg(await build(*args))
+
+    builders = {
+        'get_user_main_keyboard': build_main_menu,
+        'get_event_schedule_keyboard': lambda: get_event_schedule_keyboard(event),
+        'get_my_presentations_keyboard': lambda: get_my_presentations_keyboard(presentation.speaker),
+        'get_current_presentation_question_keyboard':
+            lambda: get_current_presentation_question_keyboard(next(questions), listener.chat_id, False),
+        'get_questions_feed_keyboard':
+            lambda: get_questions_feed_keyboard(page[0], presentation.pk, listener.chat_id, False, *page[1:]),
+        'donate: шаблон + JSON': lambda: serialize(get_donate_keyboard),
+        'donate: сборка + JSON': lambda: serialize(get_donate_keyboard.__wrapped__),
+        'question_main_menu: шаблон + JSON': lambda: serialize(get_question_main_menu_keyboard, presentation.pk, False),
+        'question_main_menu: сборка + JSON':
+            lambda: serialize(get_question_main_menu_keyboard.__wrapped__, presentation.pk, False),
+    }
+
+    async def build_keyboards():
+        rows = []
+        for name, build in builders.items():
+            measurement = Measurement(options['repeat'])
+            for _ in measurement.runs():
+                await build()
+            rows.append({'name': f'keyboards: {name}', **measurement.result()})
+        return rows
+
+    return async_to_sync(build_keyboards)()
+
+
+# Пути через обработчики бота: чей чат и какие обновления он присылает
+HANDLER_PATHS = {
+    '/start': ('listener', [('message', '/start')]),
+    'main_menu': ('listener', [('callback', 'main_menu')]),
+    'show_schedule': ('listener', [('callback', 'show_schedule')]),
+    'show_current_presentation': ('listener', [('callback', 'show_current_presentation')]),
+    'questions_show': ('listener', [('callback', 'questions_show_{presentation_id}')]),
+    'question_like': ('voter', [('callback', 'question_like_{question_id}')]),
+    'show_my_events': ('listener', [('callback', 'show_my_events')]),
+    'show_my_presentations': ('speaker', [('callback', 'show_my_presentations')]),
+    'questions_show докладчиком': ('speaker', [('callback', 'questions_show_{presentation_id}')]),
+}
+
+
+@benchmark('handlers')
+def handlers_benchmark(options):
+    """Updates of ``HANDLER_PATHS`` going through the dispatcher with its middlewares and the fake Bot API."""
+    event, clients, presentation = create_benchmark_fixture(options)
+    question_ids = Question.objects.filter(presentation=presentation).order_by('pk').values_list('pk', flat=True)
+    votes = cycle(product(list(question_ids), [int(client.chat_id) for client in clients[1:]]))
+    chats = {'listener': int(clients[-1].chat_id), 'speaker': int(presentation.speaker.chat_id)}
+
+    async def run_paths():
+        rows = []
+        update_ids = count(1)
+        async with fake_bot_api():
+            for name, (role, steps) in HANDLER_PATHS.items():
+                measurement = Measurement(options['repeat'])
+                for _ in measurement.runs():
+                    question_id, chats['voter'] = next(votes)
+                    await send_steps(steps, chats[role], update_ids,
+                                     presentation_id=presentation.pk, question_id=question_id)
+                rows.append({'name': f'handlers: {name}', **measurement.result()})
+        return rows
+
+    return async_to_sync(run_paths)()
+
+
+# Сценарии организатора в admin_handlers, каждый прогон проходит сценарий целиком
+ADMIN_FLOWS = {
+    '/admin': [('message', '/admin')],
+    'edit_program': [('callback', 'edit_program_{event_id}')],
+    'изменение времени доклада': [
+        ('callback', 'edit_presentation_{presentation_id}'),
+        ('callback', 'edit_time_start'),
+        ('message', '00:00'),
+    ],
+    'новый доклад': [
+        ('callback', 'create_presentation_{event_id}'),
+        ('message', 'Новый доклад {run}'),
+        ('message', 'Аннотация'),
+        ('callback', 'set_time_10:00'),
+        ('callback', 'set_time_11:00'),
+        ('message', '{speaker_id}'),
+    ],
+    'новое мероприятие': [
+        ('callback', 'create_event'),
+        ('message', 'Новое мероприятие {run}'),
+        ('message', 'Описание'),
+        ('callback', 'set_year_{year}'),
+        ('callback', 'set_month_01'),
+        ('callback', 'set_day_15'),
+        ('callback', 'set_time_10:00'),
+    ],
+}
+
+
+@benchmark('admin')
+def admin_benchmark(options):
+    """Organizer flows of ``ADMIN_FLOWS``, the flows that create objects run last.
+
+    Changing the time of a presentation notifies all its visitors, the
+    broadcast is recorded within the run and sent in the background.
+    """
+    event, clients, presentation = create_benchmark_fixture(options)
+    presentation_ids = cycle(list(Presentation.objects.filter(event=event).values_list('pk', flat=True)))
+    organizer_id = int(clients[0].chat_id)
+
+    async def run_flows():
+        rows = []
+        update_ids = count(1)
+        async with fake_bot_api():
+            try:
+                for name, steps in ADMIN_FLOWS.items():
+                    measurement = Measurement(options['repeat'])
+                    for run, _ in enumerate(measurement.runs()):
+                        await send_steps(steps, organizer_id, update_ids, run=run, event_id=event.pk,
+                                         presentation_id=next(presentation_ids),
+                                         speaker_id=presentation.speaker.chat_id, year=event.date.year)
+                    rows.append({'name': f'admin: {name}', **measurement.result()})
+            finally:
+                await broadcast_engine.stop()
+        return rows
+
+    return async_to_sync(run_flows)()
+
+
+# Что делает один слушатель: открывает меню, программу, текущий доклад и вопросы к нему
+USER_SCENARIO = (
+    '/start',
+    'main_menu',
+    'show_schedule',
+    'show_current_presentation',
+    'questions_show_{presentation_id}',
+    'show_my_events',
+)
+
+
+async def simulate_users(chat_ids, presentation_id, rounds):
+    """Feed ``USER_SCENARIO`` of every user to the dispatcher concurrently.
+
+    The bot talks to a local ``FakeTelegramServer``, so the latency of an update
+    covers the handler, its queries and one HTTP round trip to the Bot API.
+    """
+    update_ids = count(1)
+    latencies = []
+
+    async def user(chat_id):
+        for _ in range(rounds):
+            for step in USER_SCENARIO:
+                step = step.format(presentation_id=presentation_id)
+                if step.startswith('/'):
+                    update = make_message_update(next(update_ids), chat_id, step)
+                else:
+                    update = make_callback_update(next(update_ids), chat_id, step)
+                started_at = time.perf_counter()
+                # Like aiogram itself, handle every update in its own task: filters cache the FSM state in the context
+                await asyncio.create_task(dp.process_update(types.Update(**update)))
+                latencies.append(time.perf_counter() - started_at)
+
+    async with fake_bot_api():
+        started_at = time.perf_counter()
+        await asyncio.gather(*(user(chat_id) for chat_id in chat_ids))
+        elapsed = time.perf_counter() - started_at
+    return latencies, elapsed
+
+
+@benchmark('concurrent_users')
+def concurrent_users_benchmark(options):
+    event, clients = create_event_fixture(options['users'])
+    presentation = Presentation.objects.filter(event=event).first()
+    Question.objects.bulk_create(
+        Question(question_number=number + 1, text=f'Вопрос {number}', presentation=presentation, client=client)
+        for number, client in enumerate(clients[:20])
+    )
+    chat_ids = [int(client.chat_id) for client in clients]
+    single_flight.reset_stats()
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries):
+        latencies, elapsed = async_to_sync(simulate_users)(chat_ids, presentation.pk, options['rounds'])
+    return [{
+        'name': f'concurrent_users: {len(chat_ids)} слушателей',
+        'runs': len(latencies),
+        'queries_per_run': queries.count / len(latencies),
+        'ms_per_run': elapsed * 1000 / len(latencies),
+        **latency_stats(latencies),
+    }] + [
+        {'name': f'single_flight: {name}', **stats}
+        for name, stats in single_flight.stats().items()
+    ]
+
+
+# Настройки SQLite по умолчанию, с которыми сравнивается профиль из DATABASES['default']['PRAGMAS']
+SQLITE_DEFAULT_PRAGMAS = {'journal_mode': 'delete', 'synchronous': 'full'}
+
+
+def create_file_database(alias, path, pragmas):
+    connections.settings[alias] = {**connections['default'].settings_dict, 'NAME': str(path), 'PRAGMAS': pragmas}
+    call_command('migrate', database=alias, verbosity=0)
+
+
+def run_contention(alias, seconds, writers, readers):
+    """Bot writers add questions and likes while admin readers list them."""
+    speaker = Client.objects.using(alias).create(chat_id='1', first_name='Докладчик')
+    event = Event.objects.using(alias).create(name='Python Meetup', date=datetime.now().date(),
+                                              start_time=datetime.min.time())
+    presentation = Presentation.objects.using(alias).create(
+        name='Доклад',
+        annotation='Аннотация',
+        event=event,
+        start_time=datetime.min.time(),
+        end_time=datetime.max.time(),
+        speaker=speaker,
+    )
+    clients = [Client.objects.using(alias).create(chat_id=str(100000 + number)) for number in range(writers)]
+    question_ids = []
+    write_latencies = []
+    read_latencies = []
+    locked = 0
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def write(client):
+        nonlocal locked
+        liked = 0
+        while time.monotonic() < deadline:
+            started_at = time.perf_counter()
+            try:
+                question = Question.objects.using(alias).create(
+                    question_number=len(question_ids) + 1,
+                    text='Вопрос',
+                    presentation=presentation,
+                    client=client,
+                )
+                with lock:
+                    question_ids.append(question.pk)
+                    to_like = question_ids[liked:-1]
+                    liked = len(question_ids) - 1
+                for question_id in to_like[-5:]:
+                    Likes.objects.using(alias).get_or_create(question_id=question_id, client=client)
+            except OperationalError:
+                with lock:
+                    locked += 1
+                continue
+            with lock:
+                write_latencies.append(time.perf_counter() - started_at)
+
+    def read():
+        nonlocal locked
+        questions = Question.objects.using(alias).select_related('client', 'presentation').order_by('-pk')
+        while time.monotonic() < deadline:
+            started_at = time.perf_counter()
+            try:
+                questions.count()
+                list(questions[:100])
+            except OperationalError:
+                with lock:
+                    locked += 1
+                continue
+            with lock:
+                read_latencies.append(time.perf_counter() - started_at)
+
+    def in_thread(func, *args):
+        try:
+            func(*args)
+        finally:
+            connections.close_all()
+
+    with ThreadPoolExecutor(writers + readers) as executor:
+        for client in clients:
+            executor.submit(in_thread, write, client)
+        for _ in range(readers):
+            executor.submit(in_thread, read)
+    return write_latencies, read_latencies, locked
+
+
+@benchmark('sqlite_contention')
+def sqlite_contention_benchmark(options):
+    profiles = {
+        'без профиля': SQLITE_DEFAULT_PRAGMAS,
+        'профиль': connections['default'].settings_dict.get('PRAGMAS', {}),
+    }
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        for number, (label, pragmas) in enumerate(profiles.items()):
+            alias = f'contention_{number}'
+            create_file_database(alias, Path(directory) / f'{alias}.sqlite3', pragmas)
+            try:
+                writes, reads, locked = run_contention(alias, options['seconds'], options['writers'],
+                                                       options['readers'])
+            finally:
+                connections[alias].close()
+            rows += [
+                {
+                    'name': f'sqlite_contention: {label}, запись',
+                    'runs': len(writes),
+                    'ms_per_run': statistics.fmean(writes) * 1000 if writes else 0,
+                    **latency_stats(writes),
+                    'locked': locked,
+                },
+                {
+                    'name': f'sqlite_contention: {label}, чтение',
+                    'runs': len(reads),
+                    'ms_per_run': statistics.fmean(reads) * 1000 if reads else 0,
+                    **latency_stats(reads),
+                },
+            ]
+    return rows
+
+
+ROW_FORMATS = {
+    'runs': 'runs={:<6}',
+    'queries_per_run': 'queries/run={:<8.2f}',
+    'ms_per_run': 'ms/run={:.3f}',
+    'us_per_run': 'us/run={:.2f}',
+    'alloc_kb_per_run': 'alloc/run={:.1f}KB',
+    'p50_ms': 'p50={:.1f}ms',
+    'p99_ms': 'p99={:.1f}ms',
+    'votes_per_second': 'votes/s={:.0f}',
+    'actions_per_second': 'actions/s={:.0f}',
+    'api_calls_per_run': 'api_calls/run={:.2f}',
+    'errors': 'errors={}',
+    'locked': 'locked={}',
+    'hits': 'hits={:<6}',
+    'misses': 'misses={}',
+}
+
+
+# Параметры, от которых зависят результаты, их записывают в JSON вместе с результатами
+FIXTURE_OPTIONS = ('names', 'clients', 'presentations', 'questions', 'repeat', 'users', 'rounds', 'seconds',
+                   'writers', 'readers')
+
+
+def format_row(row):
+    fields = (pattern.format(row[key]) for key, pattern in ROW_FORMATS.items() if key in row)
+    return f'{row["name"]:<54} ' + ' '.join(fields)
+
+
+class Command(BaseCommand):
+    help = 'Запускает бенчмарки бота на временной базе данных в памяти'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help=f'Какие бенчмарки запустить: {", ".join(BENCHMARKS)}')
+        parser.add_argument('--clients', type=int, default=1000, help='Количество слушателей в фикстуре')
+        parser.add_argument('--presentations', type=int, default=50,
+                            help='Количество докладов в фикстуре keyboards, handlers и admin')
+        parser.add_argument('--questions', type=int, default=100,
+                            help='Количество вопросов к каждому докладу в фикстуре keyboards, handlers и admin')
+        parser.add_argument('--repeat', type=int, default=200,
+                            help='Сколько раз keyboards, handlers и admin прогоняют каждый замер')
+        parser.add_argument('--users', type=int, default=500,
+                            help='Количество одновременных слушателей в concurrent_users')
+        parser.add_argument('--rounds', type=int, default=1,
+                            help='Сколько раз каждый слушатель проходит сценарий в concurrent_users')
+        parser.add_argument('--seconds', type=float, default=3, help='Длительность sqlite_contention для профиля')
+        parser.add_argument('--writers', type=int, default=8, help='Количество пишущих потоков в sqlite_contention')
+        parser.add_argument('--readers', type=int, default=2, help='Количество читающих потоков в sqlite_contention')
+        parser.add_argument('--json', help='Файл, в который записать результаты для сравнения запусков')
+
+    def handle(self, *args, **options):
+        started_at = datetime.now()
+        names = options['names'] or list(BENCHMARKS)
+        unknown = set(names) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f'Неизвестные бенчмарки: {", ".join(sorted(unknown))}')
+        results = []
+        with temporary_database():
+            for name in names:
+                with transaction.atomic():
+                    rows = BENCHMARKS[name](options)
+                    transaction.set_rollback(True)
+                menu_state_cache.clear()
+                schedule_resolver.invalidate()
+                for row in rows:
+                    self.stdout.write(format_row(row))
+                results += [{'benchmark': name, **row} for row in rows]
+        if options['json']:
+            report = {
+                'started_at': started_at.isoformat(timespec='seconds'),
+                'options': {option: options[option] for option in FIXTURE_OPTIONS},
+                'results': results,
+            }
+            Path(options['json']).write_text(json.dumps(report, ensure_ascii=False, indent=2))
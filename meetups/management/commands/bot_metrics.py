@@ -0,0 +1,154 @@
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from pathlib import Path
+
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from meetups.metrics import Metrics
+from meetups.query_budget import QueryProfile
+
+logger = logging.getLogger('BotMetrics')
+
+metrics = Metrics()
+
+# Update type and handler of the update being processed, read by the errors handler
+last_handler = contextvars.ContextVar('last_handler', default=None)
+
+
+class InstrumentedBot(Bot):
+    """Bot that records the latency and errors of every Bot API request."""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception:
+            metrics.inc('telegram_api_errors_total', method=method)
+            raise
+        finally:
+            metrics.observe('telegram_api_duration_seconds', time.perf_counter() - started_at, method=method)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Records latency, errors and in-flight updates of message and callback handlers.
+
+    Callback queries are reported under the handler the callback router picks
+    for them. With ``directory`` set, the metrics of the process are saved
+    every ``flush_interval`` seconds to a file of its own for the ``/metrics``
+    view. SQL statements of every update are counted, updates running more
+    than ``query_budget`` statements or spending more than ``query_budget_ms``
+    in them are logged with their queries.
+    """
+
+    def __init__(self, directory=None, flush_interval=5, query_budget=None, query_budget_ms=None):
+        super().__init__()
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.query_budget = query_budget
+        self.query_budget_ms = query_budget_ms
+        self._write_task = None
+
+    def setup(self, manager):
+        super().setup(manager)
+        manager.dispatcher.register_errors_handler(self.record_error)
+
+    @property
+    def path(self):
+        # Webhook workers are forked, so the file name is taken when writing
+        return Path(self.directory) / f'bot-{os.getpid()}.json'
+
+    @staticmethod
+    def handler_name(obj):
+        # The callback router keeps the route it picked on the callback
+        matched_route = getattr(obj, 'matched_route', None)
+        if matched_route is None:
+            handler = current_handler.get()
+        else:
+            route, _ = matched_route
+            handler = route.handler if route is not None else None
+        return getattr(handler, '__name__', None)
+
+    def start(self, update_type, obj, data):
+        name = self.handler_name(obj)
+        previous = data.pop('metrics', None)
+        if previous is not None:
+            # The previous handler raised SkipHandler, the update goes on to the next one
+            metrics.dec('bot_handler_in_flight', update=update_type, handler=previous[0])
+        if name is None:
+            return
+        data['metrics'] = (name, previous[1] if previous is not None else time.perf_counter())
+        metrics.inc('bot_handler_in_flight', update=update_type, handler=name)
+        if self.directory and (self._write_task is None or self._write_task.done()):
+            self._write_task = asyncio.create_task(self._write_periodically())
+
+    def finish(self, update_type, data):
+        started = data.pop('metrics', None)
+        if started is None:
+            return
+        name, started_at = started
+        metrics.dec('bot_handler_in_flight', update=update_type, handler=name)
+        metrics.observe('bot_handler_duration_seconds', time.perf_counter() - started_at,
+                        update=update_type, handler=name)
+        last_handler.set((update_type, name))
+
+    def over_query_budget(self, profile):
+        return (
+            self.query_budget is not None and profile.count > self.query_budget
+            or self.query_budget_ms is not None and profile.duration * 1000 > self.query_budget_ms
+        )
+
+    async def on_pre_process_update(self, update, data):
+        last_handler.set(None)
+        data['query_profile'] = QueryProfile().__enter__()
+
+    async def on_post_process_update(self, update, results, data):
+        profile = data.pop('query_profile')
+        profile.__exit__(None, None, None)
+        handled = last_handler.get()
+        if handled is None:
+            return
+        update_type, profile.name = handled
+        metrics.inc('bot_handler_queries_total', profile.count, update=update_type, handler=profile.name)
+        if self.over_query_budget(profile):
+            metrics.inc('bot_handler_over_query_budget_total', update=update_type, handler=profile.name)
+            logger.warning('query budget exceeded by %s', profile.report())
+
+    async def on_process_message(self, message, data):
+        self.start('message', message, data)
+
+    async def on_post_process_message(self, message, results, data):
+        self.finish('message', data)
+
+    async def on_process_callback_query(self, callback, data):
+        self.start('callback_query', callback, data)
+
+    async def on_post_process_callback_query(self, callback, results, data):
+        self.finish('callback_query', data)
+
+    async def record_error(self, update, exception):
+        handled = last_handler.get()
+        if handled is not None:
+            update_type, name = handled
+            metrics.inc('bot_handler_errors_total', update=update_type, handler=name)
+
+    def write(self):
+        try:
+            metrics.write(self.path)
+        except OSError:
+            logger.exception('failed to save metrics')
+
+    async def _write_periodically(self):
+        while True:
+            self.write()
+            await asyncio.sleep(self.flush_interval)
+
+    async def close(self):
+        if self._write_task is not None:
+            self._write_task.cancel()
+        if self.directory:
+            self.write()
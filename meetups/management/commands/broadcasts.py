@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+
+from aiogram.utils.exceptions import (
+    BotBlocked,
+    CantInitiateConversation,
+    ChatNotFound,
+    RetryAfter,
+    TelegramAPIError,
+    UserDeactivated,
+)
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+
+from meetups.models import Broadcast, BroadcastDelivery, Visitor
+
+logger = logging.getLogger('Broadcasts')
+
+# Ограничения Telegram: около 30 сообщений в секунду всего и одно сообщение в секунду в один чат
+GLOBAL_RATE = 30
+PER_CHAT_RATE = 1
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated_at = clock()
+        self.paused_until = 0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Stop handing out tokens, e.g. after Telegram answered RetryAfter."""
+        self.paused_until = max(self.paused_until, self.clock() + seconds)
+        self.updated_at = self.paused_until
+        self.tokens = 0
+
+    def _take(self):
+        """Take a token, returns how long to wait for one if there is none."""
+        now = self.clock()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                delay = self._take()
+                if not delay:
+                    return
+                await asyncio.sleep(delay)
+
+
+def _shared_field(index):
+    def get(self):
+        return self._state[index]
+
+    def set(self, value):
+        self._state[index] = value
+
+    return property(get, set)
+
+
+class SharedTokenBucket(TokenBucket):
+    """Token bucket kept in shared memory.
+
+    Bot processes forked after the bucket is created, like the webhook
+    workers, take tokens from the same bucket, so the Telegram limit holds
+    for all of them together. A pause after RetryAfter stops every process.
+    """
+
+    tokens = _shared_field(0)
+    updated_at = _shared_field(1)
+    paused_until = _shared_field(2)
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self._state = multiprocessing.get_context('fork').Array('d', 3)
+        super().__init__(rate, capacity, clock)
+
+    def pause(self, seconds):
+        with self._state.get_lock():
+            super().pause(seconds)
+
+    def _take(self):
+        with self._state.get_lock():
+            return super()._take()
+
+
+class BroadcastEngine:
+    """Sends a message to many chats concurrently within Telegram flood limits.
+
+    Recipients are stored as pending ``BroadcastDelivery`` rows before the first
+    message goes out and their status is written back in batches, so a
+    broadcast interrupted by a restart is resumed with ``resume_unfinished``.
+    The ``global_bucket`` is shared with the processes forked from this one.
+    """
+
+    def __init__(self, bot, rate=GLOBAL_RATE, chat_rate=PER_CHAT_RATE, concurrency=GLOBAL_RATE, flush_every=100):
+        self.bot = bot
+        self.global_bucket = SharedTokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.concurrency = concurrency
+        self.flush_every = flush_every
+        self._chat_buckets = {}
+        self._tasks = set()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10 * self.flush_every:
+                idle_since = time.monotonic() - 1 / self.chat_rate
+                self._chat_buckets = {
+                    key: value for key, value in self._chat_buckets.items() if value.updated_at > idle_since
+                }
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, capacity=1)
+        return bucket
+
+    @staticmethod
+    def create_broadcast(text, event=None, exclude_chat_ids=()):
+        broadcast = Broadcast.objects.create(text=text, event=event)
+        recipients = (
+            Visitor.objects.filter(event=event)
+            .exclude(client__chat_id__in=exclude_chat_ids)
+            .values_list('client__chat_id', flat=True)
+            .distinct()
+        )
+        BroadcastDelivery.objects.bulk_create(
+            (BroadcastDelivery(broadcast=broadcast, chat_id=chat_id) for chat_id in recipients.iterator()),
+            batch_size=500,
+            ignore_conflicts=True,
+        )
+        return broadcast
+
+    async def broadcast(self, text, event=None, exclude_chat_ids=()):
+        """Record a new broadcast and start sending it in the background."""
+        broadcast = await sync_to_async(self.create_broadcast)(text, event, exclude_chat_ids)
+        self.schedule(broadcast)
+        return broadcast
+
+    def schedule(self, broadcast):
+        return self._start(self.run(broadcast))
+
+    def notify(self, chat_id, text):
+        """Send one message in the background within the same flood limits, it is not recorded."""
+        return self._start(self.deliver(chat_id, text))
+
+    def _start(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def stop(self):
+        """Cancel broadcasts being sent, ``resume_unfinished`` picks them up on the next start.
+
+        Notifications waiting to be sent are dropped.
+        """
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def resume_unfinished(self):
+        broadcasts = await sync_to_async(list)(Broadcast.objects.filter(finished_at__isnull=True))
+        for broadcast in broadcasts:
+            logger.info(f'resume broadcast {broadcast.pk}')
+            self.schedule(broadcast)
+
+    async def deliver(self, chat_id, text):
+        while True:
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text)
+                return BroadcastDelivery.SENT
+            except RetryAfter as error:
+                logger.warning(f'flood control, retry in {error.timeout} s')
+                self.global_bucket.pause(error.timeout)
+            except (BotBlocked, ChatNotFound, UserDeactivated, CantInitiateConversation):
+                return BroadcastDelivery.BLOCKED
+            except TelegramAPIError:
+                logger.exception(f'failed to deliver broadcast to {chat_id}')
+                return BroadcastDelivery.FAILED
+
+    @staticmethod
+    def save_progress(broadcast, results):
+        for status, chat_ids in results.items():
+            BroadcastDelivery.objects.filter(
+                broadcast=broadcast,
+                chat_id__in=chat_ids,
+            ).update(status=status)
+
+    async def run(self, broadcast):
+        chat_ids = await sync_to_async(list)(
+            broadcast.deliveries.filter(status=BroadcastDelivery.PENDING).values_list('chat_id', flat=True)
+        )
+        queue = asyncio.Queue()
+        for chat_id in chat_ids:
+            queue.put_nowait(chat_id)
+        results = {}
+        done = 0
+
+        async def flush():
+            nonlocal results, done
+            pending_results, results, done = results, {}, 0
+            if pending_results:
+                await sync_to_async(self.save_progress)(broadcast, pending_results)
+
+        async def worker():
+            nonlocal done
+            while not queue.empty():
+                chat_id = queue.get_nowait()
+                status = await self.deliver(chat_id, broadcast.text)
+                results.setdefault(status, []).append(chat_id)
+                done += 1
+                if done >= self.flush_every:
+                    await flush()
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(chat_ids)))))
+        finally:
+            await flush()
+        broadcast.finished_at = timezone.now()
+        await sync_to_async(broadcast.save)(update_fields=['finished_at'])
+        logger.info(f'broadcast {broadcast.pk} finished, {len(chat_ids)} recipients')
@@ -0,0 +1,153 @@
+import inspect
+from collections import namedtuple
+
+from aiogram.dispatcher.filters.state import State
+from aiogram.dispatcher.handler import SkipHandler
+
+SEPARATOR = '_'
+ANY_STATE = '*'
+
+
+class CallbackConflict(Exception):
+    pass
+
+
+class CallbackData:
+    """Scheme of a callback payload ``<prefix>_<field>_<field>...``.
+
+    Fields are converted with the callables they are declared with (``int``,
+    ``str``). Trailing fields with a default may be left out, so buttons of
+    messages sent before a field was added keep working.
+    """
+
+    def __init__(self, prefix, defaults=None, **fields):
+        defaults = defaults or {}
+        self.prefix = prefix
+        self.parts = tuple(prefix.split(SEPARATOR))
+        self.converters = tuple(fields.values())
+        self.required = len(fields) - len(defaults)
+        if set(defaults) != set(list(fields)[self.required:]):
+            raise ValueError(f'Only trailing fields of {prefix!r} may have defaults')
+        self.type = namedtuple(
+            ''.join(part.title() for part in self.parts) + 'Data',
+            fields,
+            defaults=[defaults[name] for name in list(fields)[self.required:]],
+        )
+
+    def __repr__(self):
+        return f'CallbackData({SEPARATOR.join((self.prefix, *self.type._fields))!r})'
+
+    def parse(self, values):
+        """Typed payload from the parts after the prefix, ``None`` if they do not fit the scheme."""
+        if not self.required <= len(values) <= len(self.converters):
+            return None
+        try:
+            return self.type(*(convert(value) for convert, value in zip(self.converters, values)))
+        except ValueError:
+            return None
+
+
+class Route:
+    def __init__(self, callback_data, state, handler):
+        self.callback_data = callback_data
+        self.state = state
+        self.handler = handler
+        self.arguments = set(inspect.signature(handler).parameters)
+
+    async def call(self, callback, callback_data, state):
+        arguments = {'callback_data': callback_data, 'state': state}
+        return await self.handler(callback, **{name: value for name, value in arguments.items()
+                                               if name in self.arguments})
+
+
+class TrieNode:
+    __slots__ = ('children', 'routes')
+
+    def __init__(self):
+        self.children = {}
+        self.routes = {}
+
+
+class CallbackRouter:
+    """Dispatches callback queries by payload prefix instead of a chain of filters.
+
+    Prefixes are kept in a trie of ``_``-separated parts, so finding the route
+    costs one dict lookup per part of the payload whatever the number of
+    handlers. The longest registered prefix wins, then a route registered for
+    the current FSM state wins over one for any state (``'*'``). As with
+    aiogram filters, ``state=None`` means "no state". Registering the same
+    prefix twice for the same state raises ``CallbackConflict`` at import.
+    The route is resolved once per callback, by the filter of the dispatcher
+    handler, and kept as ``callback.matched_route`` for middlewares.
+    """
+
+    def __init__(self, dispatcher=None):
+        self.root = TrieNode()
+        self.routes = []
+        self.dispatcher = dispatcher
+        if dispatcher is not None:
+            dispatcher.register_callback_query_handler(self.dispatch, self.match, state=ANY_STATE)
+
+    def route(self, *schemes, state=None):
+        """Decorator registering a handler for payloads of ``schemes``.
+
+        The handler gets the callback query and, if it asks for them, the
+        parsed ``callback_data`` and the FSM context ``state``.
+        """
+        states = state if isinstance(state, (list, tuple, set)) else [state]
+        states = [item.state if isinstance(item, State) else item for item in states]
+
+        def register(handler):
+            for callback_data in schemes:
+                for state_name in states:
+                    self.add_route(Route(callback_data, state_name, handler))
+            return handler
+        return register
+
+    def add_route(self, route):
+        node = self.root
+        for part in route.callback_data.parts:
+            node = node.children.setdefault(part, TrieNode())
+        registered = node.routes.get(route.state)
+        if registered is not None:
+            raise CallbackConflict(
+                f'{route.callback_data} in state {route.state!r} is handled by both '
+                f'{registered.handler.__qualname__} and {route.handler.__qualname__}'
+            )
+        node.routes[route.state] = route
+        self.routes.append(route)
+
+    def resolve(self, data, current_state):
+        """Route for the payload in the FSM state with the parsed payload, ``(None, None)`` if there is none."""
+        parts = data.split(SEPARATOR)
+        node = self.root
+        matched = []
+        for depth, part in enumerate(parts, 1):
+            node = node.children.get(part)
+            if node is None:
+                break
+            if node.routes:
+                matched.append((depth, node))
+        for depth, node in reversed(matched):
+            for route in (node.routes.get(current_state), node.routes.get(ANY_STATE)):
+                if route is None:
+                    continue
+                callback_data = route.callback_data.parse(parts[depth:])
+                if callback_data is not None:
+                    return route, callback_data
+        return None, None
+
+    async def match(self, callback):
+        """Filter passing callbacks that have a route, which is kept on the callback."""
+        state = self.dispatcher.current_state()
+        callback.matched_route = self.resolve(callback.data or '', await state.get_state())
+        return callback.matched_route[0] is not None
+
+    async def dispatch(self, callback, state):
+        matched_route = getattr(callback, 'matched_route', None)
+        if matched_route is None:
+            matched_route = self.resolve(callback.data or '', await state.get_state())
+        route, callback_data = matched_route
+        if route is None:
+            raise SkipHandler()
+        return await route.call(callback, callback_data, state)
@@ -0,0 +1,144 @@
+import asyncio
+import time
+from itertools import count
+
+from aiohttp import web
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'PythonMeetupBot', 'username': 'python_meetup_bot'}
+
+MESSAGE_METHODS = {'sendmessage', 'editmessagetext', 'sendinvoice'}
+
+
+class FakeTelegramServer:
+    """Local stand-in for the Telegram Bot API that records every call.
+
+    Point the bot at it with ``TG_API_SERVER=http://host:port`` (or by passing
+    ``TelegramAPIServer.from_base(url)`` to ``Bot``) and inspect ``calls``.
+    Updates added with ``push_update`` are served to a polling bot through
+    ``getUpdates``, ``wait_for_reply`` waits for the next message the bot sends
+    or edits in a chat.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self._message_ids = count(1)
+        self._updates = []
+        self._updates_added = asyncio.Event()
+        self._reply_waiters = {}
+        self._runner = None
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+
+    async def start(self, host='127.0.0.1', port=0, backlog=1024):
+        """Serve in the running event loop, returns the base URL of the server."""
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        # Under load the bot opens hundreds of connections at once
+        site = web.TCPSite(self._runner, host, port, backlog=backlog)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        return f'http://{host}:{port}'
+
+    async def stop(self):
+        # Wake up pending long polls, so the runner does not wait for them
+        self._updates_added.set()
+        await self._runner.cleanup()
+
+    def calls_of(self, method):
+        return [data for called, data in self.calls if called.lower() == method.lower()]
+
+    def push_update(self, update):
+        """Queue an update for ``getUpdates``, update ids have to grow."""
+        self._updates.append(update)
+        self._updates_added.set()
+
+    def wait_for_reply(self, chat_id):
+        """Future of the next message sent or edited in the chat, as ``(method, data, message)``."""
+        waiter = asyncio.get_running_loop().create_future()
+        self._reply_waiters[str(chat_id)] = waiter
+        return waiter
+
+    async def get_updates(self, data):
+        offset = int(data.get('offset') or 0)
+        limit = int(data.get('limit') or 100)
+        timeout = float(data.get('timeout') or 0)
+        # Like Telegram, updates before the offset are confirmed and forgotten
+        self._updates = [update for update in self._updates if update['update_id'] >= offset]
+        if not self._updates and timeout:
+            self._updates_added.clear()
+            try:
+                await asyncio.wait_for(self._updates_added.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    def record(self, method, data, result):
+        self.calls.append((method, data))
+        if method.lower() in MESSAGE_METHODS:
+            waiter = self._reply_waiters.pop(data.get('chat_id'), None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result((method, data, result))
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        data = dict(await request.post())
+        if method.lower() == 'getupdates':
+            return web.json_response({'ok': True, 'result': await self.get_updates(data)})
+        result = self.get_result(method.lower(), data)
+        self.record(method, data, result)
+        return web.json_response({'ok': True, 'result': result})
+
+    def get_result(self, method, data):
+        if method == 'getme':
+            return BOT_USER
+        if method in MESSAGE_METHODS:
+            return {
+                'message_id': int(data.get('message_id') or next(self._message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': int(data.get('chat_id', 0)), 'type': 'private'},
+                'from': BOT_USER,
+                'text': data.get('text', ''),
+            }
+        return True
+
+
+def make_user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+
+def make_message_update(update_id, user_id, text):
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': make_user(user_id),
+        'text': text,
+    }
+    if text.startswith('/'):
+        command = text.split()[0]
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    return {'update_id': update_id, 'message': message}
+
+
+def make_callback_update(update_id, user_id, data, message_id=1):
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': make_user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': '🤖 ГЛАВНОЕ МЕНЮ:',
+            },
+        },
+    }
+
+
+async def post_update(session, url, update):
+    async with session.post(url, json=update) as response:
+        return response.status, await response.text()
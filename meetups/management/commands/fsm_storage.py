@@ -0,0 +1,197 @@
+import asyncio
+import json
+import logging
+import time
+import typing
+from datetime import timedelta
+
+from aiogram.dispatcher.storage import BaseStorage
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from meetups.models import FSMRecord
+
+logger = logging.getLogger('FSMStorage')
+
+
+def to_primitive(value):
+    """Copy of ``value`` that survives a JSON round trip, fails early on model instances."""
+    return json.loads(json.dumps(value))
+
+
+class DatabaseStorage(BaseStorage):
+    """FSM storage kept in the project database.
+
+    States are cached in memory and written in batches every
+    ``flush_interval`` seconds (or at once when ``batch_size`` records are
+    dirty). Records idle for longer than ``ttl`` seconds are expired. Several
+    bot processes can share the table as long as updates of one user are
+    handled by one process, which is what ``runuserbot --webhook`` does.
+    """
+
+    def __init__(self, ttl=None, flush_interval=None, batch_size=100, clock=time.monotonic):
+        self.ttl = ttl or settings.FSM_STATE_TTL
+        self.flush_interval = flush_interval if flush_interval is not None else settings.FSM_FLUSH_INTERVAL
+        self.batch_size = batch_size
+        self.clock = clock
+        self._cache = {}
+        self._dirty = set()
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self._last_cleanup = clock()
+
+    @staticmethod
+    def _empty_record():
+        return {'state': None, 'data': {}, 'bucket': {}}
+
+    def _load_record(self, chat, user):
+        expires_before = timezone.now() - timedelta(seconds=self.ttl)
+        record = FSMRecord.objects.filter(chat=chat, user=user, updated_at__gte=expires_before).first()
+        if record is None:
+            return self._empty_record()
+        return {'state': record.state, 'data': record.data, 'bucket': record.bucket}
+
+    async def _get_record(self, chat, user):
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        key = (chat, user)
+        cached = self._cache.get(key)
+        if cached is not None and self.clock() - cached['touched'] < self.ttl:
+            return key, cached
+        record = await sync_to_async(self._load_record)(chat, user)
+        record['touched'] = self.clock()
+        # A write made while the record was loading wins over the loaded copy
+        current = self._cache.get(key)
+        if current is not None and current is not cached:
+            return key, current
+        self._cache[key] = record
+        return key, record
+
+    async def _mark_dirty(self, key, record):
+        record['touched'] = self.clock()
+        self._dirty.add(key)
+        if len(self._dirty) >= self.batch_size:
+            await self.flush()
+        if self._dirty and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if not self._dirty:
+                return
+
+    def _write(self, records, cleanup):
+        now = timezone.now()
+        empty = [key for key, record in records.items() if not any(record.values())]
+        for chat, user in empty:
+            FSMRecord.objects.filter(chat=chat, user=user).delete()
+        FSMRecord.objects.bulk_create(
+            [
+                FSMRecord(chat=chat, user=user, updated_at=now, **record)
+                for (chat, user), record in records.items()
+                if (chat, user) not in empty
+            ],
+            update_conflicts=True,
+            unique_fields=['chat', 'user'],
+            update_fields=['state', 'data', 'bucket', 'updated_at'],
+        )
+        if cleanup:
+            FSMRecord.objects.filter(updated_at__lt=now - timedelta(seconds=self.ttl)).delete()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            records = {
+                key: {name: self._cache[key][name] for name in ('state', 'data', 'bucket')}
+                for key in dirty
+            }
+            now = self.clock()
+            cleanup = now - self._last_cleanup > self.ttl / 24
+            if cleanup:
+                self._last_cleanup = now
+                for key, record in list(self._cache.items()):
+                    if key not in dirty and now - record['touched'] > self.ttl:
+                        del self._cache[key]
+            try:
+                await sync_to_async(self._write)(records, cleanup)
+            except Exception:
+                logger.exception('failed to save FSM states, will retry')
+                self._dirty |= dirty
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, record = await self._get_record(chat, user)
+        return record['state'] or self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._get_record(chat, user)
+        return to_primitive(record['data']) or default or {}
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        key, record = await self._get_record(chat, user)
+        record['state'] = self.resolve_state(state)
+        await self._mark_dirty(key, record)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, record = await self._get_record(chat, user)
+        record['data'] = to_primitive(data or {})
+        await self._mark_dirty(key, record)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None,
+                          **kwargs):
+        key, record = await self._get_record(chat, user)
+        record['data'] = {**record['data'], **to_primitive({**(data or {}), **kwargs})}
+        await self._mark_dirty(key, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._get_record(chat, user)
+        return to_primitive(record['bucket']) or default or {}
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key, record = await self._get_record(chat, user)
+        record['bucket'] = to_primitive(bucket or {})
+        await self._mark_dirty(key, record)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None,
+                            **kwargs):
+        key, record = await self._get_record(chat, user)
+        record['bucket'] = {**record['bucket'], **to_primitive({**(bucket or {}), **kwargs})}
+        await self._mark_dirty(key, record)
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from meetups.ranking import HotRanking, add_hot_votes, hot_vote, save_hot_votes
+
+logger = logging.getLogger('HotScores')
+
+
+class HotScores:
+    """Time-decayed "hot" scores of the questions of running presentations.
+
+    A vote moves its question in the in-memory ``HotRanking`` of the
+    presentation, which the speaker's questions feed is served from, and is
+    added to the votes waiting to be saved. Every ``flush_interval`` seconds
+    the waiting votes are added to ``Question.hot_score``, where the votes of
+    all bot processes meet. The ranking of a presentation is loaded from the
+    database when it is first needed, reloaded with the votes of other
+    processes once it is older than ``flush_interval`` and dropped with
+    ``forget`` when the presentation is over.
+    """
+
+    def __init__(self, flush_interval=None, half_life=None, clock=timezone.now):
+        self.flush_interval = flush_interval if flush_interval is not None else settings.HOT_FLUSH_INTERVAL
+        self.half_life = half_life or settings.HOT_HALF_LIFE
+        self.clock = clock
+        self._rankings = {}
+        self._loaded_at = {}
+        self._pending = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def ranking(self, presentation_id):
+        return self._rankings.get(presentation_id)
+
+    def _is_fresh(self, presentation_id):
+        loaded_at = self._loaded_at.get(presentation_id)
+        return loaded_at is not None and (self.clock() - loaded_at).total_seconds() < self.flush_interval
+
+    async def get_ranking(self, presentation_id):
+        """Ranking of the presentation with the votes of this process and the saved votes of the others."""
+        if not self._is_fresh(presentation_id):
+            # Waiting votes are either saved or still pending while no flush runs
+            async with self._flush_lock:
+                if not self._is_fresh(presentation_id):
+                    loaded_at = self.clock()
+                    ranking = await sync_to_async(HotRanking.load)(presentation_id)
+                    for question_id, votes in self._pending.items():
+                        ranking.vote(question_id, votes)
+                    self._rankings[presentation_id] = ranking
+                    self._loaded_at[presentation_id] = loaded_at
+        return self._rankings[presentation_id]
+
+    def question_added(self, question):
+        ranking = self._rankings.get(question.presentation_id)
+        if ranking is not None:
+            ranking.set(question.pk, question.hot_score)
+
+    async def question_liked(self, presentation_id, question_id):
+        votes = hot_vote(self.clock(), self.half_life)
+        ranking = await self.get_ranking(presentation_id)
+        ranking.vote(question_id, votes)
+        pending = self._pending.get(question_id)
+        self._pending[question_id] = votes if pending is None else add_hot_votes(pending, votes)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    def question_closed(self, question):
+        ranking = self._rankings.get(question.presentation_id)
+        if ranking is not None:
+            ranking.remove(question.pk)
+
+    def forget(self, presentation_id):
+        self._rankings.pop(presentation_id, None)
+        self._loaded_at.pop(presentation_id, None)
+
+    async def _flush_later(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if not self._pending:
+                return
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            flushing, self._pending = self._pending, {}
+            try:
+                await sync_to_async(save_hot_votes)(flushing)
+            except BaseException as error:
+                for question_id, votes in flushing.items():
+                    pending = self._pending.get(question_id)
+                    self._pending[question_id] = votes if pending is None else add_hot_votes(pending, votes)
+                if not isinstance(error, Exception):
+                    raise
+                logger.exception('failed to save hot scores, will retry')
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+
+
+hot_scores = HotScores()
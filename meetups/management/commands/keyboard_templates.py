@@ -0,0 +1,89 @@
+import functools
+import inspect
+from collections import OrderedDict
+
+
+class FrozenKeyboard(str):
+    """Inline keyboard serialized to JSON once.
+
+    aiogram passes a string ``reply_markup`` to the Bot API as is, so sending
+    a frozen keyboard skips serialization. The buttons stay available through
+    ``markup`` and must not be changed.
+    """
+
+    def __new__(cls, markup):
+        keyboard = super().__new__(cls, markup.as_json())
+        keyboard.markup = markup
+        return keyboard
+
+    @property
+    def inline_keyboard(self):
+        return self.markup.inline_keyboard
+
+
+class KeyboardCache:
+    """Bounded LRU cache of frozen keyboards keyed by the arguments of their builder."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._keyboards = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._keyboards)
+
+    def clear(self):
+        self._keyboards.clear()
+
+    def get(self, key):
+        keyboard = self._keyboards.get(key)
+        if keyboard is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._keyboards.move_to_end(key)
+        return keyboard
+
+    def store(self, key, markup):
+        keyboard = self._keyboards[key] = FrozenKeyboard(markup)
+        while len(self._keyboards) > self.maxsize:
+            self._keyboards.popitem(last=False)
+        return keyboard
+
+
+def keyboard_template(maxsize=256, key=None):
+    """Cache the keyboards of a builder that depends on its arguments only.
+
+    A static keyboard is built once, a parameterized one is kept for the
+    ``maxsize`` most recently used arguments. ``key`` brings the arguments to
+    one form before the lookup, e.g. ids that come as strings from callback
+    data and as integers from models, and the builder gets them in that form.
+    Works with sync and async builders, the cache is available as the
+    ``cache`` attribute.
+    """
+    def decorator(build):
+        cache = KeyboardCache(maxsize)
+
+        if inspect.iscoroutinefunction(build):
+            @functools.wraps(build)
+            async def get_keyboard(*args):
+                if key is not None:
+                    args = key(*args)
+                keyboard = cache.get(args)
+                if keyboard is None:
+                    keyboard = cache.store(args, await build(*args))
+                return keyboard
+        else:
+            @functools.wraps(build)
+            def get_keyboard(*args):
+                if key is not None:
+                    args = key(*args)
+                keyboard = cache.get(args)
+                if keyboard is None:
+                    keyboard = cache.store(args, build(*args))
+                return keyboard
+
+        get_keyboard.cache = cache
+        return get_keyboard
+    return decorator
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+from html import escape
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.utils.exceptions import (
+    BotBlocked,
+    ChatNotFound,
+    MessageCantBeEdited,
+    MessageNotModified,
+    MessageToEditNotFound,
+    RetryAfter,
+    TelegramAPIError,
+    UserDeactivated,
+)
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from meetups.management.commands.broadcasts import GLOBAL_RATE, TokenBucket
+from meetups.management.commands.keyboard_templates import FrozenKeyboard
+from meetups.ranking import QuestionRanking, RankedQuestion
+
+logger = logging.getLogger('Leaderboard')
+
+QUESTION_PREVIEW_LENGTH = 200
+
+leaderboard_keyboard = FrozenKeyboard(InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text='⏹ Остановить обновление', callback_data='questions_live_stop'),
+    ],
+]))
+
+
+class LiveLeaderboard:
+    """Messages with the top open questions of a presentation that update themselves.
+
+    Every viewer has one such message. Question and like writes of the bot
+    move questions in the in-memory ``QuestionRanking`` of the presentation
+    and wake its refresh loop, which renders the text once and puts it into
+    the messages of all viewers with ``editMessageText``, at most once every
+    ``interval`` seconds. Writes of other bot processes show up when the
+    ranking is reloaded from the database, after ``reload_interval`` seconds
+    without local writes. Edits take tokens from ``rate``, the bucket of the
+    bot's ``BroadcastEngine``, so all senders together stay within the
+    global flood limit.
+    """
+
+    def __init__(self, bot, interval=None, size=None, reload_interval=None, rate=None):
+        self.bot = bot
+        self.interval = interval if interval is not None else settings.LEADERBOARD_INTERVAL
+        self.size = size or settings.LEADERBOARD_SIZE
+        self.reload_interval = reload_interval or settings.LEADERBOARD_RELOAD_INTERVAL
+        self.rate = rate or TokenBucket(GLOBAL_RATE)
+        self._viewers = {}
+        self._watching = {}
+        self._titles = {}
+        self._rankings = {}
+        self._changed = {}
+        self._texts = {}
+        self._tasks = set()
+
+    def viewers(self, presentation_id):
+        return dict(self._viewers.get(presentation_id, {}))
+
+    def ranking(self, presentation_id):
+        return self._rankings.get(presentation_id)
+
+    async def watch(self, presentation, chat_id, message_id):
+        """Turn the message into the live list of questions to the presentation."""
+        self.unwatch(chat_id)
+        viewers = self._viewers.setdefault(presentation.pk, {})
+        viewers[chat_id] = message_id
+        self._watching[chat_id] = presentation.pk
+        self._titles[presentation.pk] = presentation.name
+        if presentation.pk not in self._changed:
+            # The first refresh of the loop fills the messages of everybody who is watching by then
+            self._changed[presentation.pk] = asyncio.Event()
+            task = asyncio.create_task(self._refresh_loop(presentation.pk))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif presentation.pk in self._texts:
+            await self._edit(presentation.pk, chat_id, message_id, self._texts[presentation.pk])
+
+    def unwatch(self, chat_id):
+        presentation_id = self._watching.pop(chat_id, None)
+        if presentation_id is None:
+            return
+        viewers = self._viewers.get(presentation_id, {})
+        viewers.pop(chat_id, None)
+        if not viewers:
+            self._forget(presentation_id)
+
+    def stop(self, presentation_id):
+        """Stop updating the messages of all viewers, e.g. when the presentation is over."""
+        for chat_id in list(self._viewers.get(presentation_id, ())):
+            self.unwatch(chat_id)
+
+    def _forget(self, presentation_id):
+        self._viewers.pop(presentation_id, None)
+        self._titles.pop(presentation_id, None)
+        self._rankings.pop(presentation_id, None)
+        self._texts.pop(presentation_id, None)
+        changed = self._changed.pop(presentation_id, None)
+        if changed is not None:
+            # Let the refresh loop see that nobody is watching
+            changed.set()
+
+    async def _load(self, presentation_id):
+        ranking = await sync_to_async(QuestionRanking.load)(presentation_id)
+        if presentation_id in self._viewers:
+            self._rankings[presentation_id] = ranking
+
+    def _changed_ranking(self, presentation_id, change):
+        ranking = self._rankings.get(presentation_id)
+        if ranking is not None and change(ranking):
+            self._changed[presentation_id].set()
+
+    def question_added(self, question):
+        ranked = RankedQuestion(question.pk, question.question_number, question.text, question.likes_count)
+        self._changed_ranking(question.presentation_id, lambda ranking: ranking.update(ranked))
+
+    def question_liked(self, presentation_id, question_id, likes_count):
+        self._changed_ranking(presentation_id, lambda ranking: ranking.set_likes(question_id, likes_count))
+
+    def question_closed(self, question):
+        self._changed_ranking(question.presentation_id, lambda ranking: ranking.remove(question.pk))
+
+    def render(self, presentation_id):
+        text = f'ТОП ВОПРОСОВ К ДОКЛАДУ:\n<b>{escape(self._titles[presentation_id])}</b>\n\n'
+        questions = self._rankings[presentation_id].top(self.size)
+        for question in questions:
+            question_text = question.text
+            if len(question_text) > QUESTION_PREVIEW_LENGTH:
+                question_text = question_text[:QUESTION_PREVIEW_LENGTH] + '…'
+            text += f'<b>Вопрос №{question.question_number}:</b> 👍 {question.likes_count}\n' \
+                    f'{escape(question_text)}\n\n'
+        if not questions:
+            text += 'Открытых вопросов пока нет.\n\n'
+        return text + '<em>Список обновляется сам, когда появляются вопросы и голоса.</em>'
+
+    async def refresh(self, presentation_id):
+        if presentation_id not in self._rankings:
+            return
+        text = self.render(presentation_id)
+        if text == self._texts.get(presentation_id):
+            return
+        self._texts[presentation_id] = text
+        await asyncio.gather(*(
+            self._edit(presentation_id, chat_id, message_id, text)
+            for chat_id, message_id in self.viewers(presentation_id).items()
+        ))
+
+    async def _refresh_loop(self, presentation_id):
+        changed = self._changed[presentation_id]
+        reload = True
+        while self._changed.get(presentation_id) is changed:
+            try:
+                if reload:
+                    await self._load(presentation_id)
+                await self.refresh(presentation_id)
+            except Exception:
+                logger.exception(f'failed to refresh questions of presentation {presentation_id}')
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.wait_for(changed.wait(), self.reload_interval)
+                reload = False
+            except asyncio.TimeoutError:
+                reload = True
+            changed.clear()
+
+    async def _edit(self, presentation_id, chat_id, message_id, text):
+        while True:
+            await self.rate.acquire()
+            try:
+                await self.bot.edit_message_text(text, chat_id, message_id, parse_mode='HTML',
+                                                 reply_markup=leaderboard_keyboard)
+                return
+            except MessageNotModified:
+                return
+            except RetryAfter as error:
+                logger.warning(f'flood control, retry in {error.timeout} s')
+                self.rate.pause(error.timeout)
+            except (MessageToEditNotFound, MessageCantBeEdited, BotBlocked, ChatNotFound, UserDeactivated):
+                if self._viewers.get(presentation_id, {}).get(chat_id) == message_id:
+                    self.unwatch(chat_id)
+                return
+            except TelegramAPIError:
+                logger.exception(f'failed to refresh questions for {chat_id}')
+                return
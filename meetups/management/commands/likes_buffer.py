@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import time
+from collections import Counter, OrderedDict, defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from meetups.models import Client, Likes, Question
+
+logger = logging.getLogger('LikesBuffer')
+
+
+class LikesBuffer:
+    """Write-behind buffer for votes during voting peaks.
+
+    Votes are kept in memory and written with one insert every
+    ``flush_interval`` seconds (or at once when ``batch_size`` votes are
+    waiting) instead of one transaction per vote. The questions a chat voted
+    for are loaded on its first vote and kept for up to ``cache_size`` chats,
+    the saved likes totals of questions are reloaded once older than
+    ``flush_interval``, so repeated votes do not query the database. A flush
+    adds the votes it actually inserted to the counters. A failed write
+    keeps the votes for the next flush, writes are idempotent so a vote is
+    never counted twice. Votes younger than ``flush_interval`` are lost if
+    the process is killed without shutdown. Every bot process has its own
+    buffer, so votes of one user have to reach one process, which is what
+    ``runuserbot --webhook`` does.
+    """
+
+    def __init__(self, flush_interval=None, batch_size=None, cache_size=None, clock=time.monotonic):
+        self.flush_interval = flush_interval if flush_interval is not None else settings.LIKES_FLUSH_INTERVAL
+        self.batch_size = batch_size or settings.LIKES_FLUSH_BATCH_SIZE
+        self.cache_size = cache_size or settings.LIKES_CACHE_SIZE
+        self.clock = clock
+        self._pending = defaultdict(set)
+        self._flushing = {}
+        self._voted = OrderedDict()
+        self._questions = {}
+        self._size = 0
+        self._flushes = 0
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def has_vote(self, chat_id, question_id):
+        """Whether the vote is waiting in the buffer."""
+        chat_id, question_id = str(chat_id), int(question_id)
+        return chat_id in self._pending.get(question_id, ()) or chat_id in self._flushing.get(question_id, ())
+
+    def voted_question_ids(self, chat_id, questions):
+        return {question.pk for question in questions if self.has_vote(chat_id, question.pk)}
+
+    def pending_count(self, question_id):
+        question_id = int(question_id)
+        return len(self._pending.get(question_id, ())) + len(self._flushing.get(question_id, ()))
+
+    @staticmethod
+    def _load_voted(chat_id):
+        """Questions the chat voted for, raises ``Client.DoesNotExist`` for a chat that is not registered."""
+        client_id = Client.objects.filter(chat_id=chat_id).values_list('pk', flat=True).first()
+        if client_id is None:
+            raise Client.DoesNotExist
+        return set(Likes.objects.filter(client=client_id).values_list('question_id', flat=True))
+
+    @staticmethod
+    def _load_question(question_id):
+        """Presentation and saved likes total of the question."""
+        row = Question.objects.filter(pk=question_id).values_list('presentation_id', 'likes_count').first()
+        if row is None:
+            raise Question.DoesNotExist
+        return row
+
+    async def _get_voted(self, chat_id):
+        voted = self._voted.get(chat_id)
+        if voted is None:
+            voted = self._voted[chat_id] = await sync_to_async(self._load_voted)(chat_id)
+            while len(self._voted) > self.cache_size:
+                self._voted.popitem(last=False)
+        self._voted.move_to_end(chat_id)
+        return voted
+
+    async def _get_question(self, question_id):
+        saved = self._questions.get(question_id)
+        if saved is None or self.clock() - saved[2] >= self.flush_interval:
+            while True:
+                # A total read while a flush commits could count its votes twice
+                async with self._flush_lock:
+                    flushes = self._flushes
+                loaded_at = self.clock()
+                presentation_id, likes_count = await sync_to_async(self._load_question)(question_id)
+                if flushes == self._flushes:
+                    break
+            saved = self._questions[question_id] = (presentation_id, likes_count, loaded_at)
+        return saved
+
+    async def vote(self, chat_id, question_id):
+        """Buffer the vote, returns whether the vote is new, the likes total and the presentation.
+
+        Raises ``Client.DoesNotExist`` for a chat that is not registered and
+        ``Question.DoesNotExist`` for a deleted question.
+        """
+        chat_id, question_id = str(chat_id), int(question_id)
+        voted = await self._get_voted(chat_id)
+        presentation_id, likes_count, _ = await self._get_question(question_id)
+        created = question_id not in voted and not self.has_vote(chat_id, question_id)
+        voted.add(question_id)
+        if created:
+            self._pending[question_id].add(chat_id)
+            self._size += 1
+        likes_count += self.pending_count(question_id)
+        if created:
+            if self._size >= self.batch_size:
+                await self.flush()
+            if self._size and (self._flush_task is None or self._flush_task.done()):
+                self._flush_task = asyncio.create_task(self._flush_later())
+        return created, likes_count, presentation_id
+
+    async def _flush_later(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if not self._size:
+                return
+
+    @staticmethod
+    def _write(votes):
+        """Save the votes, returns the saved likes totals of their questions."""
+        chat_ids = set().union(*votes.values())
+        clients = dict(Client.objects.filter(chat_id__in=chat_ids).values_list('chat_id', 'pk'))
+        quote_name = connection.ops.quote_name
+        created_at = connection.ops.adapt_datetimefield_value(timezone.now())
+        with transaction.atomic():
+            # Votes for questions deleted in the meantime are dropped
+            question_ids = list(Question.objects.filter(pk__in=votes).values_list('pk', flat=True))
+            rows = [
+                (question_id, clients[chat_id], created_at)
+                for question_id in question_ids
+                for chat_id in votes[question_id]
+                if chat_id in clients
+            ]
+            inserted = Counter()
+            batch_size = connection.ops.bulk_batch_size(['question_id', 'client_id', 'created_at'], rows)
+            with connection.cursor() as cursor:
+                for start in range(0, len(rows), max(batch_size, 1)):
+                    batch = rows[start:start + batch_size]
+                    # Unlike bulk_create, RETURNING tells which votes were not saved before
+                    cursor.execute(
+                        f'INSERT INTO {quote_name(Likes._meta.db_table)} (question_id, client_id, created_at) '
+                        f'VALUES {", ".join(["(%s, %s, %s)"] * len(batch))} '
+                        f'ON CONFLICT (question_id, client_id) DO NOTHING RETURNING question_id',
+                        [value for row in batch for value in row],
+                    )
+                    inserted.update(question_id for question_id, in cursor.fetchall())
+            for question_id, count in inserted.items():
+                Question.objects.filter(pk=question_id).update(likes_count=F('likes_count') + count)
+            return dict(Question.objects.filter(pk__in=question_ids).values_list('pk', 'likes_count'))
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._size:
+                return
+            self._flushing, self._pending = self._pending, defaultdict(set)
+            self._size = 0
+            self._flushes += 1
+            try:
+                totals = await sync_to_async(self._write)(self._flushing)
+            except BaseException as error:
+                for question_id, chat_ids in self._flushing.items():
+                    self._pending[question_id] |= chat_ids
+                self._size = sum(map(len, self._pending.values()))
+                if not isinstance(error, Exception):
+                    raise
+                logger.exception('failed to save likes, will retry')
+            else:
+                loaded_at = self.clock()
+                self._questions = {
+                    question_id: saved for question_id, saved in self._questions.items()
+                    if loaded_at - saved[2] < self.flush_interval
+                }
+                for question_id, likes_count in totals.items():
+                    if question_id in self._questions:
+                        self._questions[question_id] = (self._questions[question_id][0], likes_count, loaded_at)
+            finally:
+                self._flushing = {}
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+
+
+likes_buffer = LikesBuffer()
@@ -0,0 +1,217 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from itertools import count
+
+from aiogram import Bot, Dispatcher
+from aiogram.bot.api import TelegramAPIServer
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from meetups.management.commands.benchmark import QueryCounter, format_row, latency_stats, temporary_database
+from meetups.management.commands.fake_telegram import FakeTelegramServer, make_callback_update, make_message_update
+from meetups.management.commands.runuserbot import bot, dp
+from meetups.models import Client, Event, Presentation
+
+SPEAKER_CHAT_ID = 100000
+FIRST_ATTENDEE_CHAT_ID = 200000
+
+
+class ScenarioError(Exception):
+    pass
+
+
+class LoadTelegramServer(FakeTelegramServer):
+    """Fake Bot API that counts calls to a chat for the action the chat is waiting on."""
+
+    def __init__(self):
+        super().__init__()
+        self.actions = {}
+        self.action_calls = Counter()
+
+    def record(self, method, data, result):
+        super().record(method, data, result)
+        action = self.actions.get(data.get('chat_id'))
+        if action is not None:
+            self.action_calls[action] += 1
+
+
+class VirtualUser:
+    """Telegram user that sends messages and presses buttons of the last message the bot showed."""
+
+    def __init__(self, load, chat_id):
+        self.load = load
+        self.chat_id = chat_id
+        self.message_id = 1
+        self.buttons = []
+
+    def has_button(self, prefix):
+        return any(data.startswith(prefix) for data in self.buttons)
+
+    async def act(self, action, update):
+        telegram = self.load.telegram
+        telegram.actions[str(self.chat_id)] = action
+        reply = telegram.wait_for_reply(self.chat_id)
+        started_at = time.perf_counter()
+        telegram.push_update(update)
+        try:
+            _, data, message = await asyncio.wait_for(reply, self.load.timeout)
+        except asyncio.TimeoutError:
+            raise ScenarioError(f'{self.chat_id}: no reply to {action}') from None
+        self.load.latencies[action].append(time.perf_counter() - started_at)
+        self.message_id = message['message_id']
+        keyboard = json.loads(data.get('reply_markup') or '{}').get('inline_keyboard', [])
+        self.buttons = [button['callback_data'] for row in keyboard for button in row if 'callback_data' in button]
+        if self.load.think_time:
+            await asyncio.sleep(random.uniform(0, 2 * self.load.think_time))
+
+    async def send(self, action, text):
+        await self.act(action, make_message_update(next(self.load.update_ids), self.chat_id, text))
+
+    async def click(self, action, prefix):
+        choices = [data for data in self.buttons if data.startswith(prefix)]
+        if not choices:
+            raise ScenarioError(f'{self.chat_id}: no {prefix} button for {action}')
+        data = random.choice(choices)
+        await self.act(action, make_callback_update(next(self.load.update_ids), self.chat_id, data, self.message_id))
+
+
+class LoadGenerator:
+    """Attendees and the speaker of the current presentation talking to the polling bot.
+
+    Every attendee registers, asks a question, likes a question of someone
+    else and goes back to the main menu, while the speaker keeps reviewing and
+    closing questions. Updates reach the bot through ``getUpdates`` of a
+    ``FakeTelegramServer``, so a latency covers polling, the handler and its
+    Bot API calls up to the reply.
+    """
+
+    def __init__(self, users, think_time=0, timeout=30):
+        self.users = users
+        self.think_time = think_time
+        self.timeout = timeout
+        self.telegram = LoadTelegramServer()
+        self.update_ids = count(1)
+        self.latencies = defaultdict(list)
+        self.errors = []
+
+    async def attendee(self, user):
+        await user.send('start', '/start')
+        await user.click('register', 'user_register')
+        await user.click('choose_event', 'event_choose')
+        await user.send('enter_name', f'Слушатель {user.chat_id}')
+        await user.click('current_presentation', 'show_current_presentation')
+        await user.click('ask_question', 'question_ask')
+        await user.send('question_text', f'Вопрос слушателя {user.chat_id}')
+        await user.click('current_presentation', 'show_current_presentation')
+        await user.click('questions', 'questions_show')
+        if user.has_button('question_like'):
+            await user.click('like', 'question_like')
+        await user.click('main_menu', 'main_menu')
+
+    async def speaker(self, user, attendees_done):
+        while not attendees_done.is_set():
+            await user.send('speaker_start', '/start')
+            await user.click('speaker_current_presentation', 'show_current_presentation')
+            if user.has_button('questions_show'):
+                await user.click('speaker_questions', 'questions_show')
+                if user.has_button('question_close'):
+                    await user.click('speaker_close_question', 'question_close')
+            await asyncio.sleep(self.think_time or 0.05)
+
+    async def run(self):
+        production_server = bot.server
+        bot.server = TelegramAPIServer.from_base(await self.telegram.start())
+        Bot.set_current(bot)
+        Dispatcher.set_current(dp)
+        polling = asyncio.create_task(dp.start_polling())
+        attendees_done = asyncio.Event()
+        try:
+            speaker = asyncio.create_task(self.speaker(VirtualUser(self, SPEAKER_CHAT_ID), attendees_done))
+            started_at = time.perf_counter()
+            results = await asyncio.gather(
+                *(self.attendee(VirtualUser(self, FIRST_ATTENDEE_CHAT_ID + number)) for number in range(self.users)),
+                return_exceptions=True,
+            )
+            elapsed = time.perf_counter() - started_at
+            attendees_done.set()
+            results += await asyncio.gather(speaker, return_exceptions=True)
+        finally:
+            dp.stop_polling()
+            await self.telegram.stop()
+            await asyncio.wait_for(polling, self.timeout)
+            bot.server = production_server
+            await dp.storage.close()
+            await (await bot.get_session()).close()
+        for result in results:
+            if isinstance(result, ScenarioError):
+                self.errors.append(str(result))
+            elif isinstance(result, BaseException):
+                raise result
+        return elapsed
+
+    def report(self, elapsed, queries):
+        latencies = [latency for action_latencies in self.latencies.values() for latency in action_latencies]
+        rows = [{
+            'name': f'loadtest: {self.users} слушателей',
+            'runs': len(latencies),
+            'queries_per_run': queries / len(latencies),
+            'actions_per_second': len(latencies) / elapsed,
+            'api_calls_per_run': sum(self.telegram.action_calls.values()) / len(latencies),
+            'errors': len(self.errors),
+            **latency_stats(latencies),
+        }]
+        for action, action_latencies in self.latencies.items():
+            rows.append({
+                'name': f'loadtest: {action}',
+                'runs': len(action_latencies),
+                'api_calls_per_run': self.telegram.action_calls[action] / len(action_latencies),
+                **latency_stats(action_latencies),
+            })
+        return rows
+
+
+def create_load_fixture():
+    """Today's event with one presentation going on all day."""
+    today = datetime.now().date()
+    speaker = Client.objects.create(chat_id=str(SPEAKER_CHAT_ID), first_name='Докладчик', last_name='Докладов')
+    event = Event.objects.create(name='Python Meetup', date=today, start_time=datetime.min.time())
+    Presentation.objects.create(
+        name='Доклад',
+        annotation='Аннотация',
+        event=event,
+        start_time=datetime.min.time(),
+        end_time=datetime.max.time(),
+        speaker=speaker,
+    )
+
+
+class Command(BaseCommand):
+    help = 'Прогоняет через бота синтетическую нагрузку от слушателей и докладчика через заглушку Telegram'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help='Количество одновременных слушателей')
+        parser.add_argument('--think-time', type=float, default=0,
+                            help='Средняя пауза слушателя между действиями, секунды')
+        parser.add_argument('--timeout', type=float, default=30, help='Сколько ждать ответа бота, секунды')
+        parser.add_argument('--seed', type=int, help='Зерно случайного выбора кнопок')
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        # Handler logs would take more time than the handlers, query budget overruns are in the metrics
+        logging.disable(logging.WARNING)
+        load = LoadGenerator(options['users'], options['think_time'], options['timeout'])
+        with temporary_database():
+            create_load_fixture()
+            queries = QueryCounter()
+            with connection.execute_wrapper(queries):
+                elapsed = async_to_sync(load.run)()
+        for row in load.report(elapsed, queries.count):
+            self.stdout.write(format_row(row))
+        for error in load.errors[:10]:
+            self.stderr.write(error)
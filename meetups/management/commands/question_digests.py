@@ -0,0 +1,154 @@
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from html import escape
+
+from aiogram.utils.exceptions import (
+    BotBlocked,
+    CantInitiateConversation,
+    ChatNotFound,
+    RetryAfter,
+    TelegramAPIError,
+    UserDeactivated,
+)
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from meetups.management.commands.broadcasts import GLOBAL_RATE, TokenBucket
+from meetups.management.commands.user_keyboards import get_question_digest_keyboard
+from meetups.models import Presentation
+
+logger = logging.getLogger('QuestionDigests')
+
+DIGEST_SIZE = 10
+QUESTION_PREVIEW_LENGTH = 200
+
+
+class QuestionDigests:
+    """Pushes new questions to the speaker of the presentation in digests.
+
+    Handlers put new questions into a queue and do not wait for anything
+    else. The first question of a burst starts an ``interval`` seconds window,
+    the questions that come during the window are sent together, one message
+    per speaker. Before sending, the bot process claims the presentation's
+    ``digest_sent_at`` with a conditional update. If another process sent a
+    digest within ``interval``, the questions wait for the next window. So
+    a speaker gets at most one digest every ``interval`` seconds however many
+    questions are asked and however many processes collect them. Questions to
+    finished presentations and questions the speaker asked themselves are
+    skipped. Messages take tokens from ``rate``, the bucket of the bot's
+    ``BroadcastEngine``.
+    """
+
+    def __init__(self, bot, interval=None, rate=None, clock=timezone.now):
+        self.bot = bot
+        self.interval = interval if interval is not None else settings.QUESTION_DIGEST_INTERVAL
+        self.rate = rate or TokenBucket(GLOBAL_RATE)
+        self.clock = clock
+        self._queue = asyncio.Queue()
+        self._pending = defaultdict(list)
+        self._task = None
+
+    def question_added(self, question):
+        self._queue.put_nowait(question)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def _collect(self):
+        while not self._queue.empty():
+            question = self._queue.get_nowait()
+            self._pending[question.presentation_id].append(question)
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                question = await self._queue.get()
+                self._pending[question.presentation_id].append(question)
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception('failed to send new questions')
+
+    async def tick(self):
+        """Close the window: send the questions collected so far that may be sent now."""
+        self._collect()
+        await self.flush()
+
+    @staticmethod
+    def _claim(presentation_id, interval, now):
+        """Take the turn to send a digest, ``False`` if a bot process sent one within ``interval`` seconds."""
+        return bool(
+            Presentation.objects.filter(pk=presentation_id)
+            .filter(Q(digest_sent_at__isnull=True) | Q(digest_sent_at__lte=now - timedelta(seconds=interval)))
+            .update(digest_sent_at=now)
+        )
+
+    def _claim_digests(self, pending, interval):
+        """Digests this process may send now and the questions that have to wait."""
+        now = self.clock()
+        presentations = Presentation.objects.filter(pk__in=list(pending), is_finished=False).select_related('speaker')
+        digests = []
+        deferred = {}
+        for presentation in presentations:
+            questions = [
+                question for question in pending[presentation.pk] if question.client_id != presentation.speaker_id
+            ]
+            if not questions:
+                continue
+            if self._claim(presentation.pk, interval, now):
+                digests.append((presentation, questions))
+            else:
+                deferred[presentation.pk] = questions
+        return digests, deferred
+
+    async def flush(self, force=False):
+        """Send the collected questions, ``force`` sends them even if another process just sent a digest."""
+        pending, self._pending = self._pending, defaultdict(list)
+        if not pending:
+            return
+        digests, deferred = await sync_to_async(self._claim_digests)(pending, 0 if force else self.interval)
+        for presentation_id, questions in deferred.items():
+            self._pending[presentation_id][:0] = questions
+        await asyncio.gather(*(self._send(presentation, questions) for presentation, questions in digests))
+
+    @staticmethod
+    def render(presentation, questions):
+        text = f'🔔 НОВЫЕ ВОПРОСЫ К ДОКЛАДУ:\n<b>{escape(presentation.name)}</b>\n\n'
+        for question in questions[:DIGEST_SIZE]:
+            question_text = question.text
+            if len(question_text) > QUESTION_PREVIEW_LENGTH:
+                question_text = question_text[:QUESTION_PREVIEW_LENGTH] + '…'
+            text += f'<b>Вопрос №{question.question_number}:</b>\n{escape(question_text)}\n\n'
+        if len(questions) > DIGEST_SIZE:
+            text += f'<em>И еще вопросов: {len(questions) - DIGEST_SIZE}</em>'
+        return text
+
+    async def _send(self, presentation, questions):
+        chat_id = presentation.speaker.chat_id
+        text = self.render(presentation, questions)
+        while True:
+            await self.rate.acquire()
+            try:
+                await self.bot.send_message(chat_id, text, parse_mode='HTML',
+                                            reply_markup=await get_question_digest_keyboard(presentation.pk))
+                return
+            except RetryAfter as error:
+                logger.warning(f'flood control, retry in {error.timeout} s')
+                self.rate.pause(error.timeout)
+            except (BotBlocked, ChatNotFound, UserDeactivated, CantInitiateConversation):
+                return
+            except TelegramAPIError:
+                logger.exception(f'failed to send new questions to {chat_id}')
+                return
+
+    async def close(self):
+        """Send the questions that are still waiting."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._collect()
+        await self.flush(force=True)
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from meetups.models import Likes, Question
+from meetups.ranking import recount_hot_scores
+
+
+def recount_likes(questions=None):
+    if questions is None:
+        questions = Question.objects.all()
+    likes = (
+        Likes.objects
+        .filter(question=OuterRef('pk'))
+        .order_by()
+        .values('question')
+        .annotate(total=Count('pk'))
+        .values('total')
+    )
+    return questions.update(likes_count=Coalesce(Subquery(likes), 0))
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счетчики лайков у вопросов одним запросом и горячие рейтинги вопросов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--presentation', type=int, help='Пересчитать только вопросы этого доклада')
+
+    def handle(self, *args, **options):
+        questions = Question.objects.all()
+        if options['presentation']:
+            questions = questions.filter(presentation=options['presentation'])
+        updated = recount_likes(questions)
+        recount_hot_scores(questions)
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано вопросов: {updated}'))
@@ -1,17 +1,21 @@
 import asyncio
 import logging
+import os
 from datetime import datetime
+from html import escape
 
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import StatesGroup, State
 from django.core.management.base import BaseCommand
 from aiogram import Bot, Dispatcher, executor, types
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from django.db.models import Count
 from aiogram.types.message import ContentTypes
+from aiogram.utils.exceptions import MessageNotModified
 
+from meetups import queries
 from meetups.management.commands.texts import about_bot
+from meetups.schedule import PresentationScheduler, schedule_resolver
 from meetups.models import (
     Client,
     Event,
@@ -21,9 +25,18 @@ from meetups.models import (
     Likes,
     Organizer, Donate
 )
-from asgiref.sync import sync_to_async
 from conf import settings
 from meetups.management.commands import admin_handlers
+from meetups.management.commands.bot_metrics import InstrumentedBot, MetricsMiddleware
+from meetups.management.commands.broadcasts import BroadcastEngine
+from meetups.management.commands.callback_router import CallbackData, CallbackRouter
+from meetups.management.commands.fsm_storage import DatabaseStorage
+from meetups.management.commands.hot_scores import hot_scores
+from meetups.management.commands.keyboard_templates import FrozenKeyboard
+from meetups.management.commands.leaderboard import LiveLeaderboard
+from meetups.management.commands.likes_buffer import likes_buffer
+from meetups.management.commands.question_digests import QuestionDigests
+from meetups.management.commands.webhook import run_webhook
 from meetups.management.commands.user_keyboards import (
     get_user_main_keyboard,
     get_event_schedule_keyboard,
@@ -33,6 +46,7 @@ from meetups.management.commands.user_keyboards import (
     get_cancel_keyboard,
     get_just_main_menu_keyboard, get_presentation_annotation_keyboard, get_show_my_events_keyboard,
     get_question_contacts_keyboard, get_donate_keyboard, get_my_presentations_keyboard,
+    get_questions_feed_keyboard, afetch_questions_page, first_page_cursor, question_feed_order,
 )
 
 logging.basicConfig(
@@ -42,15 +56,38 @@ logging.basicConfig(
 
 logger = logging.getLogger('UserBot')
 
-storage = MemoryStorage()
-bot = Bot(settings.TG_TOKEN_API)
+QUESTION_PREVIEW_LENGTH = 500
+
+storage = DatabaseStorage()
+telegram_server = TelegramAPIServer.from_base(settings.TG_API_SERVER) if settings.TG_API_SERVER else TELEGRAM_PRODUCTION
+bot = InstrumentedBot(settings.TG_TOKEN_API, server=telegram_server)
 dp = Dispatcher(bot=bot, storage=storage)
+metrics_middleware = MetricsMiddleware(
+    settings.METRICS_DIR,
+    settings.METRICS_FLUSH_INTERVAL,
+    query_budget=settings.QUERY_BUDGET,
+    query_budget_ms=settings.QUERY_BUDGET_MS,
+)
+dp.middleware.setup(metrics_middleware)
+router = CallbackRouter(dp)
+broadcast_engine = BroadcastEngine(bot)
+live_leaderboard = LiveLeaderboard(bot, rate=broadcast_engine.global_bucket)
+question_digests = QuestionDigests(bot, rate=broadcast_engine.global_bucket)
+
+
+def stop_finished_presentations(presentation_ids):
+    for presentation_id in presentation_ids:
+        live_leaderboard.stop(presentation_id)
+        hot_scores.forget(presentation_id)
+
+
+presentation_scheduler = PresentationScheduler(schedule_resolver, on_finished=stop_finished_presentations)
 
-user_register_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+user_register_keyboard = FrozenKeyboard(InlineKeyboardMarkup(inline_keyboard=[
     [
         InlineKeyboardButton(text='Зарегистрироваться', callback_data='user_register'),
     ],
-])
+]))
 
 
 class ClientRegisterFSM(StatesGroup):
@@ -70,9 +107,7 @@ class DonateFSM(StatesGroup):
 
 @dp.message_handler(commands=['start'])
 async def start_command(message: types.Message) -> None:
-    client, created = await sync_to_async(Client.objects.get_or_create)(
-        chat_id=message.from_user.id,
-    )
+    client, created = await queries.get_or_create_client(message.from_user.id)
     if created or not client.first_name or not client.last_name:
         await message.answer('🤖 Добро пожаловать в чат-бот\n<b>Python Meetups!</b>\n\n'
                              'Я помогу вам получить 💪 максимум от каждого события.\n'
@@ -95,12 +130,12 @@ async def start_command(message: types.Message) -> None:
                              )
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data == 'user_register', state='*')
+@router.route(CallbackData('user_register'), state='*')
 async def user_register_handler(callback: types.CallbackQuery) -> None:
     await ClientRegisterFSM.choose_event.set()
-    events = await sync_to_async(Event.objects.all)()
+    events = await queries.list_events()
     inline_keyboard = []
-    async for event in events:
+    for event in events:
         when_info = f'{event.date.strftime("%d.%m")} {event.start_time.strftime("%H:%M")}'
         name_info = f'{event.name}'
         event_keyboard=[[
@@ -120,39 +155,38 @@ async def user_register_handler(callback: types.CallbackQuery) -> None:
                                     )
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('event_'),
-                           state=ClientRegisterFSM.choose_event)
-async def event_choose_handler(callback: types.CallbackQuery, state: FSMContext) -> None:
-    event_id = callback.data.split('_')[-1]
-    event = await sync_to_async(Event.objects.get)(id=event_id)
-    if callback.data.startswith('event_about_'):
-        event_register_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text='Регистрация', callback_data=f'event_choose_{event.id}'),
-                InlineKeyboardButton(text='Назад', callback_data='user_register'),
-            ],
-        ])
-        await callback.message.edit_text(event.description,
-                                         parse_mode='HTML',
-                                         reply_markup=event_register_keyboard,
-                                         )
-    if callback.data.startswith('event_choose_'):
-        async with state.proxy() as data:
-            data['event'] = event
-
-        await ClientRegisterFSM.next()
-        await callback.message.answer(f'Вы выбрали мероприятие: <b>{event.name}</b>\n'
-                                      'Для продолжения регистрации введите Ваше имя и '
-                                      'фамилию в формате: <b>Имя Фамилия</b>',
-                                      parse_mode='HTML',
-                                      )
+@router.route(CallbackData('event_about', event_id=int), state=ClientRegisterFSM.choose_event)
+async def register_event_about_handler(callback: types.CallbackQuery, callback_data) -> None:
+    event = await queries.get_event(callback_data.event_id)
+    event_register_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text='Регистрация', callback_data=f'event_choose_{event.id}'),
+            InlineKeyboardButton(text='Назад', callback_data='user_register'),
+        ],
+    ])
+    await callback.message.edit_text(event.description,
+                                     parse_mode='HTML',
+                                     reply_markup=event_register_keyboard,
+                                     )
+
 
+@router.route(CallbackData('event_choose', event_id=int), state=ClientRegisterFSM.choose_event)
+async def event_choose_handler(callback: types.CallbackQuery, callback_data, state: FSMContext) -> None:
+    event = await queries.get_event(callback_data.event_id)
+    async with state.proxy() as data:
+        data['event_id'] = event.id
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data == 'show_schedule', state='*')
+    await ClientRegisterFSM.next()
+    await callback.message.answer(f'Вы выбрали мероприятие: <b>{event.name}</b>\n'
+                                  'Для продолжения регистрации введите Ваше имя и '
+                                  'фамилию в формате: <b>Имя Фамилия</b>',
+                                  parse_mode='HTML',
+                                  )
+
+
+@router.route(CallbackData('show_schedule'), state='*')
 async def show_schedule_handler(callback: types.CallbackQuery) -> None:
-    today = datetime.today()
-    now = datetime.now()
-    current_event = await sync_to_async(Event.objects.filter(date=today, start_time__lte=now.time()).first)()
+    current_event = await schedule_resolver.get_current_event()
     await callback.message.edit_text(f'<b>{current_event.name}</b>\n\n'
                                      f'<em>Нажмите на название доклада, чтобы '
                                      f'📖 прочитать о нем подробнее</em>\n\n'
@@ -172,35 +206,28 @@ async def user_register_personal_info_handler(message: types.Message, state: FSM
         return
     first_name, last_name = message.text.split()
     logger.info(f'first_name: {first_name}, last_name: {last_name}')
-    client, _ = await sync_to_async(Client.objects.get_or_create)(chat_id=message.from_user.id)
-    client.first_name = first_name
-    client.last_name = last_name
-    await sync_to_async(client.save)()
+    client, _ = await queries.get_or_create_client(message.from_user.id)
+    await queries.rename_client(client, first_name, last_name)
     async with state.proxy() as data:
-        event = data['event']
-    await sync_to_async(Visitor.objects.get_or_create)(
-        client=client,
-        event=event,
-    )
+        event_id = data['event_id']
+    await queries.register_visitor(client, event_id)
+    await state.finish()
     await bot.send_message(client.chat_id,
                            f'{client.first_name} {client.last_name}, Вы успешно зарегистрированы!',
                            parse_mode='HTML',
                            reply_markup=await get_user_main_keyboard(client)
                            )
-    await state.finish()
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data == 'show_current_presentation', state='*')
+@router.route(CallbackData('show_current_presentation'), state='*')
 async def show_current_presentation_handler(callback: types.CallbackQuery) -> None:
-    today = datetime.today()
-    now = datetime.now()
-    current_event = await sync_to_async(Event.objects.filter(date=today, start_time__lte=now.time()).first)()
-    if current_event:
-        current_presentation = await sync_to_async(Presentation.objects.filter(
-            event=current_event,
-            start_time__lte=now.time(),
-            is_finished=False,
-        ).select_related('speaker').first)()
+    current_presentation = await schedule_resolver.get_current_presentation()
+    if current_presentation is None:
+        await callback.message.edit_text('Сейчас нет текущего доклада.',
+                                         parse_mode='HTML',
+                                         reply_markup=await get_just_main_menu_keyboard(),
+                                         )
+        return
     speaker_chat_id = current_presentation.speaker.chat_id
     speaker = int(speaker_chat_id) == int(callback.from_user.id)
     logger.info(f'speaker: {speaker}')
@@ -229,110 +256,175 @@ async def show_current_presentation_handler(callback: types.CallbackQuery) -> No
                                   ),
                                   )
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('questions_show'), state='*')
-async def show_current_presentation_questions_handler(callback: types.CallbackQuery) -> None:
-    presentation_id = callback.data.split('_')[-1]
-    questions = await sync_to_async(
-        Question.objects.filter(
-            presentation=presentation_id,
-            is_closed=False,
-        ).all().select_related('presentation').select_related('client').prefetch_related)('likes')
-    presentation = await sync_to_async(
-        Presentation.objects.filter(pk=presentation_id).select_related('speaker').first
-    )()
+PRESENTATION_DELETED = 'Этот доклад удалён'
+
+
+async def show_questions_feed(callback, presentation_id, cursor=None, direction='next', fresh=False):
+    # fresh: re-render after the user's own write, which a page read already in flight would miss
+    presentation = await queries.get_presentation(presentation_id)
+    if presentation is None:
+        await callback.answer(PRESENTATION_DELETED, show_alert=True)
+        return
     speaker_chat_id = presentation.speaker.chat_id
     speaker = int(speaker_chat_id) == int(callback.from_user.id)
-    async for question in questions:
-        likes_count = await sync_to_async(question.likes.count)()
+    order = question_feed_order(cursor)
+    questions, has_prev, has_next = await afetch_questions_page(presentation_id, cursor, direction, fresh=fresh)
+    if not questions and cursor and cursor != first_page_cursor(order):
+        questions, has_prev, has_next = await afetch_questions_page(
+            presentation_id, first_page_cursor(order), fresh=fresh,
+        )
+
+    text = f'ВОПРОСЫ К ДОКЛАДУ:\n<b>{escape(presentation.name)}</b>\n\n'
+    if order == 'hot':
+        text += '<em>🔥 Сначала вопросы, которые быстрее всего набирают голоса</em>\n\n'
+    for question in questions:
         author = int(question.client.chat_id) == int(callback.from_user.id)
-        texts = {
-            'True': f'<b>Вопрос №{question.question_number}:</b> ✏ 👍 {likes_count}\n'
-                    f'--------------------------------------\n'
-                    f'{question.text}\n\n',
-            'False': f'<b>Вопрос №{question.question_number}:</b> 👍 {likes_count}\n'
-                     f'--------------------------------------\n'
-                    f'{question.text}\n\n',
-        }
-        await callback.message.answer(texts[str(author)],
-                                      parse_mode='HTML',
-                                      reply_markup=await get_current_presentation_question_keyboard(
-                                        question,
-                                        callback.from_user.id,
-                                        speaker,
-                                      ),
-                                    )
+        author_mark = '✏ ' if author else ''
+        question_text = question.text
+        if len(question_text) > QUESTION_PREVIEW_LENGTH:
+            question_text = question_text[:QUESTION_PREVIEW_LENGTH] + '…'
+        likes_count = question.likes_count + likes_buffer.pending_count(question.pk)
+        text += f'<b>Вопрос №{question.question_number}:</b> {author_mark}👍 {likes_count}\n' \
+                f'--------------------------------------\n' \
+                f'{escape(question_text)}\n\n'
+    if not questions:
+        text += 'Открытых вопросов пока нет.\n\n'
     texts = {
         'True': f'Не забывайте иногда <b>обновлять список вопросов</b>, чтобы не пропустить новые!',
         'False': f'Вы также можете задать свой вопрос или вернуться в главное меню:'
     }
-    await callback.message.answer(texts[str(speaker)],
-                                  parse_mode='HTML',
-                                  reply_markup=await get_question_main_menu_keyboard(
-                                      presentation_id,
-                                      speaker,
-                                  ),
-                                  )
+    text += texts[str(speaker)]
+    try:
+        await callback.message.edit_text(text,
+                                         parse_mode='HTML',
+                                         reply_markup=await get_questions_feed_keyboard(
+                                             questions,
+                                             presentation_id,
+                                             callback.from_user.id,
+                                             speaker,
+                                             has_prev,
+                                             has_next,
+                                             order,
+                                         ),
+                                         )
+    except MessageNotModified:
+        pass
+
 
+def get_feed_presentation_id(message):
+    """Presentation of a questions feed message, every feed links the live top of its presentation."""
+    for row in message.reply_markup.inline_keyboard if message.reply_markup else ():
+        for button in row:
+            if button.callback_data and button.callback_data.startswith('questions_live_'):
+                return int(button.callback_data.removeprefix('questions_live_'))
+    return None
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('question_ask'), state='*')
-async def ask_question_handler(callback: types.CallbackQuery, state: FSMContext) -> None:
-    presentation_id = callback.data.split('_')[-1]
+
+@router.route(CallbackData('questions_show', presentation_id=int), state='*')
+async def show_current_presentation_questions_handler(callback: types.CallbackQuery, callback_data) -> None:
+    await show_questions_feed(callback, callback_data.presentation_id)
+
+
+@router.route(CallbackData('questions_live', presentation_id=int), state='*')
+async def watch_questions_handler(callback: types.CallbackQuery, callback_data) -> None:
+    presentation = await queries.get_presentation(callback_data.presentation_id)
+    if presentation is None:
+        await callback.answer(PRESENTATION_DELETED, show_alert=True)
+        return
+    await live_leaderboard.watch(presentation, callback.from_user.id, callback.message.message_id)
+
+
+@router.route(CallbackData('questions_live_stop'), state='*')
+async def stop_watching_questions_handler(callback: types.CallbackQuery) -> None:
+    live_leaderboard.unwatch(callback.from_user.id)
+    client = await queries.get_client(callback.from_user.id)
+    await callback.message.edit_text('🤖 ГЛАВНОЕ МЕНЮ:',
+                                     parse_mode='HTML',
+                                     reply_markup=await get_user_main_keyboard(client),
+                                     )
+
+
+def page_direction(value):
+    if value not in ('next', 'prev'):
+        raise ValueError(value)
+    return value
+
+
+@router.route(CallbackData('questions', direction=page_direction, presentation_id=int, cursor=str), state='*')
+async def page_current_presentation_questions_handler(callback: types.CallbackQuery, callback_data) -> None:
+    await show_questions_feed(callback, callback_data.presentation_id, callback_data.cursor, callback_data.direction)
+
+
+@router.route(CallbackData('question_ask', presentation_id=int), state='*')
+async def ask_question_handler(callback: types.CallbackQuery, callback_data, state: FSMContext) -> None:
+    presentation_id = callback_data.presentation_id
     await ClientAskQuestionFSM.enter_question.set()
+    # The question may arrive as soon as the prompt is sent
+    async with state.proxy() as data:
+        data['presentation_id'] = presentation_id
     await callback.message.answer('Введите ваш вопрос:',
                                   parse_mode='HTML',
                                   reply_markup=await get_cancel_keyboard(),
                                   )
-    async with state.proxy() as data:
-        data['presentation_id'] = presentation_id
 
 
 @dp.message_handler(state=ClientAskQuestionFSM.enter_question)
 async def save_question_handler(message: types.Message, state: FSMContext) -> None:
     async with state.proxy() as data:
         presentation_id = data['presentation_id']
-    presentation = await sync_to_async(
-        Presentation.objects.filter(pk=presentation_id).annotate(num_questions=Count('questions')).first
-    )()
-    question_number = presentation.num_questions + 1
-    client = await sync_to_async(Client.objects.get)(chat_id=message.from_user.id)
-    await sync_to_async(Question.objects.create)(
-        client=client,
-        presentation=presentation,
-        text=message.text,
-        question_number=question_number,
-    )
+    client = await queries.get_client(message.from_user.id)
+    question = await queries.create_question(client, presentation_id, message.text)
+    await state.finish()
+    live_leaderboard.question_added(question)
+    hot_scores.question_added(question)
+    question_digests.question_added(question)
 
     await message.answer('Ваш вопрос отправлен докладчику!',
                          parse_mode='HTML',
                          reply_markup=await get_user_main_keyboard(client),
                          )
-    await state.finish()
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('question_like'), state='*')
-async def like_question_handler(callback: types.CallbackQuery) -> None:
-    question_id = callback.data.split('_')[-1]
-    client = await sync_to_async(Client.objects.get)(chat_id=callback.from_user.id)
-    question = await sync_to_async(
-        Question.objects.filter(
-            pk=question_id,
-        ).select_related('presentation').select_related('client').prefetch_related('likes').first)()
-    increased_likes_number = await sync_to_async(question.likes.count)() + 1
-    exists_user_like = await sync_to_async(Likes.objects.filter(
-        client__chat_id=callback.from_user.id,
-        question=question,
-    ).exists)()
-    if exists_user_like:
-        await callback.message.edit_text(f'Вы уже поддержали вопрос №{question_id}!',
+# Кнопки ленты вопросов передают страницу, на которой нажаты, кнопки старых сообщений с одним вопросом - нет
+QUESTION_ACTION_DEFAULTS = {'cursor': None}
+
+
+@router.route(CallbackData('question_like', question_id=int, cursor=str, defaults=QUESTION_ACTION_DEFAULTS),
+              state='*')
+async def like_question_handler(callback: types.CallbackQuery, callback_data) -> None:
+    question_id = callback_data.question_id
+    try:
+        if settings.LIKES_BUFFER:
+            created, likes_count, presentation_id = await likes_buffer.vote(callback.from_user.id, question_id)
+        else:
+            created, likes_count, presentation_id = await queries.like_question(callback.from_user.id, question_id)
+    except Client.DoesNotExist:
+        await callback.answer('Чтобы поддерживать вопросы, отправьте /start и зарегистрируйтесь', show_alert=True)
+        return
+    except Question.DoesNotExist:
+        await callback.answer('Этот вопрос удалён', show_alert=True)
+        presentation_id = get_feed_presentation_id(callback.message)
+        if callback_data.cursor is not None and presentation_id is not None:
+            await show_questions_feed(callback, presentation_id, callback_data.cursor, 'from', fresh=True)
+        return
+    live_leaderboard.question_liked(presentation_id, question_id, likes_count)
+    if created:
+        await hot_scores.question_liked(presentation_id, question_id)
+    if callback_data.cursor is not None:
+        await show_questions_feed(callback, presentation_id, callback_data.cursor, 'from', fresh=True)
+        return
+
+    # Сообщения с отдельным вопросом, отправленные до появления ленты вопросов
+    question = await queries.get_question(question_id)
+    if not created:
+        client = await queries.get_client(callback.from_user.id)
+        await callback.message.edit_text(f'Вы уже поддержали вопрос №{question.question_number}!',
                                       parse_mode='HTML',
                                       reply_markup=await get_user_main_keyboard(client),
                                       )
         return
-    await sync_to_async(Likes.objects.create)(
-        client=client,
-        question=question,
-    )
-    await callback.message.edit_text(f'<b>Вопрос №{question.question_number}:</b> 👍 {increased_likes_number}\n\n'
+    question.likes_count = likes_count
+    await callback.message.edit_text(f'<b>Вопрос №{question.question_number}:</b> 👍 {question.likes_count}\n\n'
                                      f'{question.text}\n\n',
                                      parse_mode='HTML',
                                      reply_markup=await get_current_presentation_question_keyboard(
@@ -345,16 +437,16 @@ async def like_question_handler(callback: types.CallbackQuery) -> None:
 @dp.message_handler(commands=['cancel'], state='*')
 async def cancel_handler(message: types.Message, state: FSMContext) -> None:
     await state.finish()
-    client = await sync_to_async(Client.objects.get)(chat_id=message.from_user.id)
+    client = await queries.get_client(message.from_user.id)
     await message.answer('🤖 ГЛАВНОЕ МЕНЮ:',
                          parse_mode='HTML',
                          reply_markup=await get_user_main_keyboard(client),
                          )
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data in ['main_menu', 'cancel'], state='*')
+@router.route(CallbackData('main_menu'), CallbackData('cancel'), state='*')
 async def get_main_menu_handler(callback: types.CallbackQuery, state: FSMContext) -> None:
-    client = await sync_to_async(Client.objects.get)(chat_id=callback.from_user.id)
+    client = await queries.get_client(callback.from_user.id)
     await state.finish()
     await callback.message.edit_text('🤖 ГЛАВНОЕ МЕНЮ:',
                                      parse_mode='HTML',
@@ -371,7 +463,7 @@ async def cancel_handler(message: types.Message, state: FSMContext) -> None:
                          )
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data == 'about', state='*')
+@router.route(CallbackData('about'), state='*')
 async def get_bot_about_handler(callback: types.CallbackQuery) -> None:
 
     await callback.message.edit_text(about_bot,
@@ -380,12 +472,12 @@ async def get_bot_about_handler(callback: types.CallbackQuery) -> None:
                                      )
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('presentation_annotation'), state='*')
-async def get_presentation_annotation_handler(callback: types.CallbackQuery) -> None:
-    presentation_id = callback.data.split('_')[-1]
-    presentation = await sync_to_async(
-        Presentation.objects.filter(pk=presentation_id).select_related('speaker').first
-    )()
+@router.route(CallbackData('presentation_annotation', presentation_id=int), state='*')
+async def get_presentation_annotation_handler(callback: types.CallbackQuery, callback_data) -> None:
+    presentation = await queries.get_presentation(callback_data.presentation_id)
+    if presentation is None:
+        await callback.answer(PRESENTATION_DELETED, show_alert=True)
+        return
     text = f'<b>{presentation.name.upper()}</b>\n\n'\
            f'{presentation.annotation}\n\n'\
            f'<b>Докладчик</b>\n'\
@@ -399,16 +491,13 @@ async def get_presentation_annotation_handler(callback: types.CallbackQuery) ->
                                      )
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('show_my_events'), state='*')
+@router.route(CallbackData('show_my_events'), state='*')
 async def get_show_my_events_handler(callback: types.CallbackQuery) -> None:
     today = datetime.today()
-    client = await sync_to_async(Client.objects.get)(chat_id=callback.from_user.id)
-    user_events_ids = await sync_to_async(
-        Client.objects.filter(pk=client.pk, events__date__gte=today).distinct().values_list)('events', flat=True)
-    user_events_ids = await sync_to_async(list)(user_events_ids)
-    user_events = await sync_to_async(Event.objects.filter)(pk__in=user_events_ids)
+    client = await queries.get_client(callback.from_user.id)
+    user_events = await queries.list_client_events(client, today)
     inline_keyboard = []
-    async for event in user_events:
+    for event in user_events:
         when_info = f'{event.date.strftime("%d.%m")} {event.start_time.strftime("%H:%M")}'
         name_info = f'{event.name}'
         event_keyboard=[[
@@ -431,26 +520,23 @@ async def get_show_my_events_handler(callback: types.CallbackQuery) -> None:
                                      reply_markup=events_keyboard,
                                     )
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('event_about'), state='*')
-async def get_event_about_handler(callback: types.CallbackQuery) -> None:
-    event_id = callback.data.split('_')[-1]
-    event = await sync_to_async(Event.objects.get)(id=event_id)
+@router.route(CallbackData('event_about', event_id=int), state='*')
+async def get_event_about_handler(callback: types.CallbackQuery, callback_data) -> None:
+    event = await queries.get_event(callback_data.event_id)
     await callback.message.edit_text(event.description,
                                      parse_mode='HTML',
                                      reply_markup=await get_show_my_events_keyboard(),
                                      )
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('question_contacts'), state='*')
-async def get_question_contacts_handler(callback: types.CallbackQuery) -> None:
-    question_id = callback.data.split('_')[-1]
-    question = await sync_to_async(
-        Question.objects.filter(id=question_id).select_related('presentation').select_related('client').first
-    )()
-    likes = await sync_to_async(Likes.objects.filter(question__pk=question_id).select_related)('client')
+@router.route(CallbackData('question_contacts', question_id=int), state='*')
+async def get_question_contacts_handler(callback: types.CallbackQuery, callback_data) -> None:
+    question_id = callback_data.question_id
+    question = await queries.get_question(question_id)
+    likes = await queries.list_question_likes(question_id)
     presentation = question.presentation
     text = f'{question.text}\n\n'
-    async for like in likes:
+    for like in likes:
         text += f'{like.client.first_name} {like.client.last_name}, tg: {like.client.chat_id}\n\n'
     text += f'{question.client.first_name} {question.client.last_name}, tg: {question.client.chat_id}'
     await callback.message.edit_text(text,
@@ -459,24 +545,20 @@ async def get_question_contacts_handler(callback: types.CallbackQuery) -> None:
                                      )
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('presentation_finish'), state='*')
-async def get_presentation_finish_handler(callback: types.CallbackQuery) -> None:
-    presentation_id = callback.data.split('_')[-1]
-    presentation = await sync_to_async(
-        Presentation.objects.filter(pk=presentation_id).first
-    )()
-    presentation.is_finished = True
-    await sync_to_async(presentation.save)()
+@router.route(CallbackData('presentation_finish', presentation_id=int), state='*')
+async def get_presentation_finish_handler(callback: types.CallbackQuery, callback_data) -> None:
+    await queries.finish_presentation(callback_data.presentation_id)
+    live_leaderboard.stop(callback_data.presentation_id)
+    hot_scores.forget(callback_data.presentation_id)
     await callback.message.edit_text('Ваш доклад завершен!',
                                      parse_mode='HTML',
                                      reply_markup=await get_just_main_menu_keyboard(),
                                      )
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('pay_'),
-                           state=DonateFSM.enter_donate_amount)
-async def get_donate_callback_handler(callback: types.CallbackQuery) -> None:
-    donate_sum = int(callback.data.split('_')[-1])
+@router.route(CallbackData('pay', amount=int), state=DonateFSM.enter_donate_amount)
+async def get_donate_callback_handler(callback: types.CallbackQuery, callback_data) -> None:
+    donate_sum = callback_data.amount
     prices = [LabeledPrice(label='Поддержка PythonMeetups', amount=donate_sum * 100)]
     user_id = callback.from_user.id
     await bot.send_invoice(
@@ -519,7 +601,7 @@ async def process_pre_checkout_query(pre_checkout_query: types.PreCheckoutQuery,
     await state.finish()
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('donate'), state='*')
+@router.route(CallbackData('donate'), state='*')
 async def enter_donate_sum_handler(callback: types.CallbackQuery) -> None:
     await DonateFSM.enter_donate_amount.set()
     await callback.message.edit_text('Спасибо, что решили нас поддержать!\n'
@@ -531,16 +613,10 @@ async def enter_donate_sum_handler(callback: types.CallbackQuery) -> None:
 
 @dp.message_handler(content_types=ContentTypes.SUCCESSFUL_PAYMENT)
 async def got_payment(message: types.Message):
-    client = await sync_to_async(Client.objects.get)(chat_id=message.from_user.id)
-    today = datetime.today()
-    now = datetime.now()
-    current_event = await sync_to_async(Event.objects.filter(date=today, start_time__lte=now.time()).first)()
+    client = await queries.get_client(message.from_user.id)
+    current_event = await schedule_resolver.get_current_event()
     total_amount = message.successful_payment.total_amount / 100
-    await sync_to_async(Donate.objects.create)(
-        client=client,
-        sum=total_amount,
-        event=current_event,
-    )
+    await queries.create_donate(client, total_amount, current_event)
     await bot.send_message(chat_id=message.from_user.id,
                            text=f'{total_amount} руб. успешно зачислены!\n\n'
                                 f'Ваша поддержка очень важна для нас!\n'
@@ -550,34 +626,22 @@ async def got_payment(message: types.Message):
                            )
 
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('question_close'), state='*')
-async def get_presentation_finish_handler(callback: types.CallbackQuery) -> None:
-    question_id = callback.data.split('_')[-1]
-    question = await sync_to_async(
-        Question.objects.filter(pk=question_id).first
-    )()
-    question.is_closed = True
-    await sync_to_async(question.save)()
-    await callback.message.edit_text('Вопрос закрыт!',
-                                     parse_mode='HTML',
-                                     )
-
-
-@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith('question_close'), state='*')
-async def get_presentation_finish_handler(callback: types.CallbackQuery) -> None:
-    question_id = callback.data.split('_')[-1]
-    question = await sync_to_async(
-        Question.objects.filter(pk=question_id).first
-    )()
-    question.is_closed = True
-    await sync_to_async(question.save)()
+@router.route(CallbackData('question_close', question_id=int, cursor=str, defaults=QUESTION_ACTION_DEFAULTS),
+              state='*')
+async def close_question_handler(callback: types.CallbackQuery, callback_data) -> None:
+    question = await queries.close_question(callback_data.question_id)
+    live_leaderboard.question_closed(question)
+    hot_scores.question_closed(question)
+    if callback_data.cursor is not None:
+        await show_questions_feed(callback, question.presentation_id, callback_data.cursor, 'from', fresh=True)
+        return
     await callback.message.edit_text('Вопрос закрыт!',
                                      parse_mode='HTML',
                                      )
 
-@dp.callback_query_handler(lambda callback_query: callback_query.data == 'show_my_presentations', state='*')
+@router.route(CallbackData('show_my_presentations'), state='*')
 async def show_my_presentations_handler(callback: types.CallbackQuery) -> None:
-    client = await sync_to_async(Client.objects.get)(chat_id=callback.from_user.id)
+    client = await queries.get_client(callback.from_user.id)
     await callback.message.edit_text('СПИСОК ВАШИХ ДОКЛАДОВ:',
                                      parse_mode='HTML',
                                      reply_markup=await get_my_presentations_keyboard(client),
@@ -606,6 +670,45 @@ async def set_commands(bot: Bot):
     await bot.set_my_commands(commands)
 
 
+async def on_startup(dispatcher: Dispatcher):
+    await broadcast_engine.resume_unfinished()
+
+
+async def on_worker_startup(dispatcher: Dispatcher):
+    # Every bot process stops the live lists and rankings of its own viewers
+    presentation_scheduler.start()
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    await presentation_scheduler.stop()
+    await likes_buffer.close()
+    await hot_scores.close()
+    await question_digests.close()
+    await metrics_middleware.close()
+
+
 class Command(BaseCommand):
-    def handle(self, *args, **kwargs):
-        executor.start_polling(dp, skip_updates=True)
+    def add_arguments(self, parser):
+        parser.add_argument('--webhook', action='store_true', help='Получать обновления через вебхук, а не опросом')
+        parser.add_argument('--webhook-url', help='Публичный адрес вебхука для регистрации в Telegram')
+        parser.add_argument('--host', default='127.0.0.1', help='Адрес, на котором слушает вебхук')
+        parser.add_argument('--port', type=int, default=8080, help='Порт вебхука, воркеры занимают следующие порты')
+        parser.add_argument('--path', default='/webhook', help='Путь вебхука')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Количество процессов бота')
+
+    def handle(self, *args, **options):
+        if options['webhook']:
+            run_webhook(
+                dp,
+                host=options['host'],
+                port=options['port'],
+                path=options['path'],
+                workers=options['workers'],
+                webhook_url=options['webhook_url'],
+                on_startup=on_startup,
+                on_shutdown=on_shutdown,
+                on_worker_startup=on_worker_startup,
+            )
+        else:
+            executor.start_polling(dp, skip_updates=True, on_startup=[on_startup, on_worker_startup],
+                                   on_shutdown=on_shutdown)
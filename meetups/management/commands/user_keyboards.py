@@ -3,9 +3,15 @@ import logging
 from datetime import datetime
 
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
-from asgiref.sync import sync_to_async
 
-from meetups.models import Event, Presentation, Visitor, Client, Question, Likes
+from meetups import queries
+from meetups.management.commands.hot_scores import hot_scores
+from meetups.management.commands.keyboard_templates import keyboard_template
+from meetups.management.commands.likes_buffer import likes_buffer
+from meetups.menu import menu_state_cache
+from meetups.models import Presentation, Question
+from meetups.schedule import schedule_resolver
+from meetups.singleflight import single_flight
 
 logging.basicConfig(
     level=logging.INFO,
@@ -15,6 +21,7 @@ logging.basicConfig(
 logger = logging.getLogger('UserKeyboards')
 
 
+@keyboard_template()
 async def get_cancel_keyboard():
     inline_keyboard = [
         [
@@ -24,6 +31,7 @@ async def get_cancel_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
 
 
+@keyboard_template()
 async def get_just_main_menu_keyboard():
     inline_keyboard = [
         [
@@ -37,17 +45,10 @@ async def get_user_main_keyboard(client):
     inline_keyboard=[]
 
     today = datetime.today()
-    now = datetime.now()
 
-    current_event = await sync_to_async(Event.objects.filter(date=today, start_time__lte=now.time()).first)()
+    current_event = await schedule_resolver.get_current_event()
     logger.info(f'current_event: {current_event}')
-    exists_current_presentation = False
-    if current_event:
-        exists_current_presentation = await sync_to_async(Presentation.objects.filter(
-            event=current_event,
-            start_time__lte=now.time(),
-            is_finished=False,
-        ).exists)()
+    exists_current_presentation = await schedule_resolver.get_current_presentation() is not None
     logger.info(f'current_presentation: {exists_current_presentation}')
     first_row = []
     if current_event:
@@ -61,16 +62,15 @@ async def get_user_main_keyboard(client):
     if first_row:
         inline_keyboard.append(first_row)
 
-    exist_user_presentations = await sync_to_async(Presentation.objects.filter(speaker=client).exists)()
+    menu_state = await menu_state_cache.aget_state(client.pk, today.date())
+    exist_user_presentations = menu_state.has_presentations
     logger.info(f'user_presentations: {exist_user_presentations}')
     if exist_user_presentations:
         inline_keyboard.append([
             InlineKeyboardButton(text='Мои доклады', callback_data='show_my_presentations'),
         ])
-    user_events_ids = await sync_to_async(
-        Client.objects.filter(pk=client.pk,events__date__gte=today).distinct().values_list)('events', flat=True)
-    user_events_ids = await sync_to_async(list)(user_events_ids)
-    exist_other_events = await sync_to_async(Event.objects.exclude(pk__in=user_events_ids).exists)()
+    user_events_ids = menu_state.upcoming_event_ids
+    exist_other_events = await menu_state_cache.aget_events_count() > len(user_events_ids)
     events_row = []
     if user_events_ids:
         events_row.append(
@@ -91,9 +91,9 @@ async def get_user_main_keyboard(client):
 
 
 async def get_event_schedule_keyboard(event):
-    presentations = await sync_to_async(Presentation.objects.filter(event=event).select_related)('speaker')
+    presentations = await queries.list_event_presentations(event.pk)
     inline_keyboard = []
-    async for presentation in presentations:
+    for presentation in presentations:
         when_info = f'{presentation.start_time.strftime("%H:%M")} - {presentation.end_time.strftime("%H:%M")}'
         speaker_info = f'{presentation.speaker.first_name} {presentation.speaker.last_name}'
         name_info = f'{presentation.name}'
@@ -114,11 +114,9 @@ async def get_event_schedule_keyboard(event):
 
 
 async def get_my_presentations_keyboard(client):
-    presentations = await sync_to_async(
-        Presentation.objects.filter(speaker__chat_id=client.chat_id).select_related('event').select_related
-    )('speaker')
+    presentations = await queries.list_speaker_presentations(client.chat_id)
     inline_keyboard = []
-    async for presentation in presentations:
+    for presentation in presentations:
         time_info = f'{presentation.start_time.strftime("%H:%M")} - {presentation.end_time.strftime("%H:%M")}'
         date_info = f'{presentation.event.date.strftime("%d.%m.%Y")}'
         name_info = f'{presentation.name}'
@@ -139,7 +137,7 @@ async def get_my_presentations_keyboard(client):
 
 
 async def get_current_presentation_keyboard(presentation, speaker):
-    questions_count = await sync_to_async(presentation.questions.filter(presentation=presentation).count)()
+    questions_count = await queries.count_questions(presentation.pk)
     inline_keyboard = []
     if questions_count:
         ask_keyboard = [
@@ -178,10 +176,7 @@ async def get_current_presentation_keyboard(presentation, speaker):
 async def get_current_presentation_question_keyboard(question, chat_id, speaker):
     question = question
     logger.info(f'question: {question}')
-    exists_user_like = await sync_to_async(Likes.objects.filter(
-        client__chat_id=chat_id,
-        question=question,
-    ).exists)()
+    exists_user_like = likes_buffer.has_vote(chat_id, question.pk) or await queries.has_liked(chat_id, question)
     inline_keyboard = []
     author = int(question.client.chat_id) == int(chat_id)
     if speaker:
@@ -206,12 +201,16 @@ async def get_current_presentation_question_keyboard(question, chat_id, speaker)
     return InlineKeyboardMarkup(inline_keyboard=inline_keyboard, row_width=2)
 
 
+@keyboard_template(maxsize=1024, key=lambda presentation_id, speaker: (int(presentation_id), bool(speaker)))
 async def get_question_main_menu_keyboard(presentation_id, speaker):
     if speaker:
         inline_keyboard = [
             [
                 InlineKeyboardButton(text='Обновить список вопросов', callback_data=f'questions_show_{presentation_id}'),
             ],
+            [
+                InlineKeyboardButton(text='📊 Топ вопросов онлайн', callback_data=f'questions_live_{presentation_id}'),
+            ],
             [
                 InlineKeyboardButton(text='Завершить доклад', callback_data=f'presentation_finish_{presentation_id}'),
             ],
@@ -224,6 +223,9 @@ async def get_question_main_menu_keyboard(presentation_id, speaker):
             [
                 InlineKeyboardButton(text='Задать свой вопрос', callback_data=f'question_ask_{presentation_id}'),
             ],
+            [
+                InlineKeyboardButton(text='📊 Топ вопросов онлайн', callback_data=f'questions_live_{presentation_id}'),
+            ],
             [
                 InlineKeyboardButton(text='Главное меню', callback_data=f'main_menu'),
             ],
@@ -231,6 +233,176 @@ async def get_question_main_menu_keyboard(presentation_id, speaker):
     return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
 
 
+
+QUESTIONS_PAGE_SIZE = 5
+
+
+# Порядок ленты вопросов и поле, по которому он строится. Курсор ленты по лайкам - "лайки.id",
+# курсор ленты горячих вопросов - "h" и id вопроса, с которого начинается страница ("h" - первая страница)
+QUESTION_ORDERS = {
+    'likes': 'likes_count',
+    'hot': 'hot_score',
+}
+
+
+def encode_question_cursor(question, order='likes'):
+    if order == 'hot':
+        return f'h{question.pk}'
+    return f'{question.likes_count}.{question.pk}'
+
+
+def first_page_cursor(order='likes'):
+    return 'h' if order == 'hot' else ''
+
+
+def question_feed_order(cursor):
+    return 'hot' if cursor and cursor.startswith('h') else 'likes'
+
+
+def decode_question_cursor(cursor):
+    """Order of the feed and the position in it, ``None`` for the first page."""
+    order = question_feed_order(cursor)
+    if not cursor or cursor == first_page_cursor(order):
+        return order, None
+    if order == 'hot':
+        pk = int(cursor[1:])
+        # The hot score keeps changing, the position is the current score of the question
+        return 'hot', (Question.objects.filter(pk=pk).values('hot_score')[:1], pk)
+    likes_count, pk = cursor.split('.')
+    return 'likes', (int(likes_count), int(pk))
+
+
+def get_questions_page_query(presentation_id, cursor, direction, limit):
+    questions = Question.objects.filter(presentation=presentation_id).open().select_related('client')
+    order, key = decode_question_cursor(cursor)
+    by = QUESTION_ORDERS[order]
+    if key and direction == 'prev':
+        return questions.before(key, by)[:limit + 1], key
+    if key:
+        questions = questions.after(key, inclusive=direction == 'from', by=by)
+    return questions.ranked(by)[:limit + 1], key
+
+
+def get_questions_page(rows, key, direction, limit):
+    if key and direction == 'prev':
+        return rows[:limit][::-1], len(rows) > limit, True
+    return rows[:limit], bool(key), len(rows) > limit
+
+
+def fetch_questions_page(presentation_id, cursor=None, direction='next', limit=QUESTIONS_PAGE_SIZE):
+    """Keyset page of open questions ordered by likes or by hot score, then by recency, all descending.
+
+    The order is the one the ``cursor`` belongs to. ``direction`` is ``next`` (strictly after ``cursor``), ``prev`` (strictly
+    before it) or ``from`` (starting at it). Returns the page together with
+    flags telling whether there are pages before and after it.
+    """
+    query, key = get_questions_page_query(presentation_id, cursor, direction, limit)
+    return get_questions_page(list(query), key, direction, limit)
+
+
+def get_hot_page_ids(ranking, cursor, direction, limit):
+    """Ids of the rows of a hot feed page in the order of ``get_questions_page_query``.
+
+    ``None`` if the ranking does not have the question of the cursor.
+    """
+    if cursor == first_page_cursor('hot'):
+        return ranking.top(limit + 1)
+    position = ranking.position(int(cursor[1:]))
+    if position is None:
+        return None
+    if direction == 'prev':
+        return ranking.slice(position - limit - 1, position)[::-1]
+    start = position if direction == 'from' else position + 1
+    return ranking.slice(start, start + limit + 1)
+
+
+async def afetch_hot_questions_page(presentation_id, cursor, direction, limit):
+    """Page of the hot feed from the ranking of ``hot_scores``, ``None`` if it is of no help."""
+    ids = get_hot_page_ids(await hot_scores.get_ranking(presentation_id), cursor, direction, limit)
+    if ids is None:
+        return None
+    # Questions closed by other bot processes are still in the ranking
+    questions = await Question.objects.open().select_related('client').ain_bulk(ids)
+    rows = [questions[pk] for pk in ids if pk in questions]
+    return get_questions_page(rows, cursor != first_page_cursor('hot'), direction, limit)
+
+
+@single_flight.coalesce('questions_page')
+async def afetch_questions_page(presentation_id, cursor=None, direction='next', limit=QUESTIONS_PAGE_SIZE):
+    if question_feed_order(cursor) == 'hot':
+        # The ranking has the votes of this process at once, the database gets them on the next flush
+        page = await afetch_hot_questions_page(presentation_id, cursor, direction, limit)
+        if page is not None:
+            return page
+    query, key = get_questions_page_query(presentation_id, cursor, direction, limit)
+    return get_questions_page([question async for question in query], key, direction, limit)
+
+
+async def get_questions_feed_keyboard(questions, presentation_id, chat_id, speaker, has_prev, has_next,
+                                      order='likes'):
+    liked_ids = set()
+    if not speaker and questions:
+        liked_ids = await queries.liked_question_ids(chat_id, questions)
+        liked_ids |= likes_buffer.voted_question_ids(chat_id, questions)
+    # Действия с вопросом перерисовывают ту же страницу, первая страница всегда начинается сначала
+    page_cursor = encode_question_cursor(questions[0], order) if questions and has_prev else first_page_cursor(order)
+    inline_keyboard = []
+    for question in questions:
+        if speaker:
+            inline_keyboard.append([
+                InlineKeyboardButton(
+                    text=f'✅ Закрыть №{question.question_number}',
+                    callback_data=f'question_close_{question.pk}_{page_cursor}',
+                ),
+                InlineKeyboardButton(
+                    text=f'🎫 Контакты №{question.question_number}',
+                    callback_data=f'question_contacts_{question.pk}',
+                ),
+            ])
+        elif int(question.client.chat_id) != int(chat_id) and question.pk not in liked_ids:
+            inline_keyboard.append([
+                InlineKeyboardButton(
+                    text=f'👍 Поддержать вопрос №{question.question_number}',
+                    callback_data=f'question_like_{question.pk}_{page_cursor}',
+                ),
+            ])
+    navigation_row = []
+    if has_prev:
+        navigation_row.append(InlineKeyboardButton(
+            text='⬅️ Назад',
+            callback_data=f'questions_prev_{presentation_id}_{encode_question_cursor(questions[0], order)}',
+        ))
+    if has_next:
+        navigation_row.append(InlineKeyboardButton(
+            text='Вперед ➡️',
+            callback_data=f'questions_next_{presentation_id}_{encode_question_cursor(questions[-1], order)}',
+        ))
+    if navigation_row:
+        inline_keyboard.append(navigation_row)
+    if speaker and order == 'hot':
+        inline_keyboard.append([
+            InlineKeyboardButton(text='🔄 Обновить', callback_data=f'questions_next_{presentation_id}_h'),
+            InlineKeyboardButton(text='👍 Сначала популярные', callback_data=f'questions_show_{presentation_id}'),
+        ])
+    elif speaker:
+        inline_keyboard.append([
+            InlineKeyboardButton(text='🔥 Сначала горячие', callback_data=f'questions_next_{presentation_id}_h'),
+        ])
+    menu_keyboard = await get_question_main_menu_keyboard(presentation_id, speaker)
+    inline_keyboard += menu_keyboard.inline_keyboard
+    return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
+
+@keyboard_template(key=lambda presentation_id: (int(presentation_id),))
+async def get_question_digest_keyboard(presentation_id):
+    inline_keyboard = [
+        [
+            InlineKeyboardButton(text='Открыть вопросы', callback_data=f'questions_show_{presentation_id}'),
+        ],
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
+
+
+@keyboard_template()
 async def get_presentation_annotation_keyboard():
     inline_keyboard = [
         [
@@ -243,6 +415,7 @@ async def get_presentation_annotation_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
 
 
+@keyboard_template()
 async def get_show_my_events_keyboard():
     inline_keyboard = [
         [
@@ -267,6 +440,7 @@ async def get_question_contacts_keyboard(presentation):
     return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
 
 
+@keyboard_template()
 async def get_donate_keyboard():
     inline_keyboard = [
         [
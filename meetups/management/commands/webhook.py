@@ -0,0 +1,149 @@
+import json
+import logging
+import multiprocessing
+
+import aiohttp
+from aiogram import executor
+from aiohttp import web
+from django.db import connections
+
+logger = logging.getLogger('Webhook')
+
+WORKER_PATH = '/updates'
+
+UPDATE_TYPES = (
+    'message',
+    'edited_message',
+    'callback_query',
+    'pre_checkout_query',
+    'shipping_query',
+    'inline_query',
+    'chosen_inline_result',
+    'my_chat_member',
+    'chat_member',
+    'chat_join_request',
+    'poll_answer',
+)
+
+
+def get_routing_key(update):
+    """Telegram user the update belongs to, falls back to the update id."""
+    for update_type in UPDATE_TYPES:
+        payload = update.get(update_type)
+        if not payload:
+            continue
+        user = payload.get('from') or payload.get('user')
+        if user:
+            return user['id']
+        chat = payload.get('chat')
+        if chat:
+            return chat['id']
+    return update.get('update_id', 0)
+
+
+def create_front_app(path, worker_urls):
+    """Webhook endpoint that forwards each update to one of the workers.
+
+    Updates of one user always go to the same worker, so that worker keeps
+    handling the user's updates in order and sees the user's FSM state.
+    """
+    app = web.Application()
+
+    async def open_session(app):
+        app['session'] = aiohttp.ClientSession()
+
+    async def close_session(app):
+        await app['session'].close()
+
+    async def forward_update(request):
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400, text='bad update')
+        worker_url = worker_urls[get_routing_key(update) % len(worker_urls)]
+        async with app['session'].post(
+            worker_url,
+            data=body,
+            headers={'Content-Type': 'application/json'},
+        ) as response:
+            return web.Response(
+                status=response.status,
+                body=await response.read(),
+                content_type=response.content_type,
+            )
+
+    app.on_startup.append(open_session)
+    app.on_cleanup.append(close_session)
+    app.router.add_post(path, forward_update)
+    return app
+
+
+def run_worker(dispatcher, port, on_startup=None, on_shutdown=None):
+    executor.start_webhook(
+        dispatcher=dispatcher,
+        webhook_path=WORKER_PATH,
+        on_startup=on_startup,
+        on_shutdown=on_shutdown,
+        skip_updates=False,
+        host='127.0.0.1',
+        port=port,
+        print=None,
+    )
+
+
+def run_webhook(dispatcher, host, port, path, workers, webhook_url=None, on_startup=None, on_shutdown=None,
+                on_worker_startup=None):
+    """Serve updates over a webhook with ``workers`` bot processes behind it.
+
+    Every worker is a forked copy of the bot listening on ``port + N`` on the
+    loopback interface; the front process only routes updates. Background jobs
+    that must run once (``on_startup``) are started in the first worker,
+    jobs that keep the state of a worker up to date (``on_worker_startup``)
+    and ``on_shutdown`` run in every worker.
+
+    Workers do not share memory. Model signals reset the caches of the worker
+    that saved the model only, the schedule and menu caches of the others
+    notice the change through the shared ``CacheVersion`` rows within
+    ``CACHE_CHECK_INTERVAL`` seconds. Live leaderboards reread the votes of
+    other workers every ``LEADERBOARD_RELOAD_INTERVAL`` seconds, and
+    ``single_flight`` keeps nothing after a read completes. The global flood
+    limit of ``BroadcastEngine`` lives in shared memory and holds for all
+    workers together.
+    """
+    worker_ports = [port + number + 1 for number in range(workers)]
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+    processes = [
+        context.Process(
+            target=run_worker,
+            args=(
+                dispatcher,
+                worker_port,
+                [callback for callback in (on_startup if number == 0 else None, on_worker_startup) if callback],
+                on_shutdown,
+            ),
+            daemon=True,
+        )
+        for number, worker_port in enumerate(worker_ports)
+    ]
+    for process in processes:
+        process.start()
+    logger.info(f'started {workers} webhook workers on ports {worker_ports}')
+
+    app = create_front_app(path, [f'http://127.0.0.1:{worker_port}{WORKER_PATH}' for worker_port in worker_ports])
+
+    async def register_webhook(app):
+        if webhook_url:
+            await dispatcher.bot.set_webhook(webhook_url)
+            await (await dispatcher.bot.get_session()).close()
+
+    async def stop_workers(app):
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+    app.on_startup.append(register_webhook)
+    app.on_cleanup.append(stop_workers)
+    web.run_app(app, host=host, port=port)
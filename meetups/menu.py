@@ -0,0 +1,133 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date
+from threading import Lock
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from meetups.cache_version import SharedVersion
+from meetups.models import Client, Event, Presentation
+from meetups.singleflight import single_flight
+
+
+@dataclass(frozen=True)
+class MenuState:
+    """Client-specific part of the main menu, valid for one day."""
+    day: date
+    has_presentations: bool
+    upcoming_event_ids: frozenset
+
+
+class MenuStateCache:
+    """Bounded LRU cache of per-client menu state.
+
+    Entries are dropped by model signals for the affected clients only; the
+    total number of events, needed for the "Другие мероприятия" button, is
+    shared by all clients and cached separately. Edits of events, admin
+    edits of presentations and registrations and new speakers assigned by
+    organizers bump the shared ``version``, and the whole cache is dropped
+    in every process when it is seen to move.
+    """
+
+    def __init__(self, maxsize=None, version=None):
+        self.maxsize = maxsize or getattr(settings, 'MENU_CACHE_SIZE', 10000)
+        self.version = version or SharedVersion('menu')
+        self._states = OrderedDict()
+        self._events_count = None
+        self._version = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._states)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._states.clear()
+            self._events_count = None
+
+    def invalidate_clients(self, client_ids):
+        with self._lock:
+            self._version += 1
+            for client_id in client_ids:
+                self._states.pop(client_id, None)
+
+    def invalidate_events(self):
+        with self._lock:
+            self._version += 1
+            self._events_count = None
+
+    def check_version(self):
+        """Drop the cache if another process edited the menus, at most one query per check interval."""
+        if self.version.seen is None:
+            self.version.read()
+        elif self.version.changed():
+            self.clear()
+
+    async def _acheck_version(self):
+        if self.version.seen is None or self.version.is_due():
+            await single_flight.do(('menu_version', id(self)), sync_to_async(self.check_version))
+
+    def _cached_state(self, client_id, today):
+        with self._lock:
+            state = self._states.get(client_id)
+            if state is None or state.day != today:
+                return None
+            self._states.move_to_end(client_id)
+            return state
+
+    def _store_state(self, client_id, state, version):
+        with self._lock:
+            # Skip results loaded before a concurrent invalidation
+            if version != self._version:
+                return
+            self._states[client_id] = state
+            self._states.move_to_end(client_id)
+            while len(self._states) > self.maxsize:
+                self._states.popitem(last=False)
+
+    def _load_state(self, client_id, today):
+        has_presentations = Presentation.objects.filter(speaker=client_id).exists()
+        upcoming_event_ids = frozenset(
+            Client.objects.filter(pk=client_id, events__date__gte=today)
+            .values_list('events', flat=True)
+        )
+        return MenuState(today, has_presentations, upcoming_event_ids)
+
+    def get_state(self, client_id, today):
+        self.check_version()
+        state = self._cached_state(client_id, today)
+        if state is None:
+            version = self._version
+            state = self._load_state(client_id, today)
+            self._store_state(client_id, state, version)
+        return state
+
+    def get_events_count(self):
+        self.check_version()
+        events_count = self._events_count
+        if events_count is None:
+            version = self._version
+            events_count = Event.objects.count()
+            with self._lock:
+                if version == self._version:
+                    self._events_count = events_count
+        return events_count
+
+    async def aget_state(self, client_id, today):
+        await self._acheck_version()
+        state = self._cached_state(client_id, today)
+        if state is None:
+            state = await sync_to_async(self.get_state)(client_id, today)
+        return state
+
+    async def aget_events_count(self):
+        await self._acheck_version()
+        events_count = self._events_count
+        if events_count is None:
+            events_count = await sync_to_async(self.get_events_count)()
+        return events_count
+
+
+menu_state_cache = MenuStateCache()
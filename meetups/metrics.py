@@ -0,0 +1,134 @@
+import json
+import math
+import os
+import tempfile
+import time
+from pathlib import Path
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# name: (type, help)
+METRICS = {
+    'bot_handler_duration_seconds': ('histogram', 'Время обработки обновления обработчиком бота'),
+    'bot_handler_errors_total': ('counter', 'Количество обновлений, обработка которых завершилась ошибкой'),
+    'bot_handler_in_flight': ('gauge', 'Количество обновлений, которые обрабатываются прямо сейчас'),
+    'bot_handler_queries_total': ('counter', 'Количество SQL-запросов при обработке обновлений'),
+    'bot_handler_over_query_budget_total': ('counter', 'Количество обновлений, превысивших бюджет SQL-запросов'),
+    'telegram_api_duration_seconds': ('histogram', 'Время запроса к Telegram Bot API'),
+    'telegram_api_errors_total': ('counter', 'Количество запросов к Telegram Bot API, завершившихся ошибкой'),
+}
+
+
+class Metrics:
+    """Latency histograms, counters and gauges of one bot process.
+
+    Samples are keyed by metric name and a tuple of label pairs. The bot
+    saves a snapshot to its own file in ``METRICS_DIR`` and the ``/metrics``
+    view sums the snapshots of all bot processes.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.samples = {}
+
+    def _histogram(self, metric, labels):
+        empty = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+        return self.samples.setdefault(metric, {}).setdefault(tuple(sorted(labels.items())), empty)
+
+    def observe(self, metric, seconds, **labels):
+        histogram = self._histogram(metric, labels)
+        for number, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                histogram['buckets'][number] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+    def inc(self, metric, amount=1, **labels):
+        samples = self.samples.setdefault(metric, {})
+        key = tuple(sorted(labels.items()))
+        samples[key] = samples.get(key, 0) + amount
+
+    def dec(self, metric, amount=1, **labels):
+        self.inc(metric, -amount, **labels)
+
+    def merge(self, snapshot):
+        """Add samples of a snapshot taken with the same buckets."""
+        for metric, samples in snapshot['samples'].items():
+            for labels, value in samples:
+                if not isinstance(value, dict):
+                    self.inc(metric, value, **labels)
+                    continue
+                histogram = self._histogram(metric, labels)
+                histogram['buckets'] = [total + count for total, count in zip(histogram['buckets'], value['buckets'])]
+                histogram['sum'] += value['sum']
+                histogram['count'] += value['count']
+
+    def snapshot(self):
+        return {
+            'buckets': list(self.buckets),
+            'samples': {
+                metric: [[dict(labels), value] for labels, value in samples.items()]
+                for metric, samples in self.samples.items()
+            },
+        }
+
+    def write(self, path):
+        """Replace ``path`` with the current snapshot, readers never see a partial file."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=path.parent, suffix='.tmp', delete=False) as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+        os.replace(snapshot_file.name, path)
+
+
+def load_snapshots(directory, max_age):
+    """Snapshots saved in ``directory`` during the last ``max_age`` seconds."""
+    snapshots = []
+    now = time.time()
+    for path in Path(directory).glob('*.json'):
+        try:
+            if now - path.stat().st_mtime > max_age:
+                continue
+            snapshots.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            # The process removed its file or is not done with it yet
+            continue
+    return snapshots
+
+
+def merge_snapshots(snapshots):
+    merged = Metrics()
+    for snapshot in snapshots:
+        if snapshot['buckets'] == list(merged.buckets):
+            merged.merge(snapshot)
+    return merged
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def format_bound(bound):
+    return '+Inf' if math.isinf(bound) else repr(float(bound))
+
+
+def render_prometheus(metrics):
+    """Metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric, (metric_type, help_text) in METRICS.items():
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} {metric_type}']
+        for labels, value in sorted(metrics.samples.get(metric, {}).items()):
+            if metric_type != 'histogram':
+                lines.append(f'{metric}{format_labels(labels)} {value}')
+                continue
+            for bound, count in zip((*metrics.buckets, math.inf), (*value['buckets'], value['count'])):
+                lines.append(f'{metric}_bucket{format_labels(labels + (("le", format_bound(bound)),))} {count}')
+            lines.append(f'{metric}_sum{format_labels(labels)} {value["sum"]}')
+            lines.append(f'{metric}_count{format_labels(labels)} {value["count"]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,47 @@
+# Generated by Django 4.2.2 on 2026-10-18 20:15
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def remove_duplicate_likes(apps, schema_editor):
+    Likes = apps.get_model('meetups', 'Likes')
+    keep_ids = (
+        Likes.objects
+        .values('question', 'client')
+        .annotate(keep_id=Min('id'))
+        .values_list('keep_id', flat=True)
+    )
+    Likes.objects.exclude(pk__in=list(keep_ids)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meetups', '0011_question_is_closed'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='client',
+            name='chat_id',
+            field=models.CharField(db_index=True, max_length=20, verbose_name='ID чата клиента'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['date', 'start_time'], name='event_date_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='presentation',
+            index=models.Index(condition=models.Q(('is_finished', False)), fields=['event', 'start_time'], name='presentation_current_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(condition=models.Q(('is_closed', False)), fields=['presentation', 'created_at'], name='question_open_idx'),
+        ),
+        migrations.RunPython(remove_duplicate_likes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='likes',
+            constraint=models.UniqueConstraint(fields=('question', 'client'), name='unique_like_per_client'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.2 on 2026-10-18 20:15
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_likes_count(apps, schema_editor):
+    Question = apps.get_model('meetups', 'Question')
+    Likes = apps.get_model('meetups', 'Likes')
+    likes = (
+        Likes.objects
+        .filter(question=OuterRef('pk'))
+        .order_by()
+        .values('question')
+        .annotate(total=Count('pk'))
+        .values('total')
+    )
+    Question.objects.update(likes_count=Coalesce(Subquery(likes), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meetups', '0012_indexes_and_like_constraint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='likes_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Количество лайков'),
+        ),
+        migrations.RunPython(backfill_likes_count, migrations.RunPython.noop),
+    ]
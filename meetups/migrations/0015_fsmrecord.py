@@ -0,0 +1,33 @@
+# Generated by Django 4.2.2 on 2026-10-18 20:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meetups', '0014_broadcast'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FSMRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat', models.CharField(max_length=20, verbose_name='ID чата')),
+                ('user', models.CharField(max_length=20, verbose_name='ID пользователя')),
+                ('state', models.CharField(blank=True, max_length=100, null=True, verbose_name='Состояние')),
+                ('data', models.JSONField(blank=True, default=dict, verbose_name='Данные')),
+                ('bucket', models.JSONField(blank=True, default=dict, verbose_name='Бакет')),
+                ('updated_at', models.DateTimeField(db_index=True, verbose_name='Обновлено')),
+            ],
+            options={
+                'verbose_name': 'Состояние диалога',
+                'verbose_name_plural': 'Состояния диалогов',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='fsmrecord',
+            constraint=models.UniqueConstraint(fields=('chat', 'user'), name='unique_fsm_record'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.2 on 2026-10-18 20:35
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_questions_count(apps, schema_editor):
+    Presentation = apps.get_model('meetups', 'Presentation')
+    Question = apps.get_model('meetups', 'Question')
+    # The counter hands out question numbers, deleted questions must not free theirs
+    questions = (
+        Question.objects
+        .filter(presentation=OuterRef('pk'))
+        .order_by()
+        .values('presentation')
+        .annotate(last_number=Max('question_number'))
+        .values('last_number')
+    )
+    Presentation.objects.update(questions_count=Coalesce(Subquery(questions), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meetups', '0015_fsmrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='presentation',
+            name='questions_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Задано вопросов'),
+        ),
+        migrations.RunPython(backfill_questions_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.2 on 2026-10-18 21:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meetups', '0016_presentation_questions_count'),
+    ]
+
+    operations = [
+        # The ranking index covers every lookup of open questions by presentation
+        migrations.RemoveIndex(
+            model_name='question',
+            name='question_open_idx',
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(condition=models.Q(('is_closed', False)), fields=['presentation', '-likes_count', '-id'], name='question_ranking_idx'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.2 on 2026-10-18 21:13
+
+import math
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_hot_score(apps, schema_editor):
+    Question = apps.get_model('meetups', 'Question')
+    Likes = apps.get_model('meetups', 'Likes')
+
+    def add_vote(score, moment):
+        vote = moment.timestamp() / settings.HOT_HALF_LIFE
+        if score is None:
+            return vote
+        high, low = max(score, vote), min(score, vote)
+        return high + math.log2(1 + 2 ** (low - high))
+
+    scores = {
+        pk: add_vote(None, created_at)
+        for pk, created_at in Question.objects.values_list('pk', 'created_at').iterator()
+    }
+    for question_id, created_at in Likes.objects.values_list('question_id', 'created_at').iterator():
+        scores[question_id] = add_vote(scores[question_id], created_at)
+    Question.objects.bulk_update(
+        [Question(pk=pk, hot_score=score) for pk, score in scores.items()],
+        ['hot_score'],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meetups', '0017_question_ranking_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='hot_score',
+            field=models.FloatField(default=0, verbose_name='Горячий рейтинг'),
+        ),
+        migrations.RunPython(backfill_hot_score, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(condition=models.Q(('is_closed', False)), fields=['presentation', '-hot_score', '-id'], name='question_hot_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-18 21:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meetups', '0019_cacheversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='presentation',
+            name='digest_sent_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Сводка вопросов отправлена'),
+        ),
+    ]
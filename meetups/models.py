@@ -2,7 +2,7 @@ from django.db import models
 
 # Create your models here.
 class Client(models.Model):
-    chat_id = models.CharField(max_length=20, verbose_name='ID чата клиента')
+    chat_id = models.CharField(max_length=20, verbose_name='ID чата клиента', db_index=True)
     first_name = models.CharField(max_length=40, verbose_name='Имя клиента', null=True, blank=True)
     last_name = models.CharField(max_length=100, verbose_name="Фамилия клиента", null=True, blank=True)
     created_at = models.DateTimeField(verbose_name="Создано", auto_now_add=True)
@@ -30,6 +30,9 @@ class Event(models.Model):
     class Meta:
         verbose_name = 'Мероприятие'
         verbose_name_plural = 'Мероприятия'
+        indexes = [
+            models.Index(fields=['date', 'start_time'], name='event_date_start_idx'),
+        ]
 
     def __str__(self):
         return f'{self.name} {self.date} {self.start_time}'
@@ -56,14 +59,60 @@ class Presentation(models.Model):
     end_time = models.TimeField(verbose_name='Время окончания презентации')
     is_finished = models.BooleanField(verbose_name='Завершен', default=False)
     speaker = models.ForeignKey(Client, on_delete=models.CASCADE, verbose_name='Спикер', related_name='presentations')
+    questions_count = models.PositiveIntegerField(verbose_name='Задано вопросов', default=0)
+    digest_sent_at = models.DateTimeField(verbose_name='Сводка вопросов отправлена', null=True, blank=True)
 
     class Meta:
         verbose_name = 'Доклад'
         verbose_name_plural = 'Доклады'
+        indexes = [
+            models.Index(
+                fields=['event', 'start_time'],
+                condition=models.Q(is_finished=False),
+                name='presentation_current_idx',
+            ),
+        ]
 
     def __str__(self):
         return f'{self.name}: {self.event.name}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        presentation = super().from_db(db, field_names, values)
+        # Signals compare it with the saved speaker to reset the menus of both speakers
+        presentation._loaded_speaker_id = presentation.__dict__.get('speaker_id')
+        return presentation
+
+
+class QuestionQuerySet(models.QuerySet):
+    """Questions ranked by likes (most liked first) or by hot score, then by recency.
+
+    A position in the ranking is the ``(likes_count, pk)`` pair of a question,
+    or its ``(hot_score, pk)`` pair when ranking ``by='hot_score'``. Pages start
+    from such a position and end with ``LIMIT``, so the top questions of a
+    presentation are read from ``question_ranking_idx`` or ``question_hot_idx``
+    whatever the number of questions.
+    """
+
+    def open(self):
+        return self.filter(is_closed=False)
+
+    def ranked(self, by='likes_count'):
+        return self.order_by(f'-{by}', '-pk')
+
+    def after(self, key, inclusive=False, by='likes_count'):
+        """Questions ranked below the ``(value, pk)`` position, or at it too if ``inclusive``."""
+        value, pk = key
+        same_value = models.Q(pk__lte=pk) if inclusive else models.Q(pk__lt=pk)
+        return self.filter(models.Q(**{f'{by}__lt': value}) | models.Q(**{by: value}) & same_value)
+
+    def before(self, key, by='likes_count'):
+        """Questions ranked above the ``(value, pk)`` position, the nearest first."""
+        value, pk = key
+        return self.filter(
+            models.Q(**{f'{by}__gt': value}) | models.Q(**{by: value}, pk__gt=pk)
+        ).order_by(by, 'pk')
+
 
 class Question(models.Model):
     question_number = models.IntegerField(verbose_name='Номер вопроса')
@@ -72,10 +121,26 @@ class Question(models.Model):
     client = models.ForeignKey(Client, on_delete=models.CASCADE, verbose_name='Клиент', related_name='questions')
     created_at = models.DateTimeField(verbose_name='Задан', auto_now_add=True)
     is_closed = models.BooleanField(verbose_name='Закрыт', default=False)
+    likes_count = models.PositiveIntegerField(verbose_name='Количество лайков', default=0)
+    hot_score = models.FloatField(verbose_name='Горячий рейтинг', default=0)
+
+    objects = QuestionQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'Вопрос'
         verbose_name_plural = 'Вопросы'
+        indexes = [
+            models.Index(
+                fields=['presentation', '-likes_count', '-id'],
+                condition=models.Q(is_closed=False),
+                name='question_ranking_idx',
+            ),
+            models.Index(
+                fields=['presentation', '-hot_score', '-id'],
+                condition=models.Q(is_closed=False),
+                name='question_hot_idx',
+            ),
+        ]
 
     def __str__(self):
         return f'{self.text}, {self.client.first_name} {self.client.last_name}'
@@ -89,6 +154,9 @@ class Likes(models.Model):
     class Meta:
         verbose_name = 'Лайк'
         verbose_name_plural = 'Лайки'
+        constraints = [
+            models.UniqueConstraint(fields=['question', 'client'], name='unique_like_per_client'),
+        ]
 
     def __str__(self):
         return f'{self.question.text}: {self.client.first_name} {self.client.last_name}'
@@ -126,3 +194,90 @@ class Organizer(models.Model):
 
     def __str__(self):
         return f'{self.user_id}: {self.first_name} {self.last_name}'
+
+
+class Broadcast(models.Model):
+    event = models.ForeignKey(
+        Event,
+        on_delete=models.CASCADE,
+        verbose_name='Мероприятие',
+        related_name='broadcasts',
+        null=True,
+        blank=True,
+    )
+    text = models.TextField(verbose_name='Текст рассылки')
+    created_at = models.DateTimeField(verbose_name='Создана', auto_now_add=True)
+    finished_at = models.DateTimeField(verbose_name='Завершена', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Рассылка'
+        verbose_name_plural = 'Рассылки'
+
+    def __str__(self):
+        return f'{self.created_at}: {self.text[:50]}'
+
+
+class BroadcastDelivery(models.Model):
+    PENDING = 'pending'
+    SENT = 'sent'
+    BLOCKED = 'blocked'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Ожидает отправки'),
+        (SENT, 'Доставлено'),
+        (BLOCKED, 'Бот заблокирован'),
+        (FAILED, 'Ошибка'),
+    ]
+
+    broadcast = models.ForeignKey(
+        Broadcast,
+        on_delete=models.CASCADE,
+        verbose_name='Рассылка',
+        related_name='deliveries',
+    )
+    chat_id = models.CharField(max_length=20, verbose_name='ID чата получателя')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, verbose_name='Статус')
+
+    class Meta:
+        verbose_name = 'Доставка рассылки'
+        verbose_name_plural = 'Доставки рассылок'
+        constraints = [
+            models.UniqueConstraint(fields=['broadcast', 'chat_id'], name='unique_broadcast_recipient'),
+        ]
+        indexes = [
+            models.Index(fields=['broadcast', 'status'], name='delivery_status_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.broadcast_id} -> {self.chat_id}: {self.status}'
+
+
+class FSMRecord(models.Model):
+    chat = models.CharField(max_length=20, verbose_name='ID чата')
+    user = models.CharField(max_length=20, verbose_name='ID пользователя')
+    state = models.CharField(max_length=100, verbose_name='Состояние', null=True, blank=True)
+    data = models.JSONField(verbose_name='Данные', default=dict, blank=True)
+    bucket = models.JSONField(verbose_name='Бакет', default=dict, blank=True)
+    updated_at = models.DateTimeField(verbose_name='Обновлено', db_index=True)
+
+    class Meta:
+        verbose_name = 'Состояние диалога'
+        verbose_name_plural = 'Состояния диалогов'
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'user'], name='unique_fsm_record'),
+        ]
+
+    def __str__(self):
+        return f'{self.chat}/{self.user}: {self.state}'
+
+
+class CacheVersion(models.Model):
+    name = models.CharField(max_length=50, unique=True, verbose_name='Кеш')
+    version = models.PositiveBigIntegerField(verbose_name='Версия', default=0)
+
+    class Meta:
+        verbose_name = 'Версия кеша'
+        verbose_name_plural = 'Версии кешей'
+
+    def __str__(self):
+        return f'{self.name}: {self.version}'
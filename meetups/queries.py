@@ -0,0 +1,214 @@
+"""Data access for the bot handlers.
+
+Handlers call these coroutines instead of wrapping ORM calls in
+``sync_to_async`` themselves. Every query goes through Django's async
+queryset API (``aget``, ``aexists``, ``acount``, ``acreate``, ``async for``),
+so each query is one awaitable and lazy querysets are never passed across
+the sync/async boundary. Writes that need a transaction are plain functions
+run with a single ``sync_to_async`` call.
+"""
+from asgiref.sync import sync_to_async
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from meetups.models import (
+    Client,
+    Donate,
+    Event,
+    Likes,
+    Organizer,
+    Presentation,
+    Question,
+    Visitor,
+)
+from meetups.singleflight import single_flight
+
+
+async def get_client(chat_id):
+    return await Client.objects.aget(chat_id=chat_id)
+
+
+async def get_or_create_client(chat_id):
+    return await Client.objects.aget_or_create(chat_id=chat_id)
+
+
+async def rename_client(client, first_name, last_name):
+    client.first_name = first_name
+    client.last_name = last_name
+    await client.asave()
+
+
+async def register_visitor(client, event_id):
+    return await Visitor.objects.aget_or_create(client=client, event_id=event_id)
+
+
+async def get_event(event_id):
+    return await Event.objects.aget(pk=event_id)
+
+
+async def list_events():
+    return [event async for event in Event.objects.all()]
+
+
+async def list_client_events(client, since):
+    events = Event.objects.filter(visitors=client, date__gte=since).distinct()
+    return [event async for event in events]
+
+
+@single_flight.coalesce('presentation')
+async def get_presentation(presentation_id):
+    """Presentation with its speaker, ``None`` if it was deleted."""
+    return await Presentation.objects.select_related('speaker').filter(pk=presentation_id).afirst()
+
+
+async def get_presentation_with_event(presentation_id):
+    return await Presentation.objects.select_related('event').aget(pk=presentation_id)
+
+
+@single_flight.coalesce('event_presentations')
+async def list_event_presentations(event_id):
+    presentations = Presentation.objects.filter(event=event_id).select_related('speaker')
+    return [presentation async for presentation in presentations]
+
+
+async def list_speaker_presentations(chat_id):
+    presentations = Presentation.objects.filter(speaker__chat_id=chat_id).select_related('event', 'speaker')
+    return [presentation async for presentation in presentations]
+
+
+async def finish_presentation(presentation_id):
+    presentation = await Presentation.objects.aget(pk=presentation_id)
+    presentation.is_finished = True
+    await presentation.asave()
+    return presentation
+
+
+@single_flight.coalesce('questions_count')
+async def count_questions(presentation_id):
+    return await Presentation.objects.values_list('questions_count', flat=True).aget(pk=presentation_id)
+
+
+def add_question(client, presentation_id, text):
+    """Create the next numbered question of the presentation.
+
+    The counter update takes the write lock first, so simultaneous askers get
+    consecutive numbers.
+    """
+    with transaction.atomic():
+        Presentation.objects.filter(pk=presentation_id).update(questions_count=F('questions_count') + 1)
+        question_number = Presentation.objects.values_list('questions_count', flat=True).get(pk=presentation_id)
+        return Question.objects.create(
+            client=client,
+            presentation_id=presentation_id,
+            text=text,
+            question_number=question_number,
+        )
+
+
+async def create_question(client, presentation_id, text):
+    return await sync_to_async(add_question)(client, presentation_id, text)
+
+
+async def get_question(question_id):
+    """Question with its presentation and author, ``None`` if it was deleted."""
+    return await Question.objects.select_related('presentation', 'client').filter(pk=question_id).afirst()
+
+
+async def close_question(question_id):
+    question = await Question.objects.aget(pk=question_id)
+    question.is_closed = True
+    await question.asave(update_fields=['is_closed'])
+    return question
+
+
+async def has_liked(chat_id, question):
+    return await Likes.objects.filter(client__chat_id=chat_id, question=question).aexists()
+
+
+def add_like(chat_id, question_id):
+    """Vote for the question.
+
+    Returns whether the vote is new, the likes total and the presentation of
+    the question. The vote is one ``INSERT ... ON CONFLICT DO NOTHING``
+    backed by the unique (question, client) constraint, so repeated taps are
+    no-ops, and a new vote gets the total from the ``RETURNING`` clause of
+    the counter update. Model signals are not sent, the likes counter is
+    updated here instead. Raises ``Client.DoesNotExist`` for a chat that is
+    not registered and ``Question.DoesNotExist`` for a deleted question.
+    """
+    quote_name = connection.ops.quote_name
+    clients_table = quote_name(Client._meta.db_table)
+    questions_table = quote_name(Question._meta.db_table)
+    insert_like = (
+        f'INSERT INTO {quote_name(Likes._meta.db_table)} (question_id, client_id, created_at) '
+        f'SELECT %s, id, %s FROM {clients_table} WHERE chat_id = %s LIMIT 1 '
+        f'ON CONFLICT (question_id, client_id) DO NOTHING RETURNING client_id'
+    )
+    increment_likes = (
+        f'UPDATE {questions_table} SET likes_count = likes_count + 1 WHERE id = %s '
+        f'RETURNING likes_count, presentation_id'
+    )
+    load_likes = (
+        f'SELECT likes_count, presentation_id, EXISTS (SELECT 1 FROM {clients_table} WHERE chat_id = %s) '
+        f'FROM {questions_table} WHERE id = %s'
+    )
+    created_at = connection.ops.adapt_datetimefield_value(timezone.now())
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(insert_like, [question_id, created_at, str(chat_id)])
+            created = cursor.fetchone() is not None
+            if created:
+                cursor.execute(increment_likes, [question_id])
+                row = cursor.fetchone()
+            else:
+                # Either a repeated tap or a chat that never registered
+                cursor.execute(load_likes, [str(chat_id), question_id])
+                row = cursor.fetchone()
+                if row is not None and not row[2]:
+                    raise Client.DoesNotExist
+        if row is None:
+            # Rolls back the vote for a deleted question
+            raise Question.DoesNotExist
+    likes_count, presentation_id = row[:2]
+    return created, likes_count, presentation_id
+
+
+async def like_question(chat_id, question_id):
+    return await sync_to_async(add_like)(chat_id, question_id)
+
+
+async def liked_question_ids(chat_id, questions):
+    liked = Likes.objects.filter(
+        client__chat_id=chat_id,
+        question__in=questions,
+    ).values_list('question_id', flat=True)
+    return {question_id async for question_id in liked}
+
+
+async def list_question_likes(question_id):
+    likes = Likes.objects.filter(question=question_id).select_related('client')
+    return [like async for like in likes]
+
+
+async def create_donate(client, amount, event):
+    return await Donate.objects.acreate(client=client, sum=amount, event=event)
+
+
+async def get_organizer(user_id):
+    return await Organizer.objects.aget(user_id=user_id)
+
+
+async def list_organizer_events(organizer):
+    return [event async for event in Event.objects.filter(organizer=organizer)]
+
+
+async def create_organizer_event(organizer, **fields):
+    event, _ = await Event.objects.aget_or_create(**fields)
+    await organizer.events.aadd(event)
+    return event
+
+
+async def create_presentation(speaker, event_id, **fields):
+    presentation, _ = await Presentation.objects.aget_or_create(speaker=speaker, event_id=event_id, **fields)
+    return presentation
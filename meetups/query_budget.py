@@ -0,0 +1,83 @@
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Profiles of the code being run, a query is recorded by all of them
+active_profiles = ContextVar('active_profiles', default=())
+
+
+class QueryProfile:
+    """SQL statements executed while the profile is active, with their duration.
+
+    The profile follows the code through ``sync_to_async``, so it sees the
+    queries of an async handler. Profiles nest: a query counts for every
+    active one. Tasks started inside the profile inherit it, their queries
+    count until the profile ends.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.statements = []
+        self._tokens = []
+
+    def __enter__(self):
+        self._tokens.append(active_profiles.set(active_profiles.get() + (self,)))
+        return self
+
+    def __exit__(self, *exc_info):
+        active_profiles.reset(self._tokens.pop())
+
+    @property
+    def active(self):
+        return bool(self._tokens)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    @property
+    def duration(self):
+        return sum(duration for _, duration in self.statements)
+
+    def most_repeated(self):
+        """The statement run most times and how many times, N+1 patterns show up here."""
+        if not self.statements:
+            return None, 0
+        return Counter(sql for sql, _ in self.statements).most_common(1)[0]
+
+    def report(self):
+        sql, repeated = self.most_repeated()
+        lines = [f'{self.name or "block"}: {self.count} queries in {self.duration * 1000:.1f} ms']
+        if repeated > 1:
+            lines.append(f'repeated {repeated} times: {sql}')
+        lines += [f'{number}. {sql}' for number, (sql, _) in enumerate(self.statements, 1)]
+        return '\n'.join(lines)
+
+
+def record_queries(execute, sql, params, many, context):
+    profiles = active_profiles.get()
+    if not profiles:
+        return execute(sql, params, many, context)
+    started_at = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - started_at
+        for profile in profiles:
+            if profile.active:
+                profile.statements.append((sql, duration))
+
+
+def install_query_profiler(connection):
+    if record_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, record_queries)
+
+
+@contextmanager
+def assert_query_budget(max_queries, name=None):
+    """Fail the test if the block runs more than ``max_queries`` SQL statements."""
+    with QueryProfile(name) as profile:
+        yield profile
+    if profile.count > max_queries:
+        raise AssertionError(f'Query budget of {max_queries} exceeded by {profile.report()}')
@@ -0,0 +1,199 @@
+import math
+from bisect import bisect_left, insort
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import Greatest, Least, Log, Power
+
+from meetups.models import Likes, Question
+
+
+@dataclass(frozen=True)
+class RankedQuestion:
+    pk: int
+    question_number: int
+    text: str
+    likes_count: int
+
+    @property
+    def key(self):
+        return -self.likes_count, -self.pk
+
+
+class QuestionRanking:
+    """Open questions of a presentation ordered by likes, then by recency.
+
+    The order is the one of ``Question.objects.ranked()`` and of the questions feed. The ranking is loaded once
+    and then kept up to date from question and like writes: a question is
+    found by binary search and moved without re-sorting the others.
+    """
+
+    def __init__(self, questions=()):
+        self._questions = {}
+        self._keys = []
+        for question in questions:
+            self.update(question)
+
+    def __len__(self):
+        return len(self._questions)
+
+    def __contains__(self, question_id):
+        return question_id in self._questions
+
+    @classmethod
+    def load(cls, presentation_id):
+        questions = Question.objects.filter(presentation=presentation_id).open().values_list(
+            'pk', 'question_number', 'text', 'likes_count',
+        )
+        return cls(RankedQuestion(*row) for row in questions.iterator())
+
+    def _discard_key(self, question):
+        index = bisect_left(self._keys, question.key)
+        del self._keys[index]
+
+    def update(self, question):
+        """Add the question or move it to the place of its new likes total."""
+        previous = self._questions.get(question.pk)
+        if previous == question:
+            return False
+        if previous is not None:
+            self._discard_key(previous)
+        self._questions[question.pk] = question
+        insort(self._keys, question.key)
+        return True
+
+    def set_likes(self, question_id, likes_count):
+        """Move a ranked question, likes of questions the ranking does not have are ignored."""
+        question = self._questions.get(question_id)
+        if question is None or question.likes_count == likes_count:
+            return False
+        return self.update(RankedQuestion(question.pk, question.question_number, question.text, likes_count))
+
+    def remove(self, question_id):
+        question = self._questions.pop(question_id, None)
+        if question is None:
+            return False
+        self._discard_key(question)
+        return True
+
+    def top(self, size):
+        return [self._questions[-pk] for _, pk in self._keys[:size]]
+
+
+# Горячий рейтинг вопроса - это log2 суммы весов его голосов, где вес голоса удваивается каждые HOT_HALF_LIFE секунд.
+# Вопрос сам считается одним голосом в момент, когда его задали. Веса всех голосов стареют одинаково, поэтому
+# рейтинги не нужно пересчитывать со временем: порядок вопросов меняют только новые голоса.
+
+def hot_vote(moment, half_life=None):
+    """Hot score of a single vote cast at ``moment``."""
+    return moment.timestamp() / (half_life or settings.HOT_HALF_LIFE)
+
+
+def add_hot_votes(score, votes):
+    """Hot score of the votes of both scores, ``log2(2**score + 2**votes)`` without overflow."""
+    high, low = max(score, votes), min(score, votes)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+def add_hot_votes_expression(score, votes):
+    """``add_hot_votes`` computed by the database, e.g. to add votes to ``F('hot_score')``."""
+    votes = Value(votes, output_field=FloatField())
+    high, low = Greatest(score, votes), Least(score, votes)
+    return high + Log(Value(2.0), 1 + Power(Value(2.0), low - high))
+
+
+def save_hot_votes(votes):
+    """Add new votes to the saved hot scores, ``votes`` maps question ids to the hot scores of their new votes.
+
+    The votes are added to the saved score rather than replacing it, so
+    votes counted by different bot processes all end up in the database.
+    """
+    with transaction.atomic():
+        for question_id, score in votes.items():
+            Question.objects.filter(pk=question_id).update(hot_score=add_hot_votes_expression(F('hot_score'), score))
+
+
+def recount_hot_scores(questions=None, half_life=None):
+    """Compute hot scores anew from the times of questions and their likes, e.g. after changing HOT_HALF_LIFE."""
+    if questions is None:
+        questions = Question.objects.all()
+    scores = {
+        pk: hot_vote(created_at, half_life)
+        for pk, created_at in questions.values_list('pk', 'created_at').iterator()
+    }
+    likes = Likes.objects.filter(question__in=questions).values_list('question_id', 'created_at')
+    for question_id, created_at in likes.iterator():
+        scores[question_id] = add_hot_votes(scores[question_id], hot_vote(created_at, half_life))
+    Question.objects.bulk_update(
+        [Question(pk=pk, hot_score=score) for pk, score in scores.items()],
+        ['hot_score'],
+        batch_size=500,
+    )
+    return len(scores)
+
+
+class HotRanking:
+    """Hot scores of the open questions of a presentation, the hottest first.
+
+    The order is the one of ``Question.objects.ranked('hot_score')``. A vote
+    finds its question by binary search and moves it without re-sorting the
+    others, so it costs the same whatever the number of votes so far.
+    """
+
+    def __init__(self, scores=()):
+        self._scores = {}
+        self._keys = []
+        for question_id, score in scores:
+            self.set(question_id, score)
+
+    def __len__(self):
+        return len(self._scores)
+
+    def __contains__(self, question_id):
+        return question_id in self._scores
+
+    @classmethod
+    def load(cls, presentation_id):
+        scores = Question.objects.filter(presentation=presentation_id).open().values_list('pk', 'hot_score')
+        return cls(scores.iterator())
+
+    def score(self, question_id):
+        return self._scores.get(question_id)
+
+    def set(self, question_id, score):
+        previous = self._scores.get(question_id)
+        if previous is not None:
+            del self._keys[bisect_left(self._keys, (-previous, -question_id))]
+        self._scores[question_id] = score
+        insort(self._keys, (-score, -question_id))
+
+    def vote(self, question_id, votes):
+        """Add new votes to the question, votes for questions the ranking does not have are ignored."""
+        score = self._scores.get(question_id)
+        if score is None:
+            return False
+        self.set(question_id, add_hot_votes(score, votes))
+        return True
+
+    def remove(self, question_id):
+        score = self._scores.pop(question_id, None)
+        if score is None:
+            return False
+        del self._keys[bisect_left(self._keys, (-score, -question_id))]
+        return True
+
+    def position(self, question_id):
+        """Place of the question in the ranking counting from 0, ``None`` if the ranking does not have it."""
+        score = self._scores.get(question_id)
+        if score is None:
+            return None
+        return bisect_left(self._keys, (-score, -question_id))
+
+    def slice(self, start, stop):
+        """Ids of the questions ranked from ``start`` to ``stop``, the hottest first."""
+        return [-pk for _, pk in self._keys[max(start, 0):max(stop, 0)]]
+
+    def top(self, size):
+        return self.slice(0, size)
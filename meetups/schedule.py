@@ -0,0 +1,302 @@
+import asyncio
+import heapq
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from threading import Lock
+
+from asgiref.sync import sync_to_async
+
+from meetups.cache_version import SharedVersion
+from meetups.models import Event, Presentation
+from meetups.singleflight import single_flight
+
+logger = logging.getLogger('Schedule')
+
+
+@dataclass
+class ScheduleSnapshot:
+    """Today's events and unfinished presentations, valid until the next boundary."""
+    day: object
+    events: list
+    presentations: list
+    valid_until: datetime
+
+    def current_event(self, now):
+        for event in self.events:
+            if event.start_time <= now.time():
+                return event
+        return None
+
+    def current_presentation(self, now):
+        event = self.current_event(now)
+        if event is None:
+            return None
+        for presentation in self.presentations:
+            if presentation.event_id == event.pk and presentation.start_time <= now.time():
+                return presentation
+        return None
+
+
+@dataclass(frozen=True)
+class ScheduleState:
+    """Current event and presentation between two boundaries of the schedule."""
+    since: datetime
+    valid_until: datetime
+    event: object
+    presentation: object
+
+    def is_valid(self, now):
+        return self.since <= now < self.valid_until
+
+
+class ScheduleResolver:
+    """Resolves the current event and presentation without querying on every click.
+
+    The answer of ``Event.objects.filter(date=today, start_time__lte=now)`` and the
+    matching presentation query can only change when the clock passes one of
+    today's ``start_time``/``end_time`` values or when the schedule is edited.
+    The resolver loads today's schedule once, serves it from memory until the
+    next such boundary and is reset by model signals on edits. Signals only
+    reach the process that made the edit, so they also bump the shared
+    ``version`` and the resolver drops its snapshot when it sees the version
+    move, which covers edits made in the admin or in other bot processes.
+    While a ``PresentationScheduler`` runs, the current event and
+    presentation are also published as a ``ScheduleState`` that is read
+    without a lookup.
+    """
+
+    def __init__(self, clock=datetime.now, version=None):
+        self.clock = clock
+        self.version = version or SharedVersion('schedule')
+        self._snapshot = None
+        self._state = None
+        self._generation = 0
+        self._lock = Lock()
+        self._listeners = []
+
+    def subscribe(self, listener):
+        """Call ``listener`` after every edit of the schedule, possibly from another thread."""
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self._listeners.remove(listener)
+
+    def invalidate(self):
+        self._generation += 1
+        self._snapshot = None
+        self._state = None
+        for listener in list(self._listeners):
+            listener()
+
+    @property
+    def state(self):
+        return self._state
+
+    def publish(self, snapshot, now):
+        """Publish the current state of the snapshot, unless the schedule was edited since it was loaded."""
+        if snapshot is not self._snapshot:
+            return None
+        state = ScheduleState(now, snapshot.valid_until, snapshot.current_event(now), snapshot.current_presentation(now))
+        self._state = state
+        # The snapshot may have been dropped while the state was computed
+        if snapshot is not self._snapshot:
+            self._state = None
+            return None
+        return state
+
+    def check_version(self):
+        """Drop the schedule if another process edited it, at most one query per check interval."""
+        if self.version.changed():
+            self.invalidate()
+
+    async def _acheck_version(self):
+        if self.version.is_due():
+            await single_flight.do(('schedule_version', id(self)), sync_to_async(self.check_version))
+
+    def _published_state(self, now):
+        state = self._state
+        if state is not None and state.is_valid(now):
+            return state
+        return None
+
+    def _load(self, now):
+        today = now.date()
+        # Read before the schedule, an edit committed in between only causes one more reload
+        self.version.read()
+        events = list(Event.objects.filter(date=today).order_by('pk'))
+        presentations = list(
+            Presentation.objects.filter(event__in=events, is_finished=False)
+            .select_related('speaker', 'event')
+            .order_by('pk')
+        )
+        times = {event.start_time for event in events}
+        for presentation in presentations:
+            times.update((presentation.start_time, presentation.end_time))
+        boundaries = sorted(datetime.combine(today, moment) for moment in times)
+        midnight = datetime.combine(today + timedelta(days=1), datetime.min.time())
+        valid_until = next((boundary for boundary in boundaries if boundary > now), midnight)
+        return ScheduleSnapshot(today, events, presentations, valid_until)
+
+    def _fresh_snapshot(self, now):
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.day == now.date() and now < snapshot.valid_until:
+            return snapshot
+        return None
+
+    def get_snapshot(self, now=None):
+        now = now or self.clock()
+        self.check_version()
+        snapshot = self._fresh_snapshot(now)
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._fresh_snapshot(now)
+                if snapshot is None:
+                    generation = self._generation
+                    snapshot = self._load(now)
+                    # An edit committed while loading must not be hidden by a stale snapshot
+                    if generation == self._generation:
+                        self._snapshot = snapshot
+        return snapshot
+
+    async def aget_snapshot(self, now=None):
+        now = now or self.clock()
+        await self._acheck_version()
+        snapshot = self._fresh_snapshot(now)
+        if snapshot is None:
+            # Everyone who missed the expired snapshot waits for one reload
+            key = ('schedule', id(self), now.date(), self._generation)
+            snapshot = await single_flight.do(key, sync_to_async(self.get_snapshot), now)
+        return snapshot
+
+    async def get_current_event(self, now=None):
+        now = now or self.clock()
+        await self._acheck_version()
+        state = self._published_state(now)
+        if state is not None:
+            return state.event
+        snapshot = await self.aget_snapshot(now)
+        return snapshot.current_event(now)
+
+    async def get_current_presentation(self, now=None):
+        now = now or self.clock()
+        await self._acheck_version()
+        state = self._published_state(now)
+        if state is not None:
+            return state.presentation
+        snapshot = await self.aget_snapshot(now)
+        return snapshot.current_presentation(now)
+
+
+schedule_resolver = ScheduleResolver()
+
+START, END = 'start', 'end'
+
+
+class PresentationScheduler:
+    """Moves the schedule forward at the start and end times of today's events and presentations.
+
+    The boundaries of the loaded schedule are kept in a heap. The scheduler
+    sleeps until the nearest one, finishes the presentations whose end time
+    has come and publishes the current event and presentation to the
+    resolver. An edit of the schedule wakes it up to rebuild the heap from
+    the new schedule, edits made by other processes are noticed within the
+    check interval of the resolver's version. Finishing is idempotent, so
+    every bot process runs its own scheduler. ``on_finished`` is called with
+    the ids of the presentations that left today's schedule: finished at
+    their end time, by the speaker or by another process, or deleted.
+    """
+
+    def __init__(self, resolver=None, clock=None, on_finished=None):
+        self.resolver = resolver or schedule_resolver
+        self.clock = clock or self.resolver.clock
+        self.on_finished = on_finished
+        self._snapshot = None
+        self._boundaries = []
+        self._changed = None
+        self._loop = None
+        self._task = None
+
+    def _schedule(self, snapshot):
+        boundaries = [(datetime.combine(snapshot.day, event.start_time), START, event.pk) for event in snapshot.events]
+        for presentation in snapshot.presentations:
+            boundaries.append((datetime.combine(snapshot.day, presentation.start_time), START, presentation.pk))
+            boundaries.append((datetime.combine(snapshot.day, presentation.end_time), END, presentation.pk))
+        heapq.heapify(boundaries)
+        self._boundaries = boundaries
+
+    def next_boundary(self):
+        if self._snapshot is None:
+            return None
+        if self._boundaries:
+            return min(self._boundaries[0][0], self._snapshot.valid_until)
+        return self._snapshot.valid_until
+
+    @staticmethod
+    def _finish(presentation_ids):
+        for presentation in Presentation.objects.filter(pk__in=presentation_ids, is_finished=False):
+            presentation.is_finished = True
+            # Signals reset the schedule and the menus like when the speaker finishes the presentation
+            presentation.save(update_fields=['is_finished'])
+
+    @staticmethod
+    def _left(previous, snapshot):
+        if previous is None:
+            return []
+        remaining = {presentation.pk for presentation in snapshot.presentations}
+        return [presentation.pk for presentation in previous.presentations if presentation.pk not in remaining]
+
+    async def tick(self, now=None):
+        """Handle the boundaries that have come by ``now`` and publish the current state."""
+        now = now or self.clock()
+        while True:
+            snapshot = await self.resolver.aget_snapshot(now)
+            if snapshot is not self._snapshot:
+                left = self._left(self._snapshot, snapshot)
+                self._snapshot = snapshot
+                self._schedule(snapshot)
+                if left and self.on_finished is not None:
+                    self.on_finished(left)
+            ended = []
+            while self._boundaries and self._boundaries[0][0] <= now:
+                _, kind, pk = heapq.heappop(self._boundaries)
+                if kind == END:
+                    ended.append(pk)
+            if not ended:
+                return self.resolver.publish(snapshot, now)
+            await sync_to_async(self._finish)(ended)
+            # Reload after the finish is committed, also when another bot process finished them first
+            self.resolver.invalidate()
+
+    def _wake_up(self):
+        self._loop.call_soon_threadsafe(self._changed.set)
+
+    async def _run(self):
+        while True:
+            self._changed.clear()
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception('failed to advance the schedule')
+            boundary = self.next_boundary()
+            delay = (boundary - self.clock()).total_seconds() if boundary is not None else 60
+            # Edits of other processes only show up when the shared version is checked
+            delay = min(delay, self.resolver.version.check_interval)
+            try:
+                await asyncio.wait_for(self._changed.wait(), max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        self.resolver.subscribe(self._wake_up)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self.resolver.unsubscribe(self._wake_up)
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
@@ -0,0 +1,100 @@
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.signals import connection_created
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from meetups.menu import menu_state_cache
+from meetups.models import Event, Likes, Presentation, Question, Visitor
+from meetups.query_budget import install_query_profiler
+from meetups.ranking import hot_vote
+from meetups.schedule import schedule_resolver
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in connection.settings_dict.get('PRAGMAS', {}).items():
+            if not re.fullmatch(r'\w+', name) or not re.fullmatch(r'-?\w+', str(value)):
+                raise ImproperlyConfigured(f'Bad SQLite pragma {name}={value!r}')
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+@receiver(connection_created)
+def profile_queries(sender, connection, **kwargs):
+    install_query_profiler(connection)
+
+
+@receiver(pre_save, sender=Question)
+def set_initial_hot_score(sender, instance, **kwargs):
+    # A new question counts as one vote cast when it is asked
+    if instance._state.adding and not instance.hot_score:
+        instance.hot_score = hot_vote(timezone.now())
+
+
+@receiver(post_save, sender=Likes)
+def increment_question_likes(sender, instance, created, using, **kwargs):
+    if created:
+        Question.objects.using(using).filter(pk=instance.question_id).update(likes_count=F('likes_count') + 1)
+
+
+@receiver(post_delete, sender=Likes)
+def decrement_question_likes(sender, instance, using, **kwargs):
+    Question.objects.using(using).filter(
+        pk=instance.question_id,
+        likes_count__gt=0,
+    ).update(likes_count=F('likes_count') - 1)
+
+
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+@receiver(post_save, sender=Presentation)
+@receiver(post_delete, sender=Presentation)
+def invalidate_schedule(sender, **kwargs):
+    schedule_resolver.invalidate()
+    # Let the resolvers of other processes know, the edit may come from the admin
+    schedule_resolver.version.bump()
+
+
+@receiver(post_save, sender=Visitor)
+@receiver(post_delete, sender=Visitor)
+def invalidate_visitor_menu(sender, instance, **kwargs):
+    menu_state_cache.invalidate_clients([instance.client_id])
+
+
+@receiver(post_save, sender=Presentation)
+def invalidate_speaker_menu(sender, instance, created, update_fields, **kwargs):
+    # Only the speaker of a presentation changes the menu, finishing it does not
+    if update_fields is not None and not update_fields & {'speaker', 'speaker_id'}:
+        return
+    previous_speaker_id = getattr(instance, '_loaded_speaker_id', None)
+    if not created and previous_speaker_id == instance.speaker_id:
+        return
+    instance._loaded_speaker_id = instance.speaker_id
+    menu_state_cache.invalidate_clients({instance.speaker_id, previous_speaker_id} - {None})
+
+
+@receiver(post_delete, sender=Presentation)
+def invalidate_deleted_speaker_menu(sender, instance, **kwargs):
+    menu_state_cache.invalidate_clients([instance.speaker_id])
+
+
+@receiver(post_save, sender=Event)
+def invalidate_event_menu(sender, instance, created, **kwargs):
+    menu_state_cache.invalidate_events()
+    menu_state_cache.version.bump()
+    if not created:
+        visitor_ids = Visitor.objects.filter(event=instance).values_list('client_id', flat=True)
+        menu_state_cache.invalidate_clients(list(visitor_ids))
+
+
+@receiver(post_delete, sender=Event)
+def invalidate_deleted_event_menu(sender, instance, **kwargs):
+    # Visitors of the event are removed by cascade and invalidate their own clients
+    menu_state_cache.invalidate_events()
+    menu_state_cache.version.bump()
@@ -0,0 +1,70 @@
+import asyncio
+import functools
+from collections import Counter
+
+
+class SingleFlight:
+    """Coalesces identical reads that are in flight at the same time.
+
+    The first caller with a key starts the read, callers arriving before it
+    finishes await the same task and get the same result (or exception).
+    Nothing is kept after the read completes, so freshness is up to the
+    caches behind it. A read in flight may have started before the caller's
+    own write, so callers that must see their write pass ``fresh=True``.
+    Every caller gets the same object, which must not be mutated.
+    ``hits`` counts callers that joined a read in flight, ``misses`` counts
+    reads actually started; both are keyed by read name.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def __len__(self):
+        return len(self._flights)
+
+    def stats(self):
+        return {
+            name: {'hits': self.hits[name], 'misses': self.misses[name]}
+            for name in sorted(set(self.hits) | set(self.misses))
+        }
+
+    def reset_stats(self):
+        self.hits.clear()
+        self.misses.clear()
+
+    async def do(self, key, func, *args, fresh=False, **kwargs):
+        """Result of ``await func(*args, **kwargs)``, shared by callers with equal ``key``.
+
+        ``key`` is a tuple that starts with the read name. A ``fresh`` caller
+        does not join the read in flight but starts a new one, which callers
+        arriving after it share.
+        """
+        task = self._flights.get(key)
+        if fresh or task is None or task.get_loop() is not asyncio.get_running_loop():
+            self.misses[key[0]] += 1
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._flights[key] = task
+            task.add_done_callback(functools.partial(self._land, key))
+        else:
+            self.hits[key[0]] += 1
+        # A cancelled caller must not cancel the read for everyone else
+        return await asyncio.shield(task)
+
+    def _land(self, key, task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+
+    def coalesce(self, name):
+        """Decorator for a coroutine function keyed by ``name`` and its arguments."""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, fresh=False, **kwargs):
+                key = (name, *args, *sorted(kwargs.items()))
+                return await self.do(key, func, *args, fresh=fresh, **kwargs)
+            return wrapper
+        return decorator
+
+
+single_flight = SingleFlight()
@@ -1,3 +1,1485 @@
-from django.test import TestCase
+import asyncio
+import contextvars
+import multiprocessing
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta
+from io import StringIO
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.dispatcher.handler import SkipHandler
+from aiogram.dispatcher.webhook import get_new_configured_app
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.utils.payload import prepare_arg
+from aiogram.utils.exceptions import BotBlocked, RetryAfter
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from asgiref.sync import sync_to_async
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from meetups.management.commands.benchmark import ADMIN_FLOWS, Measurement, admin_benchmark, create_file_database
+from meetups.management.commands.bot_metrics import MetricsMiddleware, metrics
+from meetups.management.commands.broadcasts import BroadcastEngine, SharedTokenBucket
+from meetups.management.commands.callback_router import CallbackConflict, CallbackData, CallbackRouter
+from meetups.management.commands.fsm_storage import DatabaseStorage
+from meetups.management.commands.hot_scores import HotScores, hot_scores
+from meetups.management.commands.keyboard_templates import keyboard_template
+from meetups.management.commands.leaderboard import LiveLeaderboard
+from meetups.management.commands.likes_buffer import LikesBuffer
+from meetups.management.commands.question_digests import QuestionDigests
+from meetups.management.commands.loadtest import LoadGenerator, create_load_fixture
+from meetups.management.commands.fake_telegram import (
+    FakeTelegramServer,
+    make_callback_update,
+    make_message_update,
+)
+from meetups.management.commands.runuserbot import (
+    bot,
+    broadcast_engine,
+    dp,
+    live_leaderboard,
+    question_digests,
+    router,
+)
+from meetups.management.commands.webhook import WORKER_PATH, create_front_app
+from meetups.management.commands.user_keyboards import (
+    afetch_questions_page,
+    encode_question_cursor,
+    fetch_questions_page,
+    get_question_main_menu_keyboard,
+)
+from meetups import queries
+from meetups.menu import MenuStateCache, menu_state_cache
+from meetups.metrics import Metrics
+from meetups.query_budget import QueryProfile, assert_query_budget
+from meetups.ranking import QuestionRanking, add_hot_votes, hot_vote, recount_hot_scores
+from meetups.models import BroadcastDelivery, Client, Event, FSMRecord, Likes, Presentation, Question, Visitor
+from meetups.cache_version import SharedVersion
+from meetups.schedule import PresentationScheduler, ScheduleResolver, schedule_resolver
+from meetups.singleflight import SingleFlight
+
+
+class HotQueryIndexTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.client_ = Client.objects.create(chat_id='1', first_name='Иван', last_name='Иванов')
+        cls.event = Event.objects.create(name='Meetup', date=date(2023, 6, 25), start_time=time(10, 0))
+        cls.presentation = Presentation.objects.create(
+            name='Доклад',
+            annotation='Аннотация',
+            event=cls.event,
+            start_time=time(10, 0),
+            end_time=time(11, 0),
+            speaker=cls.client_,
+        )
+        cls.question = Question.objects.create(
+            question_number=1,
+            text='Вопрос',
+            presentation=cls.presentation,
+            client=cls.client_,
+        )
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(f'USING INDEX {index_name}', plan)
+
+    def test_client_lookup_by_chat_uses_index(self):
+        plan = Client.objects.filter(chat_id='1').explain()
+        self.assertIn('(chat_id=?)', plan)
+
+    def test_current_event_uses_index(self):
+        queryset = Event.objects.filter(date=date(2023, 6, 25), start_time__lte=time(12, 0))
+        self.assertUsesIndex(queryset, 'event_date_start_idx')
+
+    def test_current_presentation_uses_index(self):
+        queryset = Presentation.objects.filter(
+            event=self.event,
+            start_time__lte=time(12, 0),
+            is_finished=False,
+        )
+        self.assertUsesIndex(queryset, 'presentation_current_idx')
+
+    def test_ranked_questions_page_uses_index(self):
+        queryset = Question.objects.filter(presentation=self.presentation).open().ranked().after((3, 10))[:6]
+        self.assertUsesIndex(queryset, 'question_ranking_idx')
+        self.assertNotIn('TEMP B-TREE', queryset.explain())
+
+    def test_hot_questions_page_uses_index(self):
+        key = (Question.objects.filter(pk=self.question.pk).values('hot_score')[:1], self.question.pk)
+        queryset = Question.objects.filter(presentation=self.presentation).open().ranked('hot_score')
+        queryset = queryset.after(key, by='hot_score')[:6]
+        self.assertUsesIndex(queryset, 'question_hot_idx')
+        self.assertNotIn('TEMP B-TREE', queryset.explain())
+
+    def test_user_like_lookup_uses_unique_index(self):
+        queryset = Likes.objects.filter(question=self.question, client=self.client_)
+        # SQLite turns the unique constraint into an autoindex over both columns.
+        self.assertIn('(question_id=? AND client_id=?)', queryset.explain())
+
+    def test_like_is_unique_per_client(self):
+        Likes.objects.create(question=self.question, client=self.client_)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Likes.objects.create(question=self.question, client=self.client_)
+
+
+class QuestionLikesCountTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.speaker = Client.objects.create(chat_id='1', first_name='Иван', last_name='Иванов')
+        cls.listener = Client.objects.create(chat_id='2', first_name='Петр', last_name='Петров')
+        event = Event.objects.create(name='Meetup', date=date(2023, 6, 25), start_time=time(10, 0))
+        presentation = Presentation.objects.create(
+            name='Доклад',
+            annotation='Аннотация',
+            event=event,
+            start_time=time(10, 0),
+            end_time=time(11, 0),
+            speaker=cls.speaker,
+        )
+        cls.question = Question.objects.create(
+            question_number=1,
+            text='Вопрос',
+            presentation=presentation,
+            client=cls.speaker,
+        )
+
+    def test_like_create_and_delete_update_counter(self):
+        like = Likes.objects.create(question=self.question, client=self.listener)
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.likes_count, 1)
+
+        like.delete()
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.likes_count, 0)
+
+    def test_recount_likes_repairs_counter(self):
+        Likes.objects.bulk_create([
+            Likes(question=self.question, client=self.speaker),
+            Likes(question=self.question, client=self.listener),
+        ])
+        Question.objects.filter(pk=self.question.pk).update(likes_count=7)
+
+        call_command('recount_likes', stdout=StringIO())
+
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.likes_count, 2)
+
+
+class QuestionsFeedPaginationTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        speaker = Client.objects.create(chat_id='1', first_name='Иван', last_name='Иванов')
+        event = Event.objects.create(name='Meetup', date=date(2023, 6, 25), start_time=time(10, 0))
+        cls.presentation = Presentation.objects.create(
+            name='Доклад',
+            annotation='Аннотация',
+            event=event,
+            start_time=time(10, 0),
+            end_time=time(11, 0),
+            speaker=speaker,
+        )
+        Question.objects.bulk_create([
+            Question(
+                question_number=number,
+                text=f'Вопрос {number}',
+                presentation=cls.presentation,
+                client=speaker,
+                likes_count=number % 4,
+            )
+            for number in range(1, 13)
+        ])
+        cls.ranked = list(
+            Question.objects.filter(presentation=cls.presentation).order_by('-likes_count', '-pk')
+        )
+
+    def test_pages_walk_forward_and_back(self):
+        pages = []
+        cursor = None
+        has_next = True
+        while has_next:
+            page, has_prev, has_next = fetch_questions_page(self.presentation.pk, cursor, limit=5)
+            self.assertEqual(has_prev, bool(pages))
+            pages.append(page)
+            cursor = encode_question_cursor(page[-1])
+        self.assertEqual([question for page in pages for question in page], self.ranked)
+
+        page, has_prev, has_next = fetch_questions_page(
+            self.presentation.pk, encode_question_cursor(pages[1][0]), 'prev', limit=5,
+        )
+        self.assertEqual(page, pages[0])
+        self.assertFalse(has_prev)
+        self.assertTrue(has_next)
+
+        page, _, _ = fetch_questions_page(
+            self.presentation.pk, encode_question_cursor(pages[1][0]), 'from', limit=5,
+        )
+        self.assertEqual(page, pages[1])
+
+
+class ScheduleResolverTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        speaker = Client.objects.create(chat_id='1', first_name='Иван', last_name='Иванов')
+        cls.event = Event.objects.create(name='Meetup', date=date(2023, 6, 25), start_time=time(10, 0))
+        cls.first = Presentation.objects.create(
+            name='Первый доклад',
+            annotation='Аннотация',
+            event=cls.event,
+            start_time=time(10, 0),
+            end_time=time(11, 0),
+            speaker=speaker,
+        )
+        cls.second = Presentation.objects.create(
+            name='Второй доклад',
+            annotation='Аннотация',
+            event=cls.event,
+            start_time=time(11, 0),
+            end_time=time(12, 0),
+            speaker=speaker,
+        )
+
+    def setUp(self):
+        schedule_resolver.invalidate()
+
+    def test_snapshot_is_reused_until_next_boundary(self):
+        resolver = ScheduleResolver(version=SharedVersion('schedule', check_interval=60))
+        with self.assertNumQueries(3):
+            snapshot = resolver.get_snapshot(datetime(2023, 6, 25, 9, 0))
+        self.assertIsNone(snapshot.current_event(datetime(2023, 6, 25, 9, 0)))
+        self.assertEqual(snapshot.valid_until, datetime(2023, 6, 25, 10, 0))
+
+        with self.assertNumQueries(3):
+            snapshot = resolver.get_snapshot(datetime(2023, 6, 25, 10, 30))
+        with self.assertNumQueries(0):
+            snapshot = resolver.get_snapshot(datetime(2023, 6, 25, 10, 59))
+        self.assertEqual(snapshot.current_presentation(datetime(2023, 6, 25, 10, 59)), self.first)
+
+    def test_finishing_presentation_invalidates_shared_resolver(self):
+        now = datetime(2023, 6, 25, 11, 30)
+        self.assertEqual(schedule_resolver.get_snapshot(now).current_presentation(now), self.first)
+
+        self.first.is_finished = True
+        self.first.save()
+
+        self.assertEqual(schedule_resolver.get_snapshot(now).current_presentation(now), self.second)
+
+    def test_edit_in_another_process_is_noticed(self):
+        resolver = ScheduleResolver(version=SharedVersion('schedule', check_interval=0))
+        now = datetime(2023, 6, 25, 11, 30)
+        self.assertEqual(resolver.get_snapshot(now).current_presentation(now), self.first)
+
+        # Админка в другом процессе: сигналы этого процесса не срабатывают, меняется только версия
+        Presentation.objects.filter(pk=self.first.pk).update(is_finished=True)
+        SharedVersion('schedule').bump()
+
+        self.assertEqual(resolver.get_snapshot(now).current_presentation(now), self.second)
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class PresentationSchedulerTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        speaker = Client.objects.create(chat_id='1', first_name='Иван', last_name='Иванов')
+        cls.event = Event.objects.create(name='Meetup', date=date(2023, 6, 25), start_time=time(10, 0))
+        cls.first = Presentation.objects.create(
+            name='Первый доклад',
+            annotation='Аннотация',
+            event=cls.event,
+            start_time=time(10, 0),
+            end_time=time(11, 0),
+            speaker=speaker,
+        )
+        cls.second = Presentation.objects.create(
+            name='Второй доклад',
+            annotation='Аннотация',
+            event=cls.event,
+            start_time=time(11, 0),
+            end_time=time(12, 0),
+            speaker=speaker,
+        )
+
+    def setUp(self):
+        schedule_resolver.invalidate()
+
+    async def test_presentations_finish_at_their_end_time(self):
+        clock = FakeClock(datetime(2023, 6, 25, 9, 0))
+        finished = []
+        scheduler = PresentationScheduler(schedule_resolver, clock=clock, on_finished=finished.extend)
+
+        state = await scheduler.tick()
+        self.assertIsNone(state.event)
+        self.assertEqual(scheduler.next_boundary(), datetime(2023, 6, 25, 10, 0))
+
+        clock.now = datetime(2023, 6, 25, 10, 30)
+        await scheduler.tick()
+        self.assertIs(schedule_resolver.state.presentation, await schedule_resolver.get_current_presentation(clock()))
+        self.assertEqual(schedule_resolver.state.presentation, self.first)
+        self.assertEqual(scheduler.next_boundary(), datetime(2023, 6, 25, 11, 0))
+
+        clock.now = datetime(2023, 6, 25, 11, 0)
+        state = await scheduler.tick()
+        self.assertEqual(finished, [self.first.pk])
+        self.assertTrue((await Presentation.objects.aget(pk=self.first.pk)).is_finished)
+        self.assertEqual(state.event, self.event)
+        self.assertEqual(state.presentation, self.second)
+
+        # Правка программы сбрасывает опубликованное состояние и передвигает границу
+        self.second.end_time = time(11, 30)
+        await self.second.asave()
+        self.assertIsNone(schedule_resolver.state)
+        await scheduler.tick()
+        self.assertEqual(scheduler.next_boundary(), datetime(2023, 6, 25, 11, 30))
+
+        clock.now = datetime(2023, 6, 25, 11, 30)
+        state = await scheduler.tick()
+        self.assertEqual(finished, [self.first.pk, self.second.pk])
+        self.assertIsNone(state.presentation)
+        self.assertEqual(scheduler.next_boundary(), datetime(2023, 6, 26, 0, 0))
+
+    async def test_presentation_finished_in_another_process_is_reported(self):
+        resolver = ScheduleResolver(version=SharedVersion('schedule', check_interval=0))
+        finished = []
+        scheduler = PresentationScheduler(
+            resolver, clock=FakeClock(datetime(2023, 6, 25, 10, 30)), on_finished=finished.extend,
+        )
+        await scheduler.tick()
+
+        # Докладчик завершил доклад в другом процессе бота: сигналы этого процесса не срабатывают
+        await Presentation.objects.filter(pk=self.first.pk).aupdate(is_finished=True)
+        await sync_to_async(SharedVersion('schedule').bump)()
+
+        state = await scheduler.tick()
+        self.assertEqual(finished, [self.first.pk])
+        self.assertIsNone(state.presentation)
+
+
+class MenuStateCacheTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.speaker = Client.objects.create(chat_id='1', first_name='Иван', last_name='Иванов')
+        cls.listener = Client.objects.create(chat_id='2', first_name='Петр', last_name='Петров')
+        cls.event = Event.objects.create(name='Meetup', date=date(2023, 6, 25), start_time=time(10, 0))
+        cls.today = date(2023, 6, 24)
+
+    def setUp(self):
+        production_version = menu_state_cache.version
+        menu_state_cache.version = SharedVersion('menu', check_interval=60)
+        self.addCleanup(setattr, menu_state_cache, 'version', production_version)
+        menu_state_cache.clear()
+        menu_state_cache.version.read()
+
+    def test_registration_invalidates_only_its_client(self):
+        menu_state_cache.get_state(self.speaker.pk, self.today)
+        menu_state_cache.get_state(self.listener.pk, self.today)
+
+        Visitor.objects.create(client=self.listener, event=self.event)
+
+        with self.assertNumQueries(0):
+            menu_state_cache.get_state(self.speaker.pk, self.today)
+        with self.assertNumQueries(2):
+            state = menu_state_cache.get_state(self.listener.pk, self.today)
+        self.assertEqual(state.upcoming_event_ids, {self.event.pk})
+
+    def test_new_presentation_invalidates_speaker(self):
+        self.assertFalse(menu_state_cache.get_state(self.speaker.pk, self.today).has_presentations)
+
+        Presentation.objects.create(
+            name='Доклад',
+            annotation='Аннотация',
+            event=self.event,
+            start_time=time(10, 0),
+            end_time=time(11, 0),
+            speaker=self.speaker,
+        )
+
+        self.assertTrue(menu_state_cache.get_state(self.speaker.pk, self.today).has_presentations)
+
+    def test_speaker_change_invalidates_only_both_speakers(self):
+        presentation = Presentation.objects.create(
+            name='Доклад',
+            annotation='Аннотация',
+            event=self.event,
+            start_time=time(10, 0),
+            end_time=time(11, 0),
+            speaker=self.speaker,
+        )
+        presentation = Presentation.objects.get(pk=presentation.pk)
+        menu_state_cache.get_state(self.speaker.pk, self.today)
+        menu_state_cache.get_state(self.listener.pk, self.today)
+
+        # Завершение доклада не трогает меню
+        presentation.is_finished = True
+        presentation.save(update_fields=['is_finished'])
+        presentation.save()
+        self.assertEqual(len(menu_state_cache), 2)
+
+        presentation.speaker = self.listener
+        presentation.save()
+        self.assertEqual(len(menu_state_cache), 0)
+        self.assertFalse(menu_state_cache.get_state(self.speaker.pk, self.today).has_presentations)
+        self.assertTrue(menu_state_cache.get_state(self.listener.pk, self.today).has_presentations)
+
+    def test_edit_in_another_process_is_noticed(self):
+        cache = MenuStateCache(version=SharedVersion('menu', check_interval=0))
+        self.assertFalse(cache.get_state(self.speaker.pk, self.today).has_presentations)
+
+        # Докладчика назначили в админке: сигналы этого процесса не срабатывают, меняется только версия
+        Presentation.objects.bulk_create([Presentation(
+            name='Доклад',
+            annotation='Аннотация',
+            event=self.event,
+            start_time=time(10, 0),
+            end_time=time(11, 0),
+            speaker=self.speaker,
+        )])
+        SharedVersion('menu').bump()
+
+        self.assertTrue(cache.get_state(self.speaker.pk, self.today).has_presentations)
+
+    def test_least_recently_used_state_is_evicted(self):
+        cache = MenuStateCache(maxsize=1)
+        cache.get_state(self.speaker.pk, self.today)
+        cache.get_state(self.listener.pk, self.today)
+
+        self.assertEqual(len(cache), 1)
+        with self.assertNumQueries(2):
+            cache.get_state(self.speaker.pk, self.today)
+
+
+class FakeBot:
+    def __init__(self, blocked=(), flooded=()):
+        self.blocked = set(blocked)
+        self.flooded = set(flooded)
+        self.sent = []
+        self.texts = []
+        self.edited = []
+
+    async def edit_message_text(self, text, chat_id, message_id, parse_mode=None, reply_markup=None):
+        self.edited.append((chat_id, message_id, text))
+
+    async def send_message(self, chat_id, text, parse_mode=None, reply_markup=None):
+        if chat_id in self.blocked:
+            raise BotBlocked('Forbidden: bot was blocked by the user')
+        if chat_id in self.flooded:
+            self.flooded.discard(chat_id)
+            raise RetryAfter(0)
+        self.sent.append(chat_id)
+        self.texts.append(text)
+
+
+class BroadcastEngineTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.event = Event.objects.create(name='Meetup', date=date(2023, 6, 25), start_time=time(10, 0))
+        for chat_id in ('1', '2', '3', '4'):
+            client = Client.objects.create(chat_id=chat_id)
+            Visitor.objects.create(client=client, event=cls.event)
+
+    def test_global_limit_is_shared_with_forked_workers(self):
+        bucket = SharedTokenBucket(10, clock=lambda: 0)
+
+        async def drain():
+            for _ in range(10):
+                await bucket.acquire()
+
+        worker = multiprocessing.get_context('fork').Process(target=lambda: asyncio.run(drain()))
+        worker.start()
+        worker.join()
+
+        self.assertEqual(worker.exitcode, 0)
+        self.assertEqual(bucket.tokens, 0)
+        bucket.pause(5)
+        self.assertEqual(bucket.paused_until, 5)
+
+    def statuses(self, broadcast):
+        return dict(broadcast.deliveries.values_list('chat_id', 'status'))
+
+    async def test_broadcast_skips_blocked_and_retries_after_flood_control(self):
+        bot = FakeBot(blocked={'2'}, flooded={'3'})
+        engine = BroadcastEngine(bot, rate=1000, chat_rate=1000, flush_every=2)
+        broadcast = await sync_to_async(engine.create_broadcast)('Время доклада изменено', self.event, ['1'])
+
+        await engine.run(broadcast)
+
+        self.assertCountEqual(bot.sent, ['3', '4'])
+        self.assertEqual(await sync_to_async(self.statuses)(broadcast), {
+            '2': BroadcastDelivery.BLOCKED,
+            '3': BroadcastDelivery.SENT,
+            '4': BroadcastDelivery.SENT,
+        })
+        self.assertIsNotNone(broadcast.finished_at)
+
+    async def test_interrupted_broadcast_resumes_pending_recipients(self):
+        bot = FakeBot()
+        engine = BroadcastEngine(bot, rate=1000, chat_rate=1000)
+        broadcast = await sync_to_async(engine.create_broadcast)('Время доклада изменено', self.event)
+        await sync_to_async(engine.save_progress)(broadcast, {BroadcastDelivery.SENT: ['1', '2']})
+
+        await engine.resume_unfinished()
+        await asyncio.gather(*engine._tasks)
+
+        self.assertCountEqual(bot.sent, ['3', '4'])
+
+    async def test_notification_is_sent_in_background_and_not_recorded(self):
+        bot = FakeBot(flooded={'5'})
+        engine = BroadcastEngine(bot, rate=1000, chat_rate=1000)
+
+        await engine.notify('5', 'Вы назначены спикером')
+
+        self.assertEqual(bot.sent, ['5'])
+        self.assertFalse(await BroadcastDelivery.objects.aexists())
+
+
+class LiveLeaderboardTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        speaker = Client.objects.create(chat_id='81', first_name='Иван', last_name='Иванов')
+        event = Event.objects.create(name='Meetup', date=date(2023, 6, 25), start_time=time(10, 0))
+        cls.presentation = Presentation.objects.create(
+            name='Доклад',
+            annotation='Аннотация',
+            event=event,
+            start_time=time(10, 0),
+            end_time=time(11, 0),
+            speaker=speaker,
+        )
+        cls.questions = Question.objects.bulk_create([
+            Question(question_number=number, text=f'Вопрос {number}', presentation=cls.presentation, client=speaker)
+            for number in range(1, 4)
+        ])
+
+    async def wait_for_edits(self, bot, count):
+        for _ in range(100):
+            if len(bot.edited) >= count:
+                return
+            await asyncio.sleep(0.01)
+
+    def test_ranking_moves_questions_by_likes(self):
+        first, second, third = self.questions
+        ranking = QuestionRanking.load(self.presentation.pk)
+        self.assertTrue(ranking.set_likes(third.pk, 2))
+        self.assertTrue(ranking.set_likes(first.pk, 1))
+        self.assertEqual([question.pk for question in ranking.top(3)], [third.pk, first.pk, second.pk])
+        self.assertTrue(ranking.remove(third.pk))
+        self.assertFalse(ranking.set_likes(third.pk, 5))
+        self.assertEqual([question.pk for question in ranking.top(3)], [first.pk, second.pk])
+
+    def test_bot_leaderboard_shares_broadcast_flood_limit(self):
+        self.assertIs(live_leaderboard.rate, broadcast_engine.global_bucket)
+
+    async def test_viewers_get_one_refresh_per_tick(self):
+        bot = FakeBot()
+        leaderboard = LiveLeaderboard(bot, interval=0.05, size=2, reload_interval=10)
+        await leaderboard.watch(self.presentation, 1, 10)
+        await leaderboard.watch(self.presentation, 2, 20)
+        await self.wait_for_edits(bot, 2)
+        self.assertCountEqual([(chat_id, message_id) for chat_id, message_id, _ in bot.edited], [(1, 10), (2, 20)])
+
+        for likes_count in range(1, 6):
+            leaderboard.question_liked(self.presentation.pk, self.questions[2].pk, likes_count)
+        await self.wait_for_edits(bot, 4)
+        await asyncio.sleep(0.1)
+        self.assertEqual(len(bot.edited), 4)
+        text = bot.edited[-1][2]
+        self.assertLess(text.index('Вопрос №3:</b> 👍 5'), text.index('Вопрос №2:'))
+        self.assertNotIn('Вопрос №1:', text)
+
+        leaderboard.stop(self.presentation.pk)
+        await asyncio.gather(*leaderboard._tasks)
+        self.assertEqual(leaderboard.viewers(self.presentation.pk), {})
+
+
+class HotScoresTest(TestCase):
+    half_life = 600
+    asked_at = datetime(2023, 6, 25, 10, 0, tzinfo=timezone.utc)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.speaker = Client.objects.create(chat_id='91', first_name='Иван', last_name='Иванов')
+        event = Event.objects.create(name='Meetup', date=date(2023, 6, 25), start_time=time(10, 0))
+        cls.presentation = Presentation.objects.create(
+            name='Доклад',
+            annotation='Аннотация',
+            event=event,
+            start_time=time(10, 0),
+            end_time=time(11, 0),
+            speaker=cls.speaker,
+        )
+        # Вопросы заданы с разницей в один период полураспада
+        cls.questions = Question.objects.bulk_create([
+            Question(
+                question_number=number,
+                text=f'Вопрос {number}',
+                presentation=cls.presentation,
+                client=cls.speaker,
+                hot_score=hot_vote(cls.asked_at + timedelta(seconds=cls.half_life * number), cls.half_life),
+            )
+            for number in range(1, 4)
+        ])
+
+    def test_fresh_votes_outweigh_old_ones(self):
+        old = hot_vote(self.asked_at, self.half_life)
+        fresh = hot_vote(self.asked_at + timedelta(seconds=2 * self.half_life), self.half_life)
+        self.assertAlmostEqual(add_hot_votes(old, old), old + 1)
+        self.assertAlmostEqual(add_hot_votes(old, fresh), add_hot_votes(fresh, old))
+        self.assertLess(add_hot_votes(add_hot_votes(old, old), old), fresh)
+
+    async def test_votes_move_questions_and_are_saved(self):
+        first, second, third = self.questions
+        voted_at = self.asked_at + timedelta(seconds=2 * self.half_life)
+        hot_scores = HotScores(flush_interval=10, half_life=self.half_life, clock=lambda: voted_at)
+        await hot_scores.question_liked(self.presentation.pk, first.pk)
+        ranking = hot_scores.ranking(self.presentation.pk)
+        self.assertEqual(ranking.top(3), [third.pk, first.pk, second.pk])
+        await hot_scores.question_liked(self.presentation.pk, first.pk)
+        self.assertEqual(ranking.top(3), [first.pk, third.pk, second.pk])
+
+        await hot_scores.close()
+        self.assertEqual(len(hot_scores), 0)
+        saved = await Question.objects.aget(pk=first.pk)
+        self.assertAlmostEqual(saved.hot_score, ranking.score(first.pk))
+
+        page, has_prev, has_next = await sync_to_async(fetch_questions_page)(self.presentation.pk, 'h', limit=2)
+        self.assertEqual([question.pk for question in page], [first.pk, third.pk])
+        self.assertFalse(has_prev)
+        self.assertTrue(has_next)
+        page, has_prev, has_next = await sync_to_async(fetch_questions_page)(
+            self.presentation.pk, encode_question_cursor(page[-1], 'hot'), limit=2,
+        )
+        self.assertEqual([question.pk for question in page], [second.pk])
+        self.assertTrue(has_prev)
+        self.assertFalse(has_next)
+
+    async def test_hot_feed_is_served_from_ranking_before_flush(self):
+        first, second, third = self.questions
+        hot_scores.forget(self.presentation.pk)
+        self.addCleanup(hot_scores.forget, self.presentation.pk)
+        await hot_scores.question_liked(self.presentation.pk, first.pk)
+        try:
+            page, _, has_next = await afetch_questions_page(self.presentation.pk, 'h', limit=2)
+            self.assertEqual([question.pk for question in page], [first.pk, third.pk])
+            self.assertTrue(has_next)
+            page, has_prev, has_next = await afetch_questions_page(
+                self.presentation.pk, encode_question_cursor(page[-1], 'hot'), limit=2,
+            )
+            self.assertEqual([question.pk for question in page], [second.pk])
+            self.assertEqual((has_prev, has_next), (True, False))
+            page, has_prev, _ = await afetch_questions_page(
+                self.presentation.pk, encode_question_cursor(page[0], 'hot'), 'prev', limit=2,
+            )
+            self.assertEqual([question.pk for question in page], [first.pk, third.pk])
+            self.assertFalse(has_prev)
+
+            # В базу голос попадет только при следующей записи
+            page, _, _ = await sync_to_async(fetch_questions_page)(self.presentation.pk, 'h', limit=2)
+            self.assertEqual([question.pk for question in page], [third.pk, second.pk])
+        finally:
+            await hot_scores.close()
+
+    def test_recount_uses_times_of_likes(self):
+        first = self.questions[0]
+        like = Likes.objects.create(question=first, client=self.speaker)
+        liked_at = self.asked_at + timedelta(seconds=self.half_life)
+        Likes.objects.filter(pk=like.pk).update(created_at=liked_at)
+        Question.objects.filter(pk=first.pk).update(created_at=self.asked_at)
+        recount_hot_scores(Question.objects.filter(pk=first.pk), self.half_life)
+        first.refresh_from_db()
+        expected = add_hot_votes(hot_vote(self.asked_at, self.half_life), hot_vote(liked_at, self.half_life))
+        self.assertAlmostEqual(first.hot_score, expected)
+
+
+class QuestionDigestsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.speaker = Client.objects.create(chat_id='71', first_name='Иван', last_name='Иванов')
+        cls.listener = Client.objects.create(chat_id='72', first_name='Петр', last_name='Петров')
+        event = Event.objects.create(name='Meetup', date=date(2023, 6, 25), start_time=time(10, 0))
+        cls.presentation = Presentation.objects.create(
+            name='Доклад',
+            annotation='Аннотация',
+            event=event,
+            start_time=time(10, 0),
+            end_time=time(11, 0),
+            speaker=cls.speaker,
+        )
+
+    def ask(self, digests, number, client=None):
+        digests.question_added(Question(
+            question_number=number,
+            text=f'Вопрос {number}',
+            presentation=self.presentation,
+            client=client or self.listener,
+        ))
+
+    async def test_burst_of_questions_is_one_digest(self):
+        bot = FakeBot()
+        # The window of the background task never closes by itself here, the test closes it with tick
+        digests = QuestionDigests(bot, interval=60, clock=FakeClock(timezone.now()))
+        for number in range(1, 51):
+            self.ask(digests, number)
+        self.ask(digests, 51, client=self.speaker)
+        await digests.tick()
+        self.assertEqual(bot.sent, ['71'])
+        self.assertIn('Вопрос №10:', bot.texts[0])
+        self.assertNotIn('Вопрос №11:', bot.texts[0])
+        self.assertIn('И еще вопросов: 40', bot.texts[0])
+
+        self.ask(digests, 52)
+        await digests.close()
+        self.assertEqual(bot.sent, ['71', '71'])
+        self.assertIn('Вопрос №52:', bot.texts[1])
+
+    async def test_bot_processes_share_one_digest_window(self):
+        bot = FakeBot()
+        clock = FakeClock(timezone.now())
+        first, second = QuestionDigests(bot, interval=60, clock=clock), QuestionDigests(bot, interval=60, clock=clock)
+        self.ask(first, 1)
+        self.ask(second, 2)
+        await first.tick()
+        await second.tick()
+        self.assertEqual(bot.sent, ['71'])
+
+        clock.now += timedelta(seconds=59)
+        await second.tick()
+        self.assertEqual(bot.sent, ['71'])
+
+        clock.now += timedelta(seconds=1)
+        await second.tick()
+        self.assertEqual(bot.sent, ['71', '71'])
+        self.assertCountEqual([text.count('Вопрос №') for text in bot.texts], [1, 1])
+        await first.close()
+        await second.close()
+        self.assertEqual(len(bot.sent), 2)
+
+    def test_bot_digests_share_broadcast_flood_limit(self):
+        self.assertIs(question_digests.rate, broadcast_engine.global_bucket)
+
+
+class WebhookTest(TestCase):
+    async def test_front_routes_each_user_to_one_worker(self):
+        received = {0: [], 1: []}
+
+        def create_worker(number):
+            async def handle(request):
+                received[number].append(await request.json())
+                return web.Response(text='ok')
+            app = web.Application()
+            app.router.add_post(WORKER_PATH, handle)
+            return TestServer(app)
+
+        async with create_worker(0) as first, create_worker(1) as second:
+            front = create_front_app('/webhook', [
+                str(first.make_url(WORKER_PATH)),
+                str(second.make_url(WORKER_PATH)),
+            ])
+            async with TestClient(TestServer(front)) as client:
+                for update_id, user_id in enumerate([10, 11, 10, 11, 12]):
+                    response = await client.post('/webhook', json=make_callback_update(update_id, user_id, 'main_menu'))
+                    self.assertEqual(response.status, 200)
+
+        users = {
+            number: {update['callback_query']['from']['id'] for update in updates}
+            for number, updates in received.items()
+        }
+        self.assertEqual(users, {0: {10, 12}, 1: {11}})
+
+    async def test_webhook_worker_answers_through_bot_api(self):
+        telegram = FakeTelegramServer()
+        production_server = bot.server
+        async with TestServer(telegram.app) as telegram_server:
+            bot.server = TelegramAPIServer.from_base(str(telegram_server.make_url('')))
+            try:
+                async with TestClient(TestServer(get_new_configured_app(dp, WORKER_PATH))) as client:
+                    response = await client.post(WORKER_PATH, json=make_message_update(1, 42, '/start'))
+                    self.assertEqual(response.status, 200)
+            finally:
+                bot.server = production_server
+                await (await bot.get_session()).close()
+
+        messages = telegram.calls_of('sendMessage')
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]['chat_id'], '42')
+        self.assertTrue(await Client.objects.filter(chat_id='42').aexists())
+
+
+class DatabaseStorageTest(TestCase):
+    def setUp(self):
+        self.now = 0
+        self.storage = DatabaseStorage(ttl=60, flush_interval=60, batch_size=3, clock=lambda: self.now)
+
+    async def test_state_survives_restart(self):
+        await self.storage.set_state(chat=1, user=1, state='ClientRegisterFSM:personal_info')
+        await self.storage.update_data(chat=1, user=1, event_id=5)
+        await self.storage.close()
+
+        restarted = DatabaseStorage(ttl=60, flush_interval=60)
+        self.assertEqual(await restarted.get_state(chat=1, user=1), 'ClientRegisterFSM:personal_info')
+        self.assertEqual(await restarted.get_data(chat=1, user=1), {'event_id': 5})
+
+        await restarted.finish(chat=1, user=1)
+        await restarted.close()
+        self.assertFalse(await FSMRecord.objects.aexists())
+
+    async def test_dirty_states_are_written_in_one_batch(self):
+        await self.storage.set_state(chat=1, user=1, state='first')
+        await self.storage.set_state(chat=2, user=2, state='second')
+        self.assertFalse(await FSMRecord.objects.aexists())
+        await self.storage.set_state(chat=3, user=3, state='third')
+        self.assertEqual(await FSMRecord.objects.acount(), 3)
+        await self.storage.close()
+
+    async def test_model_instances_are_rejected(self):
+        event = await Event.objects.acreate(name='Meetup', date=date(2023, 6, 25), start_time=time(10, 0))
+        with self.assertRaises(TypeError):
+            await self.storage.update_data(chat=1, user=1, event=event)
+
+    async def test_idle_state_expires(self):
+        await self.storage.set_state(chat=1, user=1, state='waiting')
+        await self.storage.close()
+        await FSMRecord.objects.aupdate(updated_at=timezone.now() - timedelta(seconds=61))
+        self.now = 61
+        self.assertIsNone(await self.storage.get_state(chat=1, user=1))
+
+    async def test_idle_unsaved_state_is_kept_until_written(self):
+        await self.storage.set_state(chat=1, user=1, state='waiting')
+        self.now = 61
+
+        def locked(records, cleanup):
+            raise OperationalError('database is locked')
+
+        self.storage._write = locked
+        with self.assertLogs('FSMStorage', 'ERROR'):
+            await self.storage.flush()
+
+        del self.storage._write
+        await self.storage.flush()
+        self.assertEqual((await FSMRecord.objects.aget(chat=1, user=1)).state, 'waiting')
+
+
+class CrashingLikesBuffer(LikesBuffer):
+    """Buffer whose next writes fail, optionally after the rows were saved."""
+
+    def __init__(self, failures, after_write=False, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+        self.after_write = after_write
+
+    def _write(self, votes):
+        if not self.failures:
+            return super()._write(votes)
+        self.failures -= 1
+        if self.after_write:
+            super()._write(votes)
+        raise OperationalError('database is locked')
+
+
+class LikesBufferTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.speaker = Client.objects.create(chat_id='1', first_name='Иван', last_name='Иванов')
+        Client.objects.bulk_create(Client(chat_id=str(chat_id)) for chat_id in range(2, 5))
+        event = Event.objects.create(name='Meetup', date=date(2100, 6, 25), start_time=time(10, 0))
+        presentation = Presentation.objects.create(
+            name='Доклад',
+            annotation='Аннотация',
+            event=event,
+            start_time=time(10, 0),
+            end_time=time(11, 0),
+            speaker=cls.speaker,
+        )
+        cls.question = Question.objects.create(question_number=1, text='Вопрос', presentation=presentation,
+                                               client=cls.speaker)
+        cls.presentation_id = presentation.pk
+
+    async def assert_saved_likes(self, count):
+        self.assertEqual(await Likes.objects.filter(question=self.question).acount(), count)
+        await self.question.arefresh_from_db()
+        self.assertEqual(self.question.likes_count, count)
+
+    async def test_votes_are_deduplicated_and_written_in_one_batch(self):
+        buffer = LikesBuffer(flush_interval=60, batch_size=3)
+        self.assertEqual(await buffer.vote(2, self.question.pk), (True, 1, self.presentation_id))
+        self.assertEqual(await buffer.vote(2, self.question.pk), (False, 1, self.presentation_id))
+        self.assertEqual(await buffer.vote(3, self.question.pk), (True, 2, self.presentation_id))
+        with self.assertRaises(Client.DoesNotExist):
+            await buffer.vote(99, self.question.pk)
+        self.assertTrue(buffer.has_vote(2, self.question.pk))
+        self.assertEqual(buffer.pending_count(self.question.pk), 2)
+        await self.assert_saved_likes(0)
+
+        self.assertEqual(await buffer.vote(4, self.question.pk), (True, 3, self.presentation_id))
+        self.assertEqual(len(buffer), 0)
+        await self.assert_saved_likes(3)
+        self.assertEqual(await buffer.vote(4, self.question.pk), (False, 3, self.presentation_id))
+        await buffer.close()
+
+    async def test_repeated_votes_stay_in_memory_and_flush_adds_inserted_votes(self):
+        buffer = LikesBuffer(flush_interval=60)
+        await Question.objects.filter(pk=self.question.pk).aupdate(likes_count=10)
+        await buffer.vote(2, self.question.pk)
+        await buffer.vote(3, self.question.pk)
+
+        with assert_query_budget(0):
+            self.assertEqual(await buffer.vote(2, self.question.pk), (False, 12, self.presentation_id))
+
+        await buffer.close()
+        # The flush adds its two votes to the counter instead of recounting the rows
+        await self.question.arefresh_from_db()
+        self.assertEqual(self.question.likes_count, 12)
+        self.assertEqual(await buffer.vote(3, self.question.pk), (False, 12, self.presentation_id))
+
+    async def test_failed_flush_keeps_votes(self):
+        buffer = CrashingLikesBuffer(failures=1, flush_interval=60)
+        await buffer.vote(2, self.question.pk)
+        with self.assertLogs('LikesBuffer', 'ERROR'):
+            await buffer.flush()
+        self.assertTrue(buffer.has_vote(2, self.question.pk))
+        self.assertEqual(await buffer.vote(3, self.question.pk), (True, 2, self.presentation_id))
+        await self.assert_saved_likes(0)
+
+        await buffer.close()
+        self.assertEqual(len(buffer), 0)
+        await self.assert_saved_likes(2)
+
+    async def test_retried_flush_does_not_count_votes_twice(self):
+        buffer = CrashingLikesBuffer(failures=1, after_write=True, flush_interval=60)
+        await buffer.vote(2, self.question.pk)
+        with self.assertLogs('LikesBuffer', 'ERROR'):
+            await buffer.flush()
+        self.assertEqual(await buffer.vote(2, self.question.pk), (False, 1, self.presentation_id))
+
+        await buffer.close()
+        await self.assert_saved_likes(1)
+
+    async def test_pending_votes_are_written_on_shutdown(self):
+        buffer = LikesBuffer(flush_interval=60)
+        await buffer.vote(2, self.question.pk)
+        await buffer.vote(3, self.question.pk)
+        await buffer.close()
+        await self.assert_saved_likes(2)
+        restarted = LikesBuffer(flush_interval=60)
+        self.assertEqual(await restarted.vote(3, self.question.pk), (False, 2, self.presentation_id))
+
+
+class ConcurrentQuestionNumbersTest(TestCase):
+    def ask_in_threads(self, alias, presentation, speaker, count):
+        barrier = threading.Barrier(count)
+
+        def ask(number):
+            # The in-memory test database locks whole tables, the bot runs on a WAL file like this one
+            connections['default'] = connections[alias]
+            barrier.wait()
+            try:
+                return queries.add_question(speaker, presentation.pk, f'Вопрос {number}').question_number
+            finally:
+                connections[alias].close()
+
+        with ThreadPoolExecutor(count) as executor:
+            return list(executor.map(ask, range(count)))
+
+    def test_simultaneous_questions_get_consecutive_numbers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            alias = 'question_numbers'
+            create_file_database(alias, Path(directory) / 'questions.sqlite3', connection.settings_dict['PRAGMAS'])
+            self.addCleanup(connections.settings.pop, alias)
+            try:
+                speaker = Client.objects.using(alias).create(chat_id='1', first_name='Иван', last_name='Иванов')
+                event = Event.objects.using(alias).create(name='Meetup', date=date(2100, 6, 25),
+                                                          start_time=time(10, 0))
+                presentation = Presentation.objects.using(alias).create(
+                    name='Доклад',
+                    annotation='Аннотация',
+                    event=event,
+                    start_time=time(10, 0),
+                    end_time=time(11, 0),
+                    speaker=speaker,
+                )
+
+                numbers = self.ask_in_threads(alias, presentation, speaker, 8)
+
+                self.assertEqual(sorted(numbers), list(range(1, 9)))
+                presentation.refresh_from_db()
+                self.assertEqual(presentation.questions_count, 8)
+            finally:
+                connections[alias].close()
+
+
+class QueriesTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.speaker = Client.objects.create(chat_id='1', first_name='Иван', last_name='Иванов')
+        cls.listener = Client.objects.create(chat_id='2', first_name='Петр', last_name='Петров')
+        cls.event = Event.objects.create(name='Meetup', date=date(2100, 6, 25), start_time=time(10, 0))
+        Event.objects.create(name='Прошедший Meetup', date=date(2000, 6, 25), start_time=time(10, 0))
+        cls.presentation = Presentation.objects.create(
+            name='Доклад',
+            annotation='Аннотация',
+            event=cls.event,
+            start_time=time(10, 0),
+            end_time=time(11, 0),
+            speaker=cls.speaker,
+        )
+
+    async def test_question_is_numbered_and_liked_once(self):
+        first = await queries.create_question(self.listener, self.presentation.pk, 'Первый')
+        second = await queries.create_question(self.listener, self.presentation.pk, 'Второй')
+        self.assertEqual((first.question_number, second.question_number), (1, 2))
+        self.assertEqual(await queries.count_questions(self.presentation.pk), 2)
+
+        self.assertEqual(await queries.like_question('1', second.pk), (True, 1, self.presentation.pk))
+        self.assertEqual(await queries.like_question('1', second.pk), (False, 1, self.presentation.pk))
+        self.assertEqual(await queries.like_question('2', second.pk), (True, 2, self.presentation.pk))
+        with self.assertRaises(Client.DoesNotExist):
+            await queries.like_question('99', second.pk)
+        with self.assertRaises(Question.DoesNotExist):
+            await queries.like_question('1', second.pk + 1)
+        self.assertEqual(await Likes.objects.filter(question=second).acount(), 2)
+        self.assertEqual(await queries.liked_question_ids('1', [first, second]), {second.pk})
+
+    async def test_client_events_include_only_upcoming_ones(self):
+        await queries.register_visitor(self.listener, self.event.pk)
+        await queries.register_visitor(self.listener, self.event.pk)
+        events = await queries.list_client_events(self.listener, date(2023, 6, 25))
+        self.assertEqual(events, [self.event])
+
+
+class FakeState:
+    def __init__(self, state):
+        self.state = state
+
+    async def get_state(self):
+        return self.state
+
+
+class KeyboardTemplateTest(TestCase):
+    def test_keyboards_are_built_once_per_arguments(self):
+        built = []
+
+        @keyboard_template(maxsize=2)
+        def get_keyboard(item_id):
+            built.append(item_id)
+            return InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text='Открыть', callback_data=f'open_{item_id}')],
+            ])
+
+        keyboard = get_keyboard(1)
+        self.assertIs(get_keyboard(1), keyboard)
+        get_keyboard(2)
+        get_keyboard(3)
+        get_keyboard(1)
+        self.assertEqual(built, [1, 2, 3, 1])
+        self.assertEqual(len(get_keyboard.cache), 2)
+        self.assertEqual(keyboard.inline_keyboard[0][0].callback_data, 'open_1')
+        # aiogram sends the cached JSON as is
+        self.assertEqual(prepare_arg(keyboard), prepare_arg(keyboard.markup))
+        self.assertIs(prepare_arg(keyboard), keyboard)
+
+    async def test_ids_from_callback_data_and_models_share_a_keyboard(self):
+        get_question_main_menu_keyboard.cache.clear()
+        keyboard = await get_question_main_menu_keyboard('7', False)
+        self.assertIs(await get_question_main_menu_keyboard(7, False), keyboard)
+        self.assertEqual(len(get_question_main_menu_keyboard.cache), 1)
+        self.assertEqual(keyboard.inline_keyboard[0][0].callback_data, 'question_ask_7')
+
+    async def test_async_builders_are_cached(self):
+        @keyboard_template()
+        async def get_keyboard():
+            return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='Меню', callback_data='menu')]])
+
+        self.assertIs(await get_keyboard(), await get_keyboard())
+        self.assertEqual((get_keyboard.cache.hits, get_keyboard.cache.misses), (1, 1))
+
+
+class CallbackRouterTest(TestCase):
+    def test_longest_prefix_and_current_state_win(self):
+        resolved, _ = router.resolve('event_about_5', 'ClientRegisterFSM:choose_event')
+        self.assertEqual(resolved.handler.__name__, 'register_event_about_handler')
+        resolved, callback_data = router.resolve('event_about_5', 'DonateFSM:enter_donate_amount')
+        self.assertEqual(resolved.handler.__name__, 'get_event_about_handler')
+        self.assertEqual(callback_data.event_id, 5)
+        resolved, _ = router.resolve('event_choose_5', 'ClientRegisterFSM:choose_event')
+        self.assertEqual(resolved.handler.__name__, 'event_choose_handler')
+        self.assertEqual(router.resolve('event_choose_5', None), (None, None))
+
+    def test_payload_is_parsed_into_typed_fields(self):
+        _, callback_data = router.resolve('question_like_7_2.15', None)
+        self.assertEqual((callback_data.question_id, callback_data.cursor), (7, '2.15'))
+        _, callback_data = router.resolve('question_like_7', None)
+        self.assertIsNone(callback_data.cursor)
+        _, callback_data = router.resolve('questions_prev_3_0.9', None)
+        self.assertEqual(callback_data, ('prev', 3, '0.9'))
+        self.assertEqual(router.resolve('question_like_seven', None), (None, None))
+        self.assertEqual(router.resolve('main_menu_extra', None), (None, None))
+
+    def test_same_prefix_and_state_is_a_conflict(self):
+        local_router = CallbackRouter()
+
+        @local_router.route(CallbackData('question_close', question_id=int), state='*')
+        async def close(callback):
+            pass
+
+        local_router.route(CallbackData('question_close', question_id=int), state='Speaker:busy')(close)
+        with self.assertRaises(CallbackConflict):
+            local_router.route(CallbackData('question_close', question_id=int), state='*')(close)
+
+    async def test_dispatch_passes_requested_arguments(self):
+        local_router = CallbackRouter()
+        calls = []
+
+        @local_router.route(CallbackData('pay', amount=int), state='DonateFSM:enter_donate_amount')
+        async def pay(callback, callback_data):
+            calls.append(callback_data.amount)
+
+        callback = types.CallbackQuery(id='1', data='pay_250')
+        await local_router.dispatch(callback, FakeState('DonateFSM:enter_donate_amount'))
+        with self.assertRaises(SkipHandler):
+            await local_router.dispatch(callback, FakeState(None))
+        self.assertEqual(calls, [250])
+
+    async def test_route_is_resolved_once_per_callback(self):
+        local_router = CallbackRouter()
+
+        @local_router.route(CallbackData('pay', amount=int), state='*')
+        async def pay(callback):
+            pass
+
+        callback = types.CallbackQuery(id='1', data='pay_250')
+        callback.matched_route = local_router.resolve(callback.data, None)
+        with mock.patch.object(local_router, 'resolve') as resolve:
+            await local_router.dispatch(callback, FakeState(None))
+            self.assertEqual(MetricsMiddleware.handler_name(callback), 'pay')
+        resolve.assert_not_called()
+
+
+class MetricsTest(TestCase):
+    def handled(self, update_type, handler):
+        histogram = metrics.samples.get('bot_handler_duration_seconds', {}).get(
+            (('handler', handler), ('update', update_type)))
+        return histogram['count'] if histogram else 0
+
+    async def test_handlers_are_timed_under_their_routes(self):
+        local_dp = Dispatcher(bot=bot)
+        local_dp.middleware.setup(MetricsMiddleware())
+        local_router = CallbackRouter(local_dp)
+
+        @local_dp.message_handler()
+        async def metrics_echo_handler(message):
+            pass
+
+        @local_router.route(CallbackData('metrics_vote', question_id=int), state='*')
+        async def metrics_vote_handler(callback):
+            raise ValueError('vote failed')
+
+        await local_dp.process_updates([types.Update(**make_message_update(1, 42, 'hello'))])
+        with self.assertRaises(ValueError):
+            await local_dp.process_updates([types.Update(**make_callback_update(2, 42, 'metrics_vote_7'))])
+
+        self.assertEqual(self.handled('message', 'metrics_echo_handler'), 1)
+        self.assertEqual(self.handled('callback_query', 'metrics_vote_handler'), 1)
+        labels = (('handler', 'metrics_vote_handler'), ('update', 'callback_query'))
+        self.assertEqual(metrics.samples['bot_handler_errors_total'][labels], 1)
+        self.assertEqual(metrics.samples['bot_handler_in_flight'][labels], 0)
+
+    def test_view_sums_snapshots_of_bot_processes(self):
+        first, second = Metrics(), Metrics()
+        first.observe('bot_handler_duration_seconds', 0.02, update='message', handler='start')
+        second.observe('bot_handler_duration_seconds', 3, update='message', handler='start')
+        second.inc('telegram_api_errors_total', method='sendMessage')
+        with tempfile.TemporaryDirectory() as directory:
+            first.write(f'{directory}/bot-1.json')
+            second.write(f'{directory}/bot-2.json')
+            with override_settings(METRICS_DIR=directory):
+                response = self.client.get('/metrics')
+
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        lines = response.content.decode().splitlines()
+        labels = 'handler="start",update="message"'
+        self.assertIn(f'bot_handler_duration_seconds_bucket{{{labels},le="0.025"}} 1', lines)
+        self.assertIn(f'bot_handler_duration_seconds_bucket{{{labels},le="5.0"}} 2', lines)
+        self.assertIn(f'bot_handler_duration_seconds_bucket{{{labels},le="+Inf"}} 2', lines)
+        self.assertIn(f'bot_handler_duration_seconds_count{{{labels}}} 2', lines)
+        self.assertIn('telegram_api_errors_total{method="sendMessage"} 1', lines)
+        self.assertIn('# TYPE bot_handler_in_flight gauge', lines)
+
+
+async def process_update(update):
+    """Run the update through the bot against a fake Bot API, returns the fake."""
+    telegram = FakeTelegramServer()
+    production_server = bot.server
+    bot.server = TelegramAPIServer.from_base(await telegram.start())
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    try:
+        await dp.process_updates([types.Update(**update)])
+    finally:
+        bot.server = production_server
+        await (await bot.get_session()).close()
+        await telegram.stop()
+    return telegram
+
+
+class QuestionHandlersTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.speaker = Client.objects.create(chat_id='81', first_name='Иван', last_name='Иванов')
+        cls.listener = Client.objects.create(chat_id='82', first_name='Петр', last_name='Петров')
+        event = Event.objects.create(name='Meetup', date=timezone.localdate(), start_time=time(0, 0))
+        cls.presentation = Presentation.objects.create(
+            name='Доклад',
+            annotation='Аннотация',
+            event=event,
+            start_time=time(0, 0),
+            end_time=time(23, 59),
+            speaker=cls.speaker,
+        )
+        cls.question = Question.objects.create(
+            question_number=1, text='Вопрос', presentation=cls.presentation, client=cls.speaker,
+        )
+
+    async def test_like_of_deleted_question_refreshes_feed(self):
+        question_id = self.question.pk
+        await self.question.adelete()
+        update = make_callback_update(1, 82, f'question_like_{question_id}_')
+        update['callback_query']['message']['reply_markup'] = {'inline_keyboard': [[
+            {'text': '📊 Топ вопросов онлайн', 'callback_data': f'questions_live_{self.presentation.pk}'},
+        ]]}
+
+        telegram = await process_update(update)
+
+        answers = telegram.calls_of('answerCallbackQuery')
+        self.assertEqual(len(answers), 1)
+        self.assertEqual(answers[0]['text'], 'Этот вопрос удалён')
+        edits = telegram.calls_of('editMessageText')
+        self.assertEqual(len(edits), 1)
+        self.assertIn('Открытых вопросов пока нет', edits[0]['text'])
+
+    async def test_deleted_presentation_is_answered(self):
+        presentation_id = self.presentation.pk
+        await self.presentation.adelete()
+        for update_id, data in enumerate([
+            f'questions_show_{presentation_id}',
+            f'questions_live_{presentation_id}',
+            f'presentation_annotation_{presentation_id}',
+        ]):
+            with self.subTest(data=data):
+                telegram = await process_update(make_callback_update(update_id, 82, data))
+                answers = telegram.calls_of('answerCallbackQuery')
+                self.assertEqual([answer['text'] for answer in answers], ['Этот доклад удалён'])
+                self.assertEqual(telegram.calls_of('editMessageText'), [])
+
+
+class QueryBudgetTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.speaker = Client.objects.create(chat_id='71', first_name='Иван', last_name='Иванов')
+        cls.listener = Client.objects.create(chat_id='72', first_name='Петр', last_name='Петров')
+        event = Event.objects.create(name='Meetup', date=timezone.localdate(), start_time=time(0, 0))
+        Visitor.objects.create(client=cls.listener, event=event)
+        cls.presentation = Presentation.objects.create(
+            name='Доклад',
+            annotation='Аннотация',
+            event=event,
+            start_time=time(0, 0),
+            end_time=time(23, 59),
+            speaker=cls.speaker,
+        )
+        cls.questions = Question.objects.bulk_create([
+            Question(question_number=number, text=f'Вопрос {number}', presentation=cls.presentation, client=cls.speaker)
+            for number in range(1, 21)
+        ])
+        Likes.objects.bulk_create([Likes(question=question, client=cls.listener) for question in cls.questions[::2]])
+
+    def setUp(self):
+        production_version = menu_state_cache.version
+        menu_state_cache.version = SharedVersion('menu', check_interval=60)
+        self.addCleanup(setattr, menu_state_cache, 'version', production_version)
+        menu_state_cache.clear()
+        # A running bot has read the version already and checks it once per interval
+        menu_state_cache.version.read()
+        schedule_resolver.invalidate()
+        # States cached by other tests would hide the loads
+        production_storage = dp.storage
+        dp.storage = DatabaseStorage()
+        self.addCleanup(setattr, dp, 'storage', production_storage)
+
+    async def process(self, update):
+        await process_update(update)
+
+    async def test_handlers_stay_within_query_budget(self):
+        budgets = [
+            (make_message_update(1, 72, '/start'), 8),
+            (make_callback_update(2, 72, f'questions_show_{self.presentation.pk}'), 3),
+            (make_callback_update(3, 72, f'question_like_{self.questions[1].pk}'), 7),
+            (make_callback_update(4, 71, 'main_menu'), 4),
+        ]
+        for update, budget in budgets:
+            with self.subTest(update=update):
+                with assert_query_budget(budget):
+                    await self.process(update)
+
+    async def test_updates_over_budget_are_logged(self):
+        local_dp = Dispatcher(bot=bot)
+        local_dp.middleware.setup(MetricsMiddleware(query_budget=1))
+
+        @local_dp.message_handler()
+        async def budget_greedy_handler(message):
+            for question in await sync_to_async(list)(Question.objects.all()[:2]):
+                await sync_to_async(lambda: question.client)()
+
+        with self.assertLogs('BotMetrics', 'WARNING') as logs:
+            await local_dp.process_updates([types.Update(**make_message_update(1, 71, 'hello'))])
+        self.assertIn('budget_greedy_handler: 3 queries', logs.output[0])
+        self.assertIn('repeated 2 times', logs.output[0])
+        labels = (('handler', 'budget_greedy_handler'), ('update', 'message'))
+        self.assertEqual(metrics.samples['bot_handler_queries_total'][labels], 3)
+        self.assertEqual(metrics.samples['bot_handler_over_query_budget_total'][labels], 1)
+
+    def test_assert_query_budget_lists_queries(self):
+        with self.assertRaisesRegex(AssertionError, 'feed: 2 queries'):
+            with assert_query_budget(1, 'feed'):
+                list(Question.objects.all()[:1])
+                list(Likes.objects.all()[:1])
+        with QueryProfile() as outer, assert_query_budget(1) as inner:
+            Question.objects.exists()
+        self.assertEqual((outer.count, inner.count), (1, 1))
+
+    def test_inherited_profile_stops_at_exit(self):
+        with QueryProfile() as profile:
+            # Context of a task started while handling the update, like a storage flush
+            task_context = contextvars.copy_context()
+        task_context.run(Question.objects.exists)
+        self.assertEqual(profile.count, 0)
+
+
+class BenchmarkTest(TestCase):
+    def tearDown(self):
+        menu_state_cache.clear()
+        schedule_resolver.invalidate()
+
+    def test_measurement_reports_queries_and_allocations(self):
+        measurement = Measurement(20)
+        for _ in measurement.runs():
+            list(Client.objects.all())
+            bytearray(100 * 1024)
+        result = measurement.result()
+        self.assertEqual(result['runs'], 20)
+        self.assertEqual(result['queries_per_run'], 1)
+        self.assertIn('ms_per_run', result)
+        self.assertGreater(result['alloc_kb_per_run'], 100)
+
+    def test_admin_flows_run_on_large_event(self):
+        options = {'clients': 20, 'presentations': 3, 'questions': 5, 'repeat': 10}
+        rows = admin_benchmark(options)
+        self.assertEqual([row['name'] for row in rows], [f'admin: {name}' for name in ADMIN_FLOWS])
+        self.assertEqual(Presentation.objects.count(), 3 + 10)
+        self.assertEqual(Event.objects.count(), 2 + 10)
+        self.assertEqual(Question.objects.filter(likes_count=4).count(), 3)
+
+
+class LoadGeneratorTest(TestCase):
+    async def test_fake_telegram_serves_updates_until_confirmed(self):
+        telegram = FakeTelegramServer()
+        telegram.push_update(make_message_update(1, 42, '/start'))
+        telegram.push_update(make_message_update(2, 42, '/help'))
+        updates = await telegram.get_updates({'offset': '0', 'limit': '1'})
+        self.assertEqual([update['update_id'] for update in updates], [1])
+        updates = await telegram.get_updates({'offset': '2', 'timeout': '1'})
+        self.assertEqual([update['update_id'] for update in updates], [2])
+        self.assertEqual(await telegram.get_updates({'offset': '3', 'timeout': '0.01'}), [])
+
+        reply = telegram.wait_for_reply(42)
+        telegram.record('sendMessage', {'chat_id': '42', 'text': 'Привет'}, {'message_id': 7})
+        self.assertEqual(await reply, ('sendMessage', {'chat_id': '42', 'text': 'Привет'}, {'message_id': 7}))
+
+    async def test_attendees_and_speaker_go_through_polling_bot(self):
+        await sync_to_async(create_load_fixture)()
+        load = LoadGenerator(users=3, timeout=10)
+        elapsed = await load.run()
+
+        self.assertEqual(load.errors, [])
+        self.assertEqual(len(load.latencies['question_text']), 3)
+        self.assertEqual(await Question.objects.acount(), 3)
+        self.assertEqual(await Visitor.objects.acount(), 3)
+        total, *actions = load.report(elapsed, queries=0)
+        self.assertEqual(total['runs'], sum(row['runs'] for row in actions))
+        self.assertEqual(total['api_calls_per_run'], 1)
+
+
+class SingleFlightTest(TestCase):
+    async def test_concurrent_reads_share_one_call(self):
+        flight = SingleFlight()
+        calls = []
+
+        @flight.coalesce('schedule')
+        async def read(event_id):
+            calls.append(event_id)
+            await asyncio.sleep(0.01)
+            return [event_id]
+
+        first, second, other = await asyncio.gather(read(1), read(1), read(2))
+        self.assertIs(first, second)
+        self.assertEqual(other, [2])
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(flight.stats(), {'schedule': {'hits': 1, 'misses': 2}})
+        self.assertEqual(len(flight), 0)
+
+        await read(1)
+        self.assertEqual(calls, [1, 2, 1])
+
+    async def test_cancelled_caller_does_not_cancel_shared_read(self):
+        flight = SingleFlight()
+
+        async def read():
+            await asyncio.sleep(0.01)
+            return 'schedule'
+
+        impatient = asyncio.ensure_future(flight.do(('read',), read))
+        patient = asyncio.ensure_future(flight.do(('read',), read))
+        await asyncio.sleep(0)
+        impatient.cancel()
+        self.assertEqual(await patient, 'schedule')
+
+    async def test_fresh_read_does_not_join_read_started_before_write(self):
+        flight = SingleFlight()
+        likes = [0]
+        started = asyncio.Event()
+
+        @flight.coalesce('likes')
+        async def read():
+            seen = likes[0]
+            started.set()
+            await asyncio.sleep(0.01)
+            return seen
+
+        stale = asyncio.ensure_future(read())
+        await started.wait()
+        likes[0] += 1
+        fresh = asyncio.ensure_future(read(fresh=True))
+        await asyncio.sleep(0)
+        joined = asyncio.ensure_future(read())
+        self.assertEqual(await asyncio.gather(stale, fresh, joined), [0, 1, 1])
+        self.assertEqual(flight.stats(), {'likes': {'hits': 1, 'misses': 2}})
+
+
+class SQLitePragmasTest(TestCase):
+    def test_connection_profile_is_applied(self):
+        pragmas = connection.settings_dict['PRAGMAS']
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], pragmas['busy_timeout'])
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], pragmas['cache_size'])
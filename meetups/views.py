@@ -1,3 +1,14 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.http import HttpResponse
+from django.views.decorators.http import require_GET
 
-# Create your views here.
+from meetups.metrics import load_snapshots, merge_snapshots, render_prometheus
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+@require_GET
+def metrics(request):
+    """Bot metrics summed over the processes that saved them lately."""
+    snapshots = load_snapshots(settings.METRICS_DIR, settings.METRICS_MAX_AGE) if settings.METRICS_DIR else []
+    return HttpResponse(render_prometheus(merge_snapshots(snapshots)), content_type=PROMETHEUS_CONTENT_TYPE)